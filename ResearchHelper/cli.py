@@ -1,13 +1,16 @@
 import os
 import shutil
+import datetime
 
 import click
 from flask import current_app, g
 from flask.cli import with_appcontext, AppGroup
 
 from .db import db
-from .models import InvitationCode
+from .models import InvitationCode, User
 from .utils import rlid_generator
+from .utils import parse_size
+from .utils import format_size
 
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -243,7 +246,167 @@ def new_mod_command(mod_name, dir):
         click.echo('Please register its blueprint in the app factory.')
 
 
+paper_cli = AppGroup('paper')
+paper_cache_cli = AppGroup('cache')
+paper_cli.add_command(paper_cache_cli)
+
+
+def get_spider_cache_manager(quota=None):
+    # paper package can be imported only after the app is created
+    from .paper.caches import CacheManager
+    from .paper.config import spider_cache_quota
+    store = current_app.extensions['spider_cache_store']
+    return CacheManager(store, quota or spider_cache_quota)
+
+def gc_spider_cache(quota=None, dry_run=False):
+    return get_spider_cache_manager(quota).gc(dry_run=dry_run)
+
+def purge_parse_cache():
+    # the items parsed by the former versions of the registered spiders
+    from .paper.spiders import SpiderFactory
+    parse_cache = current_app.extensions.get('spider_parse_cache')
+    if parse_cache is None:
+        return 0
+    return parse_cache.purge_versions({
+        spider_cls.get_spider_key(): spider_cls.version
+        for spider_cls in SpiderFactory.registry.spiders
+    })
+
+def get_spider_cache_stats(quota=None):
+    return get_spider_cache_manager(quota).stats()
+
+
+@paper_cache_cli.command('gc')
+@click.option('--quota', default=None, help='The max size of cache, e.g. 2G')
+@click.option('--dry-run', is_flag=True, help='Only report what would be evicted')
+@with_appcontext
+def gc_spider_cache_command(quota, dry_run):
+    """Evict the least recently used spider cache over the quota, and
+    purge the items parsed by the former versions of spiders."""
+    quota = parse_size(quota) if quota else None
+    result = gc_spider_cache(quota, dry_run)
+    click.echo('{} accesses are applied.'.format(result['accesses']))
+    click.echo('{} entries({}) are {}evicted, {} left.'.format(
+        result['evicted'], format_size(result['evicted_size']),
+        'going to be ' if dry_run else '',
+        format_size(result['size'] - result['evicted_size'])))
+    click.echo('{} broken entries({}) are swept.'.format(
+        result['swept'], format_size(result['swept_size'])))
+    if not dry_run:
+        click.echo('{} parsed items of the former spider versions are purged.'.format(
+            purge_parse_cache()))
+
+
+@paper_cache_cli.command('stats')
+@click.option('--quota', default=None, help='The max size of cache, e.g. 2G')
+@with_appcontext
+def spider_cache_stats_command(quota):
+    """Show the statistics of spider cache."""
+    quota = parse_size(quota) if quota else None
+    stats = get_spider_cache_stats(quota)
+    click.echo('entries: {}'.format(stats['units']))
+    click.echo('size: {} / {} ({:.1%})'.format(format_size(stats['size']),
+        format_size(stats['quota']), stats['usage']))
+    for key in ('oldest_access', 'newest_access'):
+        value = stats[key]
+        value = datetime.datetime.fromtimestamp(value) if value else '-'
+        click.echo('{}: {}'.format(key.replace('_', ' '), value))
+    click.echo('access log: {}'.format(format_size(stats['access_log_size'])))
+
+
+def run_pull_worker(burst=False, interval=None, limit=None):
+    from .paper.jobs import work
+    from .paper.config import spider_job_poll_interval
+    return work(burst=burst, interval=interval or spider_job_poll_interval,
+        limit=limit)
+
+
+@paper_cli.command('worker')
+@click.option('--burst', is_flag=True, help='Quit when there is no pull job')
+@click.option('--interval', default=None, type=float,
+    help='The seconds to wait before polling pull jobs again')
+@click.option('--limit', default=None, type=int,
+    help='Quit after the number of pull jobs are done')
+@with_appcontext
+def pull_worker_command(burst, interval, limit):
+    """Consume the queued pull jobs, start more workers to pull papers
+    in parallel."""
+    count = run_pull_worker(burst, interval, limit)
+    click.echo('{} pull jobs are done.'.format(count))
+
+
+def reparse_spider_cache(processes=None, batch_size=None, restart=False,
+    progress=None):
+    from .paper.reparse import Checkpoint, reparse
+    from .paper.config import spider_reparse_batch_size
+    from .paper.config import get_spider_reparse_checkpoint_path
+    checkpoint = Checkpoint(get_spider_reparse_checkpoint_path(current_app))
+    if restart:
+        checkpoint.clear()
+    store = current_app.extensions['spider_cache_store']
+    return reparse(store, checkpoint, processes=processes,
+        batch_size=batch_size or spider_reparse_batch_size, progress=progress)
+
+
+@paper_cli.command('reparse')
+@click.option('--processes', default=None, type=int,
+    help='The number of worker processes, default to the number of CPUs')
+@click.option('--batch-size', default=None, type=int,
+    help='The number of sources saved in a transaction')
+@click.option('--restart', is_flag=True,
+    help='Ignore the checkpoint of the interrupted reparse')
+@with_appcontext
+def reparse_spider_cache_command(processes, batch_size, restart):
+    """Parse the cached pages again by spiders and update their sources,
+    e.g., after the spiders are fixed. An interrupted reparse is resumed
+    from its checkpoint."""
+    def progress(state):
+        click.echo('{parsed} parsed, {failed} failed, {skipped} skipped.'.format(**state))
+
+    state = reparse_spider_cache(processes, batch_size, restart, progress)
+    click.echo('{created} sources are created, {updated} updated, '
+        '{incomplete} incomplete.'.format(**state))
+
+
+def import_paper_urls(lines, username, batch_size=None, progress=None):
+    from .paper.imports import import_urls, get_batch_engine
+    from .paper.config import spider_import_batch_size, get_spider_options
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.BadParameter('User [{}] does not exist.'.format(username),
+            param_hint='--user')
+    return import_urls(lines, user, get_spider_options(current_app),
+        batch_size=batch_size or spider_import_batch_size,
+        engine=get_batch_engine(), progress=progress)
+
+
+@paper_cli.command('import')
+@click.argument('file', type=click.File('r', encoding='utf-8'))
+@click.option('--user', 'username', required=True,
+    help='The username who the papers are imported for')
+@click.option('--batch-size', default=None, type=int,
+    help='The number of urls pulled and saved in a transaction')
+@with_appcontext
+def import_paper_urls_command(file, username, batch_size):
+    """Pull the papers of urls in the file, one url per line, and add
+    them to the user's papers. Use `-` to read from stdin."""
+    def progress(result):
+        click.echo('{} urls are imported.'.format(result['urls']))
+
+    result = import_paper_urls(file, username, batch_size, progress)
+    for url, error in result['failures']:
+        click.echo('{}: {}'.format(url, error), err=True)
+    seconds = result['seconds']
+    click.echo('{} urls in {:.1f}s ({:.1f} urls/s), {} pulled, {} existing, '
+        '{} duplicated, {} incomplete, {} failed.'.format(
+            result['urls'], seconds, result['urls'] / seconds if seconds else 0.0,
+            result['pulled'], result['existing'], result['duplicated'],
+            result['incomplete'], len(result['failures'])))
+    click.echo('{} papers are added for [{}].'.format(result['created'], username))
+
+
 def init_app(app):
     app.cli.add_command(db_cli)
     app.cli.add_command(generate_cli)
-    app.cli.add_command(mod_cli)
\ No newline at end of file
+    app.cli.add_command(mod_cli)
+    app.cli.add_command(paper_cli)
\ No newline at end of file
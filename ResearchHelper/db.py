@@ -101,9 +101,12 @@ class CommaSeparatedString(sa.types.TypeDecorator):
             return comma_separated_string_split(value)
 
 
+# add custome column types, the models can be imported without an app,
+# e.g., by the spawned worker processes
+db.JSONType = JSONType
+db.CommaSeparatedString = CommaSeparatedString
+
+
 def init_app(app):
     """Register functions/commands into application instance."""
-    db.init_app(app)
-    # add custome column types
-    db.JSONType = JSONType
-    db.CommaSeparatedString = CommaSeparatedString
\ No newline at end of file
+    db.init_app(app)
\ No newline at end of file
@@ -12,11 +12,50 @@ from ResearchHelper.forms import ModelForm
 # create forms via WTForms-Alchemy factory
 from ResearchHelper.forms import metaclass_form_factory
 from ResearchHelper.forms import CommaListField
-from ResearchHelper.api import response_json
+from ResearchHelper.api import status_code, response_json
 from ResearchHelper.models import User
 
 from .controllers import bp
 from .config import get_spider_cache_folder
+from .config import spider_cache_store
+from .config import spider_cache_compression
+from .config import spider_cache_access_log
+from .config import spider_pool_enabled
+from .config import spider_pool_maxsize
+from .config import spider_pool_idle_timeout
+from .config import spider_entry_point_group
+from .config import spider_rate_limit_enabled
+from .config import spider_rate_limit
+from .config import spider_rate_burst
+from .config import spider_rate_limits
+from .config import spider_rate_limit_filename
+from .config import spider_retry_after_max
+from .config import spider_retry_enabled
+from .config import spider_retries
+from .config import spider_retry_backoff
+from .config import spider_retry_max_backoff
+from .config import spider_breaker_enabled
+from .config import spider_breaker_window
+from .config import spider_breaker_min_requests
+from .config import spider_breaker_threshold
+from .config import spider_breaker_reset_timeout
+from .config import spider_negative_cache_enabled
+from .config import spider_negative_cache_filename
+from .config import spider_negative_cache_ttls
+from .config import spider_parse_cache_enabled
+from .config import spider_parse_cache_filename
+from .config import spider_metrics_enabled
+from .config import spider_metrics_buckets
+from .config import spider_parse_executor
+from .config import spider_transport_mode
+from .config import get_spider_archive_path
+from .transports import HTTPConnectionPool, ReplayTransport, RecordTransport
+from .schedulers import SharedHostScheduler
+from .breakers import RetryPolicy, CircuitBreakers
+from .caches import create_cache_store, NegativeCache, ParseCache
+from .metrics import MetricsRegistry
+from .sandbox import ParseSandbox
+from .spiders import spider_registry
 
 __all__ = ['config', 'controllers', 'models']
 
@@ -24,4 +63,73 @@ __all__ = ['config', 'controllers', 'models']
 def init_app(app):
     dirname = get_spider_cache_folder(app)
     if not os.path.isdir(dirname):
-        os.makedirs(dirname)
\ No newline at end of file
+        os.makedirs(dirname)
+    # the cache store is shared by all of spiders in the app
+    options = {'access_log': spider_cache_access_log}
+    if spider_cache_store in ('compressed', 'sqlite'):
+        options['compression'] = spider_cache_compression
+    app.extensions['spider_cache_store'] = create_cache_store(
+        spider_cache_store, dirname, **options)
+    # the failures of urls and the parsed items are kept out of the cache
+    # folder, so they are not evicted by the cache gc
+    if spider_negative_cache_enabled:
+        app.extensions['spider_negative_cache'] = NegativeCache(
+            os.path.join(app.instance_path, spider_negative_cache_filename),
+            spider_negative_cache_ttls
+        )
+    if spider_parse_cache_enabled:
+        app.extensions['spider_parse_cache'] = ParseCache(
+            os.path.join(app.instance_path, spider_parse_cache_filename))
+    # the connection pool is shared by all of spiders in the app
+    transport = None
+    if spider_pool_enabled:
+        transport = HTTPConnectionPool(
+            maxsize=spider_pool_maxsize,
+            idle_timeout=spider_pool_idle_timeout
+        )
+    # the responses are recorded into or replayed from the archive
+    if spider_transport_mode == 'record':
+        transport = RecordTransport(get_spider_archive_path(app), transport)
+    elif spider_transport_mode == 'replay':
+        transport = ReplayTransport(get_spider_archive_path(app))
+    elif spider_transport_mode != 'live':
+        raise ValueError('Unknown spider transport mode: {}'.format(
+            spider_transport_mode))
+    if transport is not None:
+        app.extensions['spider_transport'] = transport
+    # the request rate per host is limited for all of spiders in the app,
+    # but not the replayed ones
+    if spider_rate_limit_enabled and spider_transport_mode != 'replay':
+        app.extensions['spider_scheduler'] = SharedHostScheduler(
+            os.path.join(app.instance_path, spider_rate_limit_filename),
+            rate=spider_rate_limit,
+            burst=spider_rate_burst,
+            limits=spider_rate_limits,
+            max_pause=spider_retry_after_max
+        )
+    # the transient errors are retried, and the hosts keep failing are
+    # skipped for a while
+    if spider_retry_enabled:
+        app.extensions['spider_retry_policy'] = RetryPolicy(
+            retries=spider_retries,
+            backoff=spider_retry_backoff,
+            max_backoff=spider_retry_max_backoff
+        )
+    if spider_breaker_enabled:
+        app.extensions['spider_breakers'] = CircuitBreakers(
+            window=spider_breaker_window,
+            min_requests=spider_breaker_min_requests,
+            threshold=spider_breaker_threshold,
+            reset_timeout=spider_breaker_reset_timeout
+        )
+    # the metrics of all of spiders in the process
+    if spider_metrics_enabled:
+        app.extensions['spider_metrics'] = MetricsRegistry(spider_metrics_buckets)
+    # the pages are parsed out of the serving processes in the sandbox
+    if spider_parse_executor == 'sandbox':
+        app.extensions['spider_parse_sandbox'] = ParseSandbox()
+    elif spider_parse_executor != 'inline':
+        raise ValueError('Unknown spider parse executor: {}'.format(
+            spider_parse_executor))
+    # the spiders of the installed packages
+    spider_registry.load_entry_points(spider_entry_point_group)
\ No newline at end of file
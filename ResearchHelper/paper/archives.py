@@ -0,0 +1,167 @@
+import os
+import gzip
+import json
+import uuid
+import base64
+import datetime
+import threading
+from collections import namedtuple
+
+from .caches import atomic_write
+from .locks import file_lock
+
+
+# A recorded HTTP response, `headers` is a list of `(name, value)`
+ArchiveRecord = namedtuple('ArchiveRecord',
+    ['url', 'status', 'reason', 'headers', 'body', 'date'])
+
+
+def utcnow():
+    return datetime.datetime.utcnow().replace(microsecond=0).isoformat() + 'Z'
+
+
+class WarcArchive(object):
+    """The responses are kept as the `response` records of a WARC file,
+    it's gzipped if the filename ends with `.gz`, one gzip member per
+    record, so that the records are appended without rewriting the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.gzipped = path.endswith('.gz')
+        self.lock = threading.Lock()
+
+    def open(self, mode):
+        if self.gzipped:
+            return gzip.open(self.path, mode)
+        return open(self.path, mode)
+
+    def __iter__(self):
+        if not os.path.isfile(self.path):
+            return
+        with self.open('rb') as f:
+            while True:
+                line = f.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                if not line.startswith(b'WARC/'):
+                    raise ValueError('Invalid WARC record: {!r}'.format(line))
+                fields = {}
+                for line in iter(f.readline, b''):
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('utf-8').partition(':')
+                    fields[name.strip().lower()] = value.strip()
+                block = f.read(int(fields.get('content-length', 0)))
+                if fields.get('warc-type') != 'response':
+                    continue
+                yield self.parse_response(fields, block)
+
+    def parse_response(self, fields, block):
+        head, _, body = block.partition(b'\r\n\r\n')
+        lines = head.decode('iso-8859-1').split('\r\n')
+        status_line = lines[0].split(' ', 2)
+        headers = []
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers.append((name.strip(), value.strip()))
+        return ArchiveRecord(
+            url=fields.get('warc-target-uri'),
+            status=int(status_line[1]),
+            reason=status_line[2] if len(status_line) > 2 else '',
+            headers=headers,
+            body=body,
+            date=fields.get('warc-date')
+        )
+
+    def append(self, record):
+        head = ['HTTP/1.1 {} {}'.format(record.status, record.reason)]
+        head += ['{}: {}'.format(name, value) for name, value in record.headers]
+        block = '\r\n'.join(head).encode('iso-8859-1') + b'\r\n\r\n' + record.body
+        fields = [
+            'WARC/1.0',
+            'WARC-Type: response',
+            'WARC-Record-ID: <urn:uuid:{}>'.format(uuid.uuid4()),
+            'WARC-Date: {}'.format(record.date or utcnow()),
+            'WARC-Target-URI: {}'.format(record.url),
+            'Content-Type: application/http; msgtype=response',
+            'Content-Length: {}'.format(len(block)),
+        ]
+        data = '\r\n'.join(fields).encode('utf-8') + b'\r\n\r\n' + block + b'\r\n\r\n'
+        # the archive is appended by the workers of the app as well, a
+        # gzip member is written by several writes
+        with self.lock, file_lock(self.path + '.lock'):
+            with self.open('ab') as f:
+                f.write(data)
+
+
+class HarArchive(object):
+    """The responses are kept as the entries of a HAR(HTTP Archive) file,
+    e.g., the one exported by browsers. The file is rewritten when an
+    entry is appended.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return {'log': {'version': '1.2', 'entries': [],
+                'creator': {'name': 'ResearchHelper', 'version': '1.0'}}}
+        with open(self.path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def __iter__(self):
+        for entry in self.load()['log']['entries']:
+            response = entry['response']
+            content = response.get('content', {})
+            text = content.get('text', '')
+            if content.get('encoding') == 'base64':
+                body = base64.b64decode(text)
+            else:
+                body = text.encode('utf-8')
+            yield ArchiveRecord(
+                url=entry['request']['url'],
+                status=response['status'],
+                reason=response.get('statusText', ''),
+                headers=[(header['name'], header['value'])
+                    for header in response.get('headers', [])],
+                body=body,
+                date=entry.get('startedDateTime')
+            )
+
+    def append(self, record):
+        mime_type = dict((name.lower(), value)
+            for name, value in record.headers).get('content-type', '')
+        entry = {
+            'startedDateTime': record.date or utcnow(),
+            'time': 0,
+            'request': {'method': 'GET', 'url': record.url, 'headers': []},
+            'response': {
+                'status': record.status,
+                'statusText': record.reason,
+                'headers': [{'name': name, 'value': value}
+                    for name, value in record.headers],
+                'content': {
+                    'size': len(record.body),
+                    'mimeType': mime_type,
+                    'text': base64.b64encode(record.body).decode('ascii'),
+                    'encoding': 'base64'
+                }
+            }
+        }
+        with self.lock, file_lock(self.path + '.lock'):
+            har = self.load()
+            har['log']['entries'].append(entry)
+            atomic_write(self.path, json.dumps(har).encode('utf-8'))
+
+
+def open_archive(path):
+    """Open a HAR archive if the filename ends with `.har`, otherwise a
+    WARC archive."""
+    if path.endswith('.har'):
+        return HarArchive(path)
+    return WarcArchive(path)
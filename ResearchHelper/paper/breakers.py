@@ -0,0 +1,153 @@
+import time
+import random
+import threading
+from collections import deque
+
+
+class RetryPolicy(object):
+    """Retry the transient errors with exponential backoff and full jitter,
+    i.e., the n-th retry waits a random time in `[0, backoff * 2 ** n]`,
+    so the retries of many spiders don't hit the host at the same time.
+    """
+
+    def __init__(self, retries=2, backoff=0.5, max_backoff=8,
+        sleep=time.sleep, random=random.random):
+        """
+        :param retries: the max times a request is retried.
+        :param backoff: the base seconds of backoff.
+        :param max_backoff: the max seconds of backoff.
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+        self.random = random
+
+    def get_backoff(self, attempt):
+        """The seconds to wait before the retry after the attempt failed,
+        the attempt starts from 0."""
+        return self.random() * min(self.max_backoff, self.backoff * 2 ** attempt)
+
+    def wait(self, attempt):
+        """Wait before the retry, return False if no more retry."""
+        if attempt >= self.retries:
+            return False
+        self.sleep(self.get_backoff(attempt))
+        return True
+
+
+class CircuitBreaker(object):
+    """The circuit breaker of a host.
+
+    It's `closed` normally, and it's `open` once the error rate of the
+    recent requests passes the threshold, then the requests fail fast.
+    After `reset_timeout` seconds, it's `half-open` and a probe request
+    is allowed, the circuit is closed if the probe succeeds, otherwise
+    it's open again.
+    """
+
+    def __init__(self, window=20, min_requests=5, threshold=0.5,
+        reset_timeout=30, clock=time.monotonic):
+        self.threshold = threshold
+        self.min_requests = min_requests
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        # the results of recent requests, True means failed
+        self.results = deque(maxlen=window)
+        self.state = 'closed'
+        self.opened = None
+        # the start time of the probe request in half-open state
+        self.probing = None
+        self.rejected = 0
+        self.trips = 0
+
+    @property
+    def error_rate(self):
+        if not self.results:
+            return 0.0
+        return sum(self.results) / len(self.results)
+
+    def allow(self):
+        """Whether a request is able to be sent."""
+        if self.state == 'open':
+            if self.clock() - self.opened < self.reset_timeout:
+                self.rejected += 1
+                return False
+            self.state = 'half-open'
+            self.probing = None
+        if self.state == 'half-open':
+            # the result of a probe may be never recorded, e.g., its
+            # spider is broken, so another probe is sent after a while
+            now = self.clock()
+            if self.probing is not None and now - self.probing < self.reset_timeout:
+                self.rejected += 1
+                return False
+            self.probing = now
+        return True
+
+    def record(self, failed):
+        if self.state == 'half-open':
+            if failed:
+                self.trip()
+            else:
+                self.state = 'closed'
+                self.results.clear()
+            self.probing = None
+            return
+        self.results.append(failed)
+        if (failed and self.state == 'closed'
+            and len(self.results) >= self.min_requests
+            and self.error_rate >= self.threshold):
+            self.trip()
+
+    def trip(self):
+        self.state = 'open'
+        self.opened = self.clock()
+        self.trips += 1
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'requests': len(self.results),
+            'error_rate': self.error_rate,
+            'rejected': self.rejected,
+            'trips': self.trips,
+        }
+
+
+class CircuitBreakers(object):
+    """The thread-safe circuit breakers of hosts, shared by all of spiders
+    in the app as their `breakers`."""
+
+    def __init__(self, **options):
+        """
+        :param options: the arguments of `CircuitBreaker`.
+        """
+        self.options = options
+        self.lock = threading.Lock()
+        self.breakers = {}
+
+    def get_breaker(self, host):
+        breaker = self.breakers.get(host)
+        if breaker is None:
+            breaker = self.breakers[host] = CircuitBreaker(**self.options)
+        return breaker
+
+    def allow(self, host):
+        with self.lock:
+            return self.get_breaker(host).allow()
+
+    def record(self, host, failed):
+        """Record the result of a request of the host."""
+        with self.lock:
+            self.get_breaker(host).record(failed)
+
+    def state(self, host):
+        with self.lock:
+            return self.get_breaker(host).state
+
+    def stats(self):
+        """The statistics of breakers by hosts."""
+        with self.lock:
+            return {host: breaker.stats()
+                for host, breaker in self.breakers.items()}
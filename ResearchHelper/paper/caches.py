@@ -0,0 +1,924 @@
+import os
+import time
+import json
+import zlib
+import lzma
+import sqlite3
+import hashlib
+import datetime
+import tempfile
+import threading
+
+from dateutil import parser as date_parser
+
+
+def walk_files(dirname):
+    """Yield `os.DirEntry` of files in the directory recursively, the
+    directory is scanned lazily so that it works for millions of files."""
+    try:
+        entries = os.scandir(dirname)
+    except FileNotFoundError:
+        return
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from walk_files(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry
+
+
+def iter_shard_keys(dirname, after=''):
+    """Yield the keys of files in the shard folders `<key[:3]>/<key>` in
+    order, only the keys after the given one."""
+    try:
+        shards = sorted(os.listdir(dirname))
+    except FileNotFoundError:
+        return
+    for shard in shards:
+        path = os.path.join(dirname, shard)
+        if len(shard) != 3 or shard < after[:3] or not os.path.isdir(path):
+            continue
+        for name in sorted(os.listdir(path)):
+            if (name.startswith('.tmp-') or name.endswith('.meta')
+                or name <= after):
+                continue
+            yield name
+
+
+def atomic_write(filename, content):
+    """Write the bytes into a temporary file and rename it as filename, so
+    that readers never see a partial file."""
+    dirname = os.path.dirname(filename)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname, exist_ok=True)
+    fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(tmpname, filename)
+    except BaseException:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+
+class CacheWriter(object):
+    """Write the content of an entry chunk by chunk, the entry is visible
+    only after `commit()`. It's the default writer of cache stores, which
+    keeps the chunks in memory and `put()` them at last.
+    """
+
+    def __init__(self, store, key):
+        self.store = store
+        self.key = key
+        self.chunks = []
+
+    def write(self, chunk):
+        self.chunks.append(chunk)
+
+    def commit(self, meta):
+        self.store.put(self.key, b''.join(self.chunks), meta)
+        self.chunks = []
+
+    def abort(self):
+        self.chunks = []
+
+
+class FileCacheWriter(CacheWriter):
+    """Write the chunks into a temporary file, which is renamed as the
+    entry file on commit."""
+
+    def __init__(self, store, key):
+        self.store = store
+        self.key = key
+        dirname = os.path.dirname(store.path(key))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        fd, self.tmpname = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, chunk):
+        self.file.write(chunk)
+
+    def commit(self, meta):
+        self.file.close()
+        os.replace(self.tmpname, self.store.path(self.key))
+        self.store.put_meta(self.key, meta)
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.tmpname):
+            os.remove(self.tmpname)
+
+
+class CompressedCacheWriter(FileCacheWriter):
+    """Compress and hash the chunks while writing them into a temporary
+    file, which is renamed as the content object on commit."""
+
+    def __init__(self, store, key):
+        self.store = store
+        self.key = key
+        self.compression = store.compression
+        self.compressor = store.codecs[self.compression][3]()
+        self.sha1 = hashlib.sha1()
+        self.size = 0
+        dirname = os.path.join(store.cache_dir, 'objects')
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        fd, self.tmpname = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, chunk):
+        self.sha1.update(chunk)
+        self.size += len(chunk)
+        self.file.write(self.compressor.compress(chunk))
+
+    def commit(self, meta):
+        self.file.write(self.compressor.flush())
+        self.file.close()
+        digest = self.sha1.hexdigest()
+        filename = self.store.object_path(digest, self.compression)
+        if os.path.isfile(filename):
+            os.remove(self.tmpname)
+            self.store.set_atime(filename, time.time())
+        else:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            os.replace(self.tmpname, filename)
+        self.store.put_ref(self.key, {
+            'digest': digest,
+            'compression': self.compression,
+            'size': self.size,
+            'meta': meta
+        })
+
+
+class SqliteCacheWriter(CacheWriter):
+    """Keep the compressed chunks in memory and insert them on commit."""
+
+    def __init__(self, store, key):
+        self.store = store
+        self.key = key
+        self.compressor = store.codecs[store.compression][3]()
+        self.chunks = []
+
+    def write(self, chunk):
+        self.chunks.append(self.compressor.compress(chunk))
+
+    def commit(self, meta):
+        self.chunks.append(self.compressor.flush())
+        self.store.put_body(self.key, b''.join(self.chunks), meta)
+        self.chunks = []
+
+
+class BaseCacheStore(object):
+    """The base class of cache stores, all of them have the interface:
+
+    - `stat(key)`: the mtime of the entry, None if the entry doesn't exist.
+    - `read(key)`: the content bytes of the entry, None if the entry was
+      removed by the garbage collection.
+    - `meta(key)`: the metadata dict of the entry.
+    - `put(key, content, meta)`: create or replace the entry.
+    - `writer(key)`: a `CacheWriter` to put the entry chunk by chunk.
+    - `touch(key, meta=None)`: renew the mtime(and metadata) of the entry.
+    - `delete(key)`: remove the entry.
+    - `record_access(key)`: append the access of the entry to the access log.
+    - `iter_keys(after='')`: yield the keys of entries in order, only the
+      keys after the given one.
+
+    And the following methods are used by `CacheManager`:
+
+    - `access(key, atime)`: set the last access time of the entry.
+    - `iter_units()`: yield `(unit, size, atime)` of units can be evicted.
+    - `evict(unit)`: remove an evictable unit and its related data.
+    - `sweep()`: remove the broken entries, yield the size of removed data.
+    """
+
+    access_log_name = 'access.log'
+
+    def __init__(self, cache_dir, access_log=True):
+        self.cache_dir = cache_dir
+        self.access_log = access_log
+
+    @property
+    def access_log_path(self):
+        return os.path.join(self.cache_dir, self.access_log_name)
+
+    def writer(self, key):
+        return CacheWriter(self, key)
+
+    def record_access(self, key):
+        if not self.access_log:
+            return
+        # a short line appended in one write isn't interleaved with the
+        # lines of other processes
+        line = '{:.0f} {}\n'.format(time.time(), key).encode('ascii')
+        fd = os.open(self.access_log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+
+class FileCacheStore(BaseCacheStore):
+    """Store the content of each url in a plain file `<key[:3]>/<key>`,
+    and its metadata in the file `<key[:3]>/<key>.meta`. The evictable
+    units are the content files.
+    """
+
+    def path(self, key):
+        # the file of the entry whose mtime is the entry's mtime
+        return os.path.join(self.cache_dir, key[:3], key)
+
+    def meta_path(self, key):
+        return self.path(key) + '.meta'
+
+    def stat(self, key):
+        try:
+            return os.path.getmtime(self.path(key))
+        except FileNotFoundError:
+            return None
+
+    def read(self, key):
+        try:
+            with open(self.path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def meta(self, key):
+        try:
+            with open(self.meta_path(key), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def put(self, key, content, meta):
+        atomic_write(self.path(key), content)
+        self.put_meta(key, meta)
+
+    def put_meta(self, key, meta):
+        atomic_write(self.meta_path(key), json.dumps(meta).encode('utf-8'))
+
+    def writer(self, key):
+        return FileCacheWriter(self, key)
+
+    def touch(self, key, meta=None):
+        os.utime(self.path(key))
+        if meta is not None:
+            self.put_meta(key, meta)
+
+    def delete(self, key):
+        for filename in (self.path(key), self.meta_path(key)):
+            if os.path.isfile(filename):
+                os.remove(filename)
+
+    def set_atime(self, filename, atime):
+        # keep the mtime, it's the time of the content was stored
+        try:
+            st = os.stat(filename)
+            os.utime(filename, (atime, st.st_mtime))
+        except FileNotFoundError:
+            pass
+
+    def access(self, key, atime):
+        self.set_atime(self.path(key), atime)
+
+    def iter_keys(self, after=''):
+        return iter_shard_keys(self.cache_dir, after)
+
+    def iter_units(self):
+        for entry in walk_files(self.cache_dir):
+            if (entry.name.endswith('.meta') 
+                or entry.name.startswith('.tmp-')
+                or entry.path == self.access_log_path
+                or entry.name.startswith(self.access_log_name)):
+                continue
+            st = entry.stat()
+            yield entry.path, st.st_size, st.st_atime
+
+    def evict(self, path):
+        for filename in (path, path + '.meta'):
+            if os.path.isfile(filename):
+                os.remove(filename)
+
+    def sweep(self, tmp_expire=3600):
+        now = time.time()
+        for entry in walk_files(self.cache_dir):
+            st = entry.stat()
+            if entry.name.startswith('.tmp-'):
+                # the temporary file left by a crashed writer
+                if st.st_mtime + tmp_expire < now:
+                    os.remove(entry.path)
+                    yield st.st_size
+            elif entry.name.endswith('.meta'):
+                if not os.path.isfile(entry.path[:-len('.meta')]):
+                    os.remove(entry.path)
+                    yield st.st_size
+
+
+class CompressedCacheStore(FileCacheStore):
+    """Store the compressed content by its hash in `objects/<hash[:2]>/<hash>`,
+    so that identical contents are stored only once. The url(key) of an
+    entry is mapped to the content via a small JSON file `refs/<key[:3]>/<key>`,
+    which also holds the metadata of the entry. The evictable units are
+    the content objects.
+    """
+
+    # name: (extension, compress, decompress, streaming compressor)
+    codecs = {
+        'zlib': ('.z', lambda data: zlib.compress(data, 6), zlib.decompress,
+            lambda: zlib.compressobj(6)),
+        'lzma': ('.xz', lzma.compress, lzma.decompress, lzma.LZMACompressor),
+    }
+
+    def __init__(self, cache_dir, compression='zlib', access_log=True):
+        if compression not in self.codecs:
+            raise ValueError('Unknown compression: {}'.format(compression))
+        super().__init__(cache_dir, access_log)
+        self.compression = compression
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, 'refs', key[:3], key)
+
+    def object_path(self, digest, compression):
+        ext = self.codecs[compression][0]
+        return os.path.join(self.cache_dir, 'objects', digest[:2], digest + ext)
+
+    def ref(self, key):
+        with open(self.path(key), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def read(self, key):
+        try:
+            ref = self.ref(key)
+            decompress = self.codecs[ref['compression']][2]
+            with open(self.object_path(ref['digest'], ref['compression']), 'rb') as f:
+                return decompress(f.read())
+        except FileNotFoundError:
+            return None
+
+    def meta(self, key):
+        try:
+            return self.ref(key).get('meta', {})
+        except FileNotFoundError:
+            return {}
+
+    def put(self, key, content, meta):
+        digest = hashlib.sha1(content).hexdigest()
+        filename = self.object_path(digest, self.compression)
+        if os.path.isfile(filename):
+            self.set_atime(filename, time.time())
+        else:
+            compress = self.codecs[self.compression][1]
+            atomic_write(filename, compress(content))
+        self.put_ref(key, {
+            'digest': digest,
+            'compression': self.compression,
+            'size': len(content),
+            'meta': meta
+        })
+
+    def put_ref(self, key, ref):
+        atomic_write(self.path(key), json.dumps(ref).encode('utf-8'))
+
+    def writer(self, key):
+        return CompressedCacheWriter(self, key)
+
+    def put_meta(self, key, meta):
+        ref = self.ref(key)
+        ref['meta'] = meta
+        self.put_ref(key, ref)
+
+    def delete(self, key):
+        # the object may be shared with other entries, it's left to the
+        # garbage collection.
+        if os.path.isfile(self.path(key)):
+            os.remove(self.path(key))
+
+    def access(self, key, atime):
+        # the objects are evicted, refs are swept when their object is gone
+        try:
+            ref = self.ref(key)
+        except (FileNotFoundError, ValueError):
+            return
+        self.set_atime(self.object_path(ref['digest'], ref['compression']), atime)
+
+    def iter_keys(self, after=''):
+        return iter_shard_keys(os.path.join(self.cache_dir, 'refs'), after)
+
+    def iter_units(self):
+        for entry in walk_files(os.path.join(self.cache_dir, 'objects')):
+            if entry.name.startswith('.tmp-'):
+                continue
+            st = entry.stat()
+            yield entry.path, st.st_size, st.st_atime
+
+    def evict(self, path):
+        if os.path.isfile(path):
+            os.remove(path)
+
+    def sweep(self, tmp_expire=3600):
+        now = time.time()
+        for entry in walk_files(self.cache_dir):
+            st = entry.stat()
+            if entry.name.startswith('.tmp-'):
+                if st.st_mtime + tmp_expire < now:
+                    os.remove(entry.path)
+                    yield st.st_size
+                continue
+            if os.path.dirname(os.path.dirname(entry.path)) != os.path.join(self.cache_dir, 'refs'):
+                continue
+            try:
+                with open(entry.path, 'r', encoding='utf-8') as f:
+                    ref = json.load(f)
+                dangling = not os.path.isfile(
+                    self.object_path(ref['digest'], ref['compression']))
+            except (ValueError, KeyError):
+                dangling = True
+            if dangling:
+                os.remove(entry.path)
+                yield st.st_size
+
+
+class CacheManager(object):
+    """Keep the size of a cache store under the quota.
+
+    The entries are evicted in LRU order, the access time of an entry is
+    recorded by the access log of the store and written back to the store
+    by `gc()`. The evictable units are walked lazily twice during `gc()`,
+    and only a histogram of the sizes by access time is kept in memory.
+    """
+
+    # the width(seconds) of access time buckets of the histogram
+    bucket_width = 3600
+
+    def __init__(self, store, quota, low_watermark=0.9):
+        """
+        :param store: the cache store.
+        :param quota: the max total bytes of the cache.
+        :param low_watermark: the cache is reduced to `quota * low_watermark`
+            bytes once it's over the quota, so that gc isn't triggered too
+            often.
+        """
+        self.store = store
+        self.quota = quota
+        self.low_watermark = low_watermark
+
+    def fold_access_log(self):
+        """Apply the access log to the access time of cache entries.
+        Return the number of applied accesses.
+        """
+        path = self.store.access_log_path
+        if not os.path.isfile(path):
+            return 0
+        # writers create a new log once the current one is renamed
+        folding = '{}.{}.gc'.format(path, os.getpid())
+        os.replace(path, folding)
+        count = 0
+        with open(folding, 'r', encoding='ascii', errors='ignore') as f:
+            for line in f:
+                try:
+                    atime, key = line.split()
+                    atime = float(atime)
+                except ValueError:
+                    continue
+                self.store.access(key, atime)
+                count += 1
+        os.remove(folding)
+        return count
+
+    def stats(self):
+        """The statistics of the cache store."""
+        units, size = 0, 0
+        oldest, newest = None, None
+        for unit, unit_size, atime in self.store.iter_units():
+            units += 1
+            size += unit_size
+            oldest = atime if oldest is None else min(oldest, atime)
+            newest = atime if newest is None else max(newest, atime)
+        log_size = 0
+        if os.path.isfile(self.store.access_log_path):
+            log_size = os.path.getsize(self.store.access_log_path)
+        return {
+            'units': units,
+            'size': size,
+            'quota': self.quota,
+            'usage': size / self.quota if self.quota else 0.0,
+            'oldest_access': oldest,
+            'newest_access': newest,
+            'access_log_size': log_size,
+        }
+
+    def gc(self, dry_run=False):
+        """Evict the least recently used units until the cache is under
+        the quota, and sweep the broken entries.
+        Return a dict of the statistics of the collection.
+        """
+        result = {'accesses': 0, 'size': 0, 'evicted': 0,
+            'evicted_size': 0, 'swept': 0, 'swept_size': 0}
+        if not dry_run:
+            result['accesses'] = self.fold_access_log()
+
+        # first pass: the histogram of sizes by access time
+        histogram = {}
+        for unit, size, atime in self.store.iter_units():
+            bucket = int(atime // self.bucket_width)
+            histogram[bucket] = histogram.get(bucket, 0) + size
+            result['size'] += size
+
+        excess = result['size'] - int(self.quota * self.low_watermark)
+        if result['size'] > self.quota and excess > 0:
+            # evict all of buckets older than the cutoff, and a part of
+            # the cutoff bucket
+            cutoff, older = None, 0
+            for bucket in sorted(histogram):
+                if older + histogram[bucket] >= excess:
+                    cutoff = bucket
+                    break
+                older += histogram[bucket]
+            cutoff_excess = excess - older
+            # second pass: evict
+            for unit, size, atime in self.store.iter_units():
+                bucket = int(atime // self.bucket_width)
+                if bucket > cutoff:
+                    continue
+                if bucket == cutoff:
+                    if cutoff_excess <= 0:
+                        continue
+                    cutoff_excess -= size
+                if not dry_run:
+                    self.store.evict(unit)
+                result['evicted'] += 1
+                result['evicted_size'] += size
+
+        if not dry_run:
+            for size in self.store.sweep():
+                result['swept'] += 1
+                result['swept_size'] += size
+        return result
+
+
+class SqliteConnectionMixin(object):
+    """The SQLite connection of the current thread, sqlite connections
+    can't be shared by threads and processes, so a thread has its own
+    one, and the one inherited by a forked process is never used. The
+    classes have `db_path`, `timeout` and a `threading.local()` as
+    `local`, the `pragmas` are run on each new connection.
+    """
+
+    pragmas = ('journal_mode=WAL',)
+
+    @property
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            dirname = os.path.dirname(self.db_path)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=self.timeout)
+            for pragma in self.pragmas:
+                conn.execute('PRAGMA ' + pragma)
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+
+class SqliteCacheStore(SqliteConnectionMixin, BaseCacheStore):
+    """Store the entries in a single SQLite file, an entry is looked up
+    via the primary key index by one query, instead of several syscalls
+    of the file stores. The WAL journal makes it safe to be shared by
+    threads and processes. The evictable units are the entries.
+    """
+
+    codecs = CompressedCacheStore.codecs
+    filename = 'cache.sqlite3'
+    # the auto vacuum only works before the database is written, even by
+    # the journal mode, see `enable_auto_vacuum()` for the others
+    pragmas = ('auto_vacuum=INCREMENTAL', 'journal_mode=WAL', 'synchronous=NORMAL')
+    schema = """
+        CREATE TABLE IF NOT EXISTS entry (
+            key TEXT PRIMARY KEY,
+            mtime REAL NOT NULL,
+            atime REAL NOT NULL,
+            size INTEGER NOT NULL,
+            compression TEXT NOT NULL,
+            meta TEXT NOT NULL,
+            body BLOB NOT NULL
+        )
+    """
+
+    def __init__(self, cache_dir, compression='zlib', access_log=True, timeout=30):
+        if compression not in self.codecs:
+            raise ValueError('Unknown compression: {}'.format(compression))
+        super().__init__(cache_dir, access_log)
+        self.compression = compression
+        self.timeout = timeout
+        self.db_path = os.path.join(cache_dir, self.filename)
+        self.local = threading.local()
+        with self.connection as conn:
+            conn.execute(self.schema)
+        self.enable_auto_vacuum()
+
+    def enable_auto_vacuum(self):
+        # the database created without the incremental auto vacuum is
+        # rebuilt once, otherwise its free pages are never given back
+        conn = self.connection
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+            return
+        try:
+            conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            conn.execute('VACUUM')
+        except sqlite3.OperationalError:
+            # it's used by another process, try again next time
+            pass
+
+    def query(self, sql, *args):
+        return self.connection.execute(sql, args).fetchone()
+
+    def stat(self, key):
+        row = self.query('SELECT mtime FROM entry WHERE key = ?', key)
+        return row[0] if row else None
+
+    def read(self, key):
+        row = self.query('SELECT compression, body FROM entry WHERE key = ?', key)
+        if row is None:
+            return None
+        return self.codecs[row[0]][2](row[1])
+
+    def meta(self, key):
+        row = self.query('SELECT meta FROM entry WHERE key = ?', key)
+        return json.loads(row[0]) if row else {}
+
+    def put(self, key, content, meta):
+        self.put_body(key, self.codecs[self.compression][1](content), meta)
+
+    def put_body(self, key, body, meta):
+        # put the compressed content
+        now = time.time()
+        with self.connection as conn:
+            conn.execute('INSERT OR REPLACE INTO entry '
+                '(key, mtime, atime, size, compression, meta, body) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, now, now, len(body), self.compression, 
+                    json.dumps(meta), sqlite3.Binary(body)))
+
+    def writer(self, key):
+        return SqliteCacheWriter(self, key)
+
+    def touch(self, key, meta=None):
+        with self.connection as conn:
+            if meta is None:
+                conn.execute('UPDATE entry SET mtime = ? WHERE key = ?',
+                    (time.time(), key))
+            else:
+                conn.execute('UPDATE entry SET mtime = ?, meta = ? WHERE key = ?',
+                    (time.time(), json.dumps(meta), key))
+
+    def delete(self, key):
+        with self.connection as conn:
+            conn.execute('DELETE FROM entry WHERE key = ?', (key,))
+
+    def access(self, key, atime):
+        with self.connection as conn:
+            conn.execute('UPDATE entry SET atime = ? WHERE key = ?', (atime, key))
+
+    def iter_keys(self, after='', batch=1000):
+        while True:
+            rows = self.connection.execute('SELECT key FROM entry '
+                'WHERE key > ? ORDER BY key LIMIT ?', (after, batch)).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                yield row[0]
+            after = rows[-1][0]
+
+    def iter_units(self, batch=1000):
+        # walk by the primary key in batches, so that the evictions
+        # between batches don't break the iteration
+        last = ''
+        while True:
+            rows = self.connection.execute('SELECT key, size, atime FROM entry '
+                'WHERE key > ? ORDER BY key LIMIT ?', (last, batch)).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                yield row
+            last = rows[-1][0]
+
+    def evict(self, unit):
+        self.delete(unit)
+
+    def get_file_size(self):
+        size = 0
+        for path in (self.db_path, self.db_path + '-wal'):
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        return size
+
+    def sweep(self):
+        # give the free pages of evicted entries back to the file system
+        conn = self.connection
+        if not conn.execute('PRAGMA freelist_count').fetchone()[0]:
+            return
+        size = self.get_file_size()
+        # the pragma frees a page per step, `executescript()` runs it to
+        # the end, and the file is truncated by the checkpoint of WAL
+        conn.executescript('PRAGMA incremental_vacuum')
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        freed = size - self.get_file_size()
+        if freed > 0:
+            yield freed
+
+
+class NegativeCache(SqliteConnectionMixin):
+    """Remember the failures of urls for a while, so that a broken url is
+    not requested and parsed again and again. The failures are kept in a
+    SQLite file shared by threads and processes.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS failure (
+            key TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            error TEXT NOT NULL,
+            message TEXT NOT NULL,
+            code INTEGER,
+            time REAL NOT NULL,
+            expires REAL NOT NULL
+        )
+    """
+    index = 'CREATE INDEX IF NOT EXISTS failure_expires ON failure (expires)'
+
+    def __init__(self, db_path, ttls, timeout=30):
+        """
+        :param db_path: the path of SQLite file.
+        :param ttls: a dict of `kind -> seconds` the failures of the kind
+            are kept, the other kinds of failures are not kept.
+        """
+        self.db_path = db_path
+        self.ttls = dict(ttls)
+        self.timeout = timeout
+        self.local = threading.local()
+        with self.connection as conn:
+            conn.execute(self.schema)
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(failure)')]
+            if 'code' not in columns:
+                conn.execute('ALTER TABLE failure ADD COLUMN code INTEGER')
+            conn.execute(self.index)
+
+    def get(self, key):
+        """Return the failure `{kind, error, message, code, time}` of the
+        key if it's not expired, otherwise None."""
+        row = self.connection.execute('SELECT kind, error, message, code, time '
+            'FROM failure WHERE key = ? AND expires > ?',
+            (key, time.time())).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('kind', 'error', 'message', 'code', 'time'), row))
+
+    def put(self, key, kind, error, message, code=None):
+        """Keep the failure if its kind has a TTL, return True if kept.
+        The code is the HTTP status code of the failure if any."""
+        ttl = self.ttls.get(kind)
+        if not ttl:
+            return False
+        now = time.time()
+        with self.connection as conn:
+            conn.execute('INSERT OR REPLACE INTO failure '
+                '(key, kind, error, message, code, time, expires) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, kind, error, message, code, now, now + ttl))
+            # the failures are rare, so the expired ones are dropped here
+            conn.execute('DELETE FROM failure WHERE expires <= ?', (now,))
+        return True
+
+    def delete(self, key):
+        with self.connection as conn:
+            conn.execute('DELETE FROM failure WHERE key = ?', (key,))
+
+    def stats(self):
+        """The number of kept failures by kinds."""
+        rows = self.connection.execute('SELECT kind, COUNT(*) FROM failure '
+            'WHERE expires > ? GROUP BY kind', (time.time(),)).fetchall()
+        return dict(rows)
+
+
+class ParseCache(SqliteConnectionMixin):
+    """Keep the items parsed from the contents by the urls, the hash of
+    contents, the spiders and their versions, so that a spider doesn't
+    parse an unchanged content again. The url is a part of the key, since
+    the fields like `download_link` are resolved against it. The items are
+    kept in a SQLite file shared by threads and processes.
+
+    The items of the other versions of spiders are kept until they're
+    purged, e.g., by `flask paper cache gc`, so the processes running
+    different versions during a deploy don't remove the items of others.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS item (
+            urlhash TEXT NOT NULL,
+            digest TEXT NOT NULL,
+            spider TEXT NOT NULL,
+            version TEXT NOT NULL,
+            item TEXT NOT NULL,
+            time REAL NOT NULL,
+            PRIMARY KEY (urlhash, digest, spider, version)
+        )
+    """
+    index = 'CREATE INDEX IF NOT EXISTS item_spider ON item (spider, version)'
+
+    def __init__(self, db_path, timeout=30):
+        self.db_path = db_path
+        self.timeout = timeout
+        self.local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        with self.connection as conn:
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(item)')]
+            if columns and 'urlhash' not in columns:
+                # the items kept without their urls are dropped
+                conn.execute('DROP TABLE item')
+            conn.execute(self.schema)
+            conn.execute(self.index)
+
+    def encode(self, item):
+        item = dict(item)
+        if isinstance(item.get('published'), datetime.datetime):
+            item['published'] = item['published'].isoformat()
+        return json.dumps(item)
+
+    def decode(self, data):
+        item = json.loads(data)
+        if item.get('published'):
+            item['published'] = date_parser.isoparse(item['published'])
+        return item
+
+    def get(self, urlhash, digest, spider, version):
+        """Return the item dict parsed from the content of the url by the
+        version of spider, None if it's not kept."""
+        row = self.connection.execute('SELECT item FROM item WHERE urlhash = ? '
+            'AND digest = ? AND spider = ? AND version = ?',
+            (urlhash, digest, spider, str(version))).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.decode(row[0])
+
+    def put(self, urlhash, digest, spider, version, item):
+        """Keep the item, the items of the url parsed from its former
+        contents are removed, they're never taken again."""
+        with self.connection as conn:
+            conn.execute('DELETE FROM item WHERE urlhash = ? AND spider = ? '
+                'AND digest != ?', (urlhash, spider, digest))
+            conn.execute('INSERT OR REPLACE INTO item (urlhash, digest, spider, '
+                'version, item, time) VALUES (?, ?, ?, ?, ?, ?)',
+                (urlhash, digest, spider, str(version), self.encode(item),
+                time.time()))
+
+    def purge(self, spider, version=None):
+        """Remove the items of the spider except its current version, or
+        all of its items if the version is None. Return the number of
+        removed items."""
+        with self.connection as conn:
+            if version is None:
+                cursor = conn.execute('DELETE FROM item WHERE spider = ?', (spider,))
+            else:
+                cursor = conn.execute('DELETE FROM item '
+                    'WHERE spider = ? AND version != ?', (spider, str(version)))
+        return cursor.rowcount
+
+    def purge_versions(self, versions):
+        """Remove the items of the other versions of spiders.
+
+        :param versions: a dict of the spider keys to their current
+            versions, the items of the other spiders are kept.
+        Return the number of removed items.
+        """
+        return sum(self.purge(spider, version)
+            for spider, version in versions.items())
+
+    def stats(self):
+        """The number of kept items by spiders, and the hits and misses
+        in this process."""
+        rows = self.connection.execute(
+            'SELECT spider, COUNT(*) FROM item GROUP BY spider').fetchall()
+        return {'items': dict(rows), 'hits': self.hits, 'misses': self.misses}
+
+
+cache_stores = {
+    'file': FileCacheStore,
+    'compressed': CompressedCacheStore,
+    'sqlite': SqliteCacheStore,
+}
+
+
+def create_cache_store(name, cache_dir, **kwargs):
+    """Create a cache store by its name, i.e., `file`, `compressed` or
+    `sqlite`."""
+    if name not in cache_stores:
+        raise ValueError('Unknown cache store: {}'.format(name))
+    return cache_stores[name](cache_dir, **kwargs)
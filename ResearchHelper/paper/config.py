@@ -2,7 +2,187 @@ import os
 
 mod_name = 'paper'
 spider_cache_dirname = 'spider_cache'
+# the lock files of urls being pulled, see `locks.SingleFlight`
+spider_lock_dirname = 'spider_locks'
 spider_cache_expire = 3600
+# how the spider cache is stored, `file` keeps the plain content of each
+# url, `compressed` keeps the compressed and deduplicated contents, and
+# `sqlite` keeps all of entries in a single indexed SQLite file. The
+# entries of a former store are not migrated, they are missed and pulled
+# again, so remove the old `<md5[:3]>/<md5>` files after the switch
+spider_cache_store = 'file'
+# the compression of `compressed` and `sqlite` cache store, `zlib` or `lzma`
+spider_cache_compression = 'zlib'
+# the max total bytes of the spider cache, `flask paper cache gc` evicts
+# the least recently used entries once it's exceeded
+spider_cache_quota = 2 * 1024 ** 3
+# log the cache hits, so that the gc knows which entries are used recently
+spider_cache_access_log = True
+# the number of threads used to pull a batch of links
+spider_batch_workers = 8
+# the max number of links submitted in a batch
+spider_batch_limit = 100
+# the engine used to pull a batch of links, `thread` or `asyncio`, the
+# latter requires the aiohttp package
+spider_batch_engine = 'thread'
+# the max number of opened connections of the asyncio engine, in total
+# and per host
+spider_async_limit = 1000
+spider_async_limit_per_host = 8
+# reuse keep-alive connections of spiders via a connection pool
+spider_pool_enabled = True
+# the max number of idle connections kept per host
+spider_pool_maxsize = 4
+# the seconds an idle connection is kept
+spider_pool_idle_timeout = 60
+# how spiders fetch the responses, `live` fetches them from the network,
+# `record` also appends them into the archive, and `replay` serves them
+# from the archive without touching the network, e.g., for benchmarks
+spider_transport_mode = 'live'
+# the archive of `record` and `replay` modes relative to the instance
+# folder, a HAR file if it ends with `.har`, otherwise a WARC file
+spider_archive_filename = 'spider_archive.warc.gz'
+# limit the request rate of spiders per host, the default number of
+# requests per second and the max number of requests sent at once, the
+# limits are shared by all of processes of the app via the SQLite file
+spider_rate_limit_enabled = True
+spider_rate_limit_filename = 'spider_rate_limits.sqlite3'
+spider_rate_limit = 2
+spider_rate_burst = 4
+# the `(rate, burst)` of the hosts of spiders overrides the default
+spider_rate_limits = {
+    'sciencedirect.com': (1, 2),
+    'ieee.org': (1, 2),
+    'springer.com': (1, 2),
+}
+# the max seconds a host is paused by its `Retry-After` header
+spider_retry_after_max = 60
+# retry the transient errors of spiders, e.g., timeout and 5xx, the n-th
+# retry waits a random time up to `backoff * 2 ** n` seconds
+spider_retry_enabled = True
+spider_retries = 2
+spider_retry_backoff = 0.5
+spider_retry_max_backoff = 8
+# fail fast the requests of a host once the error rate of its recent
+# requests passes the threshold, and probe it after the reset timeout, the
+# circuit breakers are of each process, so each worker learns the state of
+# a host by its own requests, and probes it by itself
+spider_breaker_enabled = True
+spider_breaker_window = 20
+spider_breaker_min_requests = 5
+spider_breaker_threshold = 0.5
+spider_breaker_reset_timeout = 30
+# remember the failures of urls, so a broken url isn't pulled again until
+# its failure expires, the seconds are by the kinds of failures
+spider_negative_cache_enabled = True
+spider_negative_cache_filename = 'spider_failures.sqlite3'
+spider_negative_cache_ttls = {
+    'http_4xx': 3600,
+    'http_5xx': 120,
+    'timeout': 60,
+    'network': 60,
+    'parse': 600,
+}
+# keep the items parsed from the contents, so that the spiders don't
+# parse the unchanged contents again
+spider_parse_cache_enabled = True
+spider_parse_cache_filename = 'spider_items.sqlite3'
+# where the pages are parsed, `inline` in the threads of spiders, or
+# `sandbox` in a pool of worker processes, so a pathological page can't
+# take the memory or hang the serving processes, the memory of a worker is
+# capped by the limit(`RLIMIT_AS`), it's killed once a page takes more
+# than the seconds, and it's restarted after the number of pages, the
+# pages aren't parsed while downloading in the sandbox
+spider_parse_executor = 'inline'
+spider_parse_sandbox_processes = 2
+spider_parse_sandbox_max_jobs = 100
+spider_parse_sandbox_memory_limit = 512 * 1024 * 1024
+spider_parse_sandbox_timeout = 10
+# parse the response of spiders while downloading it
+spider_stream_enabled = True
+# record the fetch latency, bytes, cache hits and parse time of spiders
+# in the process, they are shown by `/paper/metrics`, the bucket bounds of
+# the histograms are in seconds
+spider_metrics_enabled = True
+# the workers publish their metrics into the folder at most once per the
+# seconds, `/paper/metrics` merges them, and the files of the workers not
+# updated in the expire seconds are removed
+spider_metrics_dirname = 'spider_metrics'
+spider_metrics_publish_interval = 10
+spider_metrics_expire = 7 * 24 * 3600
+spider_metrics_buckets = {
+    'fetch_seconds': (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 60),
+    'html_parse_seconds': (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1),
+    'parse_seconds': (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1),
+}
+# the seconds after which a running pull job is taken as abandoned by its
+# worker, and it's able to be claimed by another worker
+spider_job_lease = 300
+# the max number of times a pull job is claimed
+spider_job_max_attempts = 3
+# the seconds an idle worker waits before polling pull jobs again
+spider_job_poll_interval = 1.0
+# the entry point group where the installed packages export their spiders
+spider_entry_point_group = 'ResearchHelper.spiders'
+# `flask paper import` pulls the urls and saves their sources in batches
+spider_import_batch_size = 100
+# `flask paper reparse` parses the cached pages again, the sources are
+# saved in batches, and the last saved cache key is kept in the checkpoint
+# file, so an interrupted run is resumed from it
+spider_reparse_batch_size = 100
+spider_reparse_checkpoint_filename = 'spider_reparse.json'
+# the PDFs of sources are downloaded by the workers in chunks into the
+# upload folder of `files`, the interrupted downloads are kept in the
+# partial folder under it, and resumed by the next attempt
+spider_download_chunk_size = 64 * 1024
+spider_download_max_size = 100 * 1024 * 1024
+spider_download_timeout = 60
+spider_download_partial_dirname = '.partial'
 
 def get_spider_cache_folder(app):
-    return os.path.join(app.instance_path, spider_cache_dirname)
\ No newline at end of file
+    return os.path.join(app.instance_path, spider_cache_dirname)
+
+def get_spider_lock_folder(app):
+    return os.path.join(app.instance_path, spider_lock_dirname)
+
+def get_spider_reparse_checkpoint_path(app):
+    return os.path.join(app.instance_path, spider_reparse_checkpoint_filename)
+
+def get_spider_archive_path(app):
+    return os.path.join(app.instance_path, spider_archive_filename)
+
+def get_spider_metrics_folder(app):
+    return os.path.join(app.instance_path, spider_metrics_dirname)
+
+def get_spider_options(app):
+    """The keyword arguments used to create spiders."""
+    return {
+        'cache_enabled': True,
+        'cache_dir': get_spider_cache_folder(app),
+        'lock_dir': get_spider_lock_folder(app),
+        'cache_expire': spider_cache_expire,
+        'encoding': 'utf-8',
+        'stream_enabled': spider_stream_enabled,
+        'cache_store': app.extensions.get('spider_cache_store'),
+        'transport': app.extensions.get('spider_transport'),
+        'scheduler': app.extensions.get('spider_scheduler'),
+        'retry_policy': app.extensions.get('spider_retry_policy'),
+        'breakers': app.extensions.get('spider_breakers'),
+        'negative_cache': app.extensions.get('spider_negative_cache'),
+        'parse_cache': app.extensions.get('spider_parse_cache'),
+        'metrics': app.extensions.get('spider_metrics'),
+        'parse_sandbox': app.extensions.get('spider_parse_sandbox')
+    }
+
+def get_spider_stats(app):
+    """The state of objects shared by spiders in this process, i.e., the
+    connection pool, the rate limits, the circuit breakers, the failures
+    kept by the negative cache, the parsed items and the workers of parse
+    sandbox."""
+    stats = {}
+    for name in ('transport', 'scheduler', 'breakers', 'negative_cache',
+        'parse_cache', 'parse_sandbox'):
+        obj = app.extensions.get('spider_' + name)
+        if obj is not None and hasattr(obj, 'stats'):
+            stats[name] = obj.stats()
+    return stats
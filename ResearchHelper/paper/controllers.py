@@ -3,16 +3,32 @@ from flask import Flask, Blueprint, request, render_template, \
 from . import db
 from . import TimestampModelMixin
 from . import login_required
-from . import response_json
-from .config import mod_name, spider_cache_expire, get_spider_cache_folder
-from .forms import SearchForm, MetadataForm
-from .models import Source, Metadata
-from .spiders import SpiderFactory
+from . import status_code, response_json
+from .config import mod_name
+from .forms import SearchForm, BatchSearchForm, MetadataForm
+from .models import Metadata, PullJob
+from .config import spider_metrics_expire, get_spider_metrics_folder, \
+    get_spider_stats
+from .metrics import MetricsRegistry, cache_hit_ratios, read_snapshots
 
 
 bp = Blueprint(mod_name, __name__, url_prefix="/paper")
 
 
+def request_wants_json():
+    mimetypes = request.accept_mimetypes
+    best = mimetypes.best_match(['application/json', 'text/html'])
+    return (best == 'application/json'
+        and mimetypes[best] > mimetypes['text/html'])
+
+
+def job_get_or_404(job_id, user_id):
+    job = PullJob.query.filter_by(id=job_id, user_id=user_id).first()
+    if job is None:
+        abort(404)
+    return job
+
+
 def metadata_get_or_404(source_id, user_id):
     metadata = Metadata.query.filter_by(
         user_id=user_id,
@@ -33,25 +49,123 @@ def index():
         return redirect(url_for('auth.login'))
 
     if form.validate_on_submit():
-        spider = SpiderFactory.create_spider(form.link.data, **{
-            'cache_enabled': True,
-            'cache_dir': get_spider_cache_folder(current_app),
-            'cache_expire': spider_cache_expire,
-            'encoding': 'utf-8'
-        })
-        try:
-            spider.pull()
-        except Exception as e:
-            flash(str(e), 'error')
-            return redirect(url_for('.index'))
-
-        item = spider.get_item()
-        source = Source.update_or_create(**item)
-        Metadata.get_or_create(source, g.user)
-        flash("You just pull a paper, maybe it's time to update the metadata.")
-        return redirect(url_for('.metadata_update', source_id=source.id))
-
-    return render_template('paper/index.html', form=form)
+        # the paper is pulled by the workers of `flask paper worker`, so
+        # the request doesn't wait for the site
+        job = PullJob.submit(form.link.data, g.user)
+        if request_wants_json():
+            return response_json(
+                message='{} is submitted.'.format(job),
+                status=status_code['ok'],
+                job=job.serialize
+            )
+        flash('Your paper is being pulled, please wait a moment.')
+        return redirect(url_for('.index', job=job.id))
+
+    job = None
+    job_id = request.args.get('job', type=int)
+    if job_id is not None and g.user is not None:
+        job = job_get_or_404(job_id, g.user.id)
+    return render_template('paper/index.html', form=form, job=job)
+
+
+@bp.route('/batch', methods=('GET', 'POST'))
+@login_required
+def batch():
+    form = BatchSearchForm()
+
+    if form.validate_on_submit():
+        # like `index()`, the links are pulled by the workers of
+        # `flask paper worker`, a job per link
+        jobs = []
+        for link in form.links.data:
+            if link not in [job.url for job in jobs]:
+                jobs.append(PullJob.submit(link, g.user))
+        if request_wants_json():
+            return response_json(
+                message='{} jobs are submitted.'.format(len(jobs)),
+                status=status_code['ok'],
+                jobs=[job.serialize for job in jobs]
+            )
+        flash('Your {} papers are being pulled, please wait a moment.'.format(
+            len(jobs)))
+        return redirect(url_for('.batch',
+            jobs=','.join(str(job.id) for job in jobs)))
+
+    jobs = []
+    for job_id in request.args.get('jobs', '').split(','):
+        if job_id.isdigit():
+            jobs.append(job_get_or_404(int(job_id), g.user.id))
+    return render_template('paper/batch.html', form=form, jobs=jobs)
+
+
+@bp.route('/api/jobs/<int:job_id>', methods=('GET',))
+@login_required
+def api_job(job_id):
+    job = job_get_or_404(job_id, g.user.id)
+    data = job.serialize
+    if job.status == 'done':
+        data['redirect'] = url_for('.metadata_update', source_id=job.source_id)
+    return response_json(
+        message='ok',
+        status=status_code['ok'],
+        job=data
+    )
+
+
+@bp.route('/api/spiders', methods=('GET',))
+@login_required
+def api_spiders():
+    return response_json(
+        message='ok',
+        status=status_code['ok'],
+        **get_spider_stats(current_app)
+    )
+
+
+@bp.route('/metrics', methods=('GET',))
+@login_required
+def metrics():
+    # the metrics of this process and the ones published by the workers
+    # of `flask paper worker`, which pull the papers
+    registry = current_app.extensions.get('spider_metrics')
+    merged = MetricsRegistry(registry.buckets if registry is not None else None)
+    if registry is not None:
+        merged.merge(registry.snapshot())
+    workers = {}
+    for snapshot in read_snapshots(get_spider_metrics_folder(current_app),
+        spider_metrics_expire):
+        merged.merge(snapshot['metrics'])
+        workers[snapshot['name']] = dict(snapshot['stats'],
+            pid=snapshot['pid'], time=snapshot['time'])
+    data = merged.stats()
+    data['cache_hit_ratio'] = cache_hit_ratios(data['counters'])
+    data.update(get_spider_stats(current_app))
+    data['workers'] = workers
+    return response_json(
+        message='ok',
+        status=status_code['ok'],
+        **data
+    )
+
+
+@bp.route('/metadata/<int:source_id>/download', methods=('POST',))
+@login_required
+def metadata_download(source_id):
+    metadata = metadata_get_or_404(user_id=g.user.id, source_id=source_id)
+    source = metadata.source
+    if not source.download_link:
+        abort(404)
+    # the PDF is downloaded by the workers of `flask paper worker`
+    job = PullJob.submit(source.download_link, g.user, kind='download',
+        source=source)
+    if request_wants_json():
+        return response_json(
+            message='{} is submitted.'.format(job),
+            status=status_code['ok'],
+            job=job.serialize
+        )
+    flash('Your paper is being downloaded, please wait a moment.')
+    return redirect(url_for('.index', job=job.id))
 
 
 @bp.route('/metadata/<int:source_id>')
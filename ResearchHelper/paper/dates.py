@@ -0,0 +1,110 @@
+import re
+import datetime
+from collections import namedtuple
+
+from dateutil import parser as date_parser
+
+
+# The result of `DateNormalizer.parse()`, `value` is the datetime or None
+# if the text is unparseable, `format` is the name of the matched format,
+# or `dateutil` if it's parsed by the fallback, and `error` tells why it's
+# unparseable.
+DateResult = namedtuple('DateResult', ['value', 'text', 'format', 'error'])
+
+months = {}
+for i, name in enumerate(('january', 'february', 'march', 'april', 'may',
+    'june', 'july', 'august', 'september', 'october', 'november',
+    'december'), 1):
+    months[name] = months[name[:3]] = i
+months['sept'] = 9
+
+time_pattern = (r'(?:[T\s]+(?P<hour>\d{1,2}):(?P<minute>\d{2})'
+    r'(?::(?P<second>\d{2})(?:\.\d+)?)?)?'
+    r'\s*(?:Z|[A-Z]{2,4}|[+-]\d{2}:?\d{2})?')
+weekday_pattern = r'(?:[A-Za-z]{3,9},?\s+)?'
+
+# name -> pattern, the names of groups are the fields of datetime, the
+# month is either a number or a name
+date_formats = [
+    ('iso', r'(?P<year>\d{4})-(?P<month>\d{1,2})-(?P<day>\d{1,2})' + time_pattern),
+    ('day month year', weekday_pattern
+        + r'(?P<day>\d{1,2})\s+(?P<month>[A-Za-z]{3,9})\.?,?\s+(?P<year>\d{4})'
+        + time_pattern),
+    ('month day year', weekday_pattern
+        + r'(?P<month>[A-Za-z]{3,9})\.?\s+(?P<day>\d{1,2}),?\s+(?P<year>\d{4})'
+        + time_pattern),
+    ('month year', r'(?P<month>[A-Za-z]{3,9})\.?,?\s+(?P<year>\d{4})'),
+    ('slash', r'(?P<year>\d{4})/(?P<month>\d{1,2})/(?P<day>\d{1,2})' + time_pattern),
+    ('year', r'(?P<year>\d{4})'),
+]
+
+
+class DateNormalizer(object):
+    """Parse the dates of papers by the precompiled patterns, which is
+    much faster than `dateutil`. The format matched the last text of a key,
+    e.g., the name of spider, is tried first, since the dates of a site are
+    usually in the same format. `dateutil` is the fallback of the texts
+    match none of patterns.
+
+    The time zones are ignored, and the missing day is the first day of the
+    month instead of today as `dateutil`.
+    """
+
+    def __init__(self, formats=None, fallback=True):
+        """
+        :param formats: a list of `(name, pattern)`, default to `date_formats`.
+        :param fallback: parse the text by `dateutil` if no pattern matches.
+        """
+        self.formats = [(name, re.compile(pattern, re.IGNORECASE))
+            for name, pattern in (formats or date_formats)]
+        self.fallback = fallback
+        # key -> the index of format matched the last text of the key
+        self.learned = {}
+
+    def match(self, index, text):
+        name, pattern = self.formats[index]
+        matched = pattern.fullmatch(text)
+        if matched is None:
+            return None
+        fields = matched.groupdict()
+        month = fields.get('month') or 1
+        if isinstance(month, str) and not month.isdigit():
+            month = months.get(month.lower())
+            if month is None:
+                return None
+        try:
+            return datetime.datetime(int(fields['year']), int(month),
+                int(fields.get('day') or 1), int(fields.get('hour') or 0),
+                int(fields.get('minute') or 0), int(fields.get('second') or 0))
+        except ValueError:
+            # e.g., February 30
+            return None
+
+    def parse(self, value, key=None):
+        """Parse the value into a datetime. Return a `DateResult`."""
+        if isinstance(value, datetime.datetime):
+            return DateResult(value, str(value), 'datetime', None)
+        text = str(value).strip() if value is not None else ''
+        if not text:
+            return DateResult(None, text, None, 'empty')
+        learned = self.learned.get(key)
+        if learned is not None:
+            dt = self.match(learned, text)
+            if dt is not None:
+                return DateResult(dt, text, self.formats[learned][0], None)
+        for index in range(len(self.formats)):
+            if index == learned:
+                continue
+            dt = self.match(index, text)
+            if dt is not None:
+                self.learned[key] = index
+                return DateResult(dt, text, self.formats[index][0], None)
+        if not self.fallback:
+            return DateResult(None, text, None, 'unknown format')
+        try:
+            return DateResult(date_parser.parse(text), text, 'dateutil', None)
+        except (ValueError, OverflowError) as e:
+            return DateResult(None, text, None, str(e) or 'unknown format')
+
+
+date_normalizer = DateNormalizer()
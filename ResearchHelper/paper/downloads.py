@@ -0,0 +1,280 @@
+import os
+import re
+import json
+import hashlib
+from urllib.parse import urlsplit
+from urllib.request import urlopen, Request
+from urllib.error import HTTPError
+
+from flask import current_app, url_for
+import sqlalchemy as sa
+
+from . import db
+from .config import spider_download_chunk_size, spider_download_max_size, \
+    spider_download_timeout, spider_download_partial_dirname
+from .spiders import SpiderFactory
+from .locks import file_lock
+from .transports import get_live_transport
+from ResearchHelper.utils import file_uniquename, uuid_generator
+from ResearchHelper.files.config import files_collection, get_upload_folder
+from ResearchHelper.files.models import File, FileOwnership
+
+
+content_range_re = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+|\*)')
+
+
+class DownloadError(Exception):
+    pass
+
+
+class Download(object):
+    """Stream a file into `path` chunk by chunk, and fingerprint it while
+    writing. The content is written into `<path>.part` first, and the
+    validators of the response are kept in `<path>.part.json`, so that an
+    interrupted download is resumed by a `Range` request.
+    """
+
+    def __init__(self, url, path, transport=None, timeout=spider_download_timeout,
+        chunk_size=spider_download_chunk_size, max_size=spider_download_max_size,
+        magic=b'%PDF'):
+        """
+        :param transport: an object has `urlopen()` like `urllib.request.urlopen()`,
+            e.g., `transports.HTTPConnectionPool`, None means urllib is used.
+        :param magic: the leading bytes of the file, e.g., the login page
+            of publishers is not taken as a PDF. None means no check.
+        """
+        self.url = url
+        self.path = path
+        self.part_path = path + '.part'
+        self.state_path = path + '.part.json'
+        self.transport = transport
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        self.magic = magic
+        self.md5 = hashlib.md5()
+        self.size = 0
+        # the number of bytes resumed from the partial file
+        self.resumed = 0
+
+    def open(self, headers):
+        if self.transport is None:
+            return urlopen(Request(self.url, headers=headers), timeout=self.timeout)
+        return self.transport.urlopen(self.url, headers=headers, timeout=self.timeout)
+
+    def load_state(self):
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if state.get('url') != self.url or not os.path.isfile(self.part_path):
+            return None
+        return state
+
+    def save_state(self, headers):
+        state = {
+            'url': self.url,
+            'etag': headers.get('ETag', ''),
+            'last_modified': headers.get('Last-Modified', ''),
+        }
+        with open(self.state_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+
+    def resume_headers(self):
+        """The headers of `Range` request of the partial file, the partial
+        file is hashed again, chunk by chunk."""
+        state = self.load_state()
+        if state is None:
+            return {}
+        with open(self.part_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                self.md5.update(chunk)
+                self.size += len(chunk)
+        if not self.size:
+            return {}
+        headers = {'Range': 'bytes={}-'.format(self.size)}
+        # the range is ignored if the file is changed since
+        validator = state['etag'] or state['last_modified']
+        if validator:
+            headers['If-Range'] = validator
+        return headers
+
+    def restart(self):
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def discard(self):
+        # the partial file is not resumed, e.g., it's not a PDF
+        for path in (self.part_path, self.state_path):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def request(self):
+        """Return the response and whether it continues the partial file."""
+        headers = self.resume_headers()
+        try:
+            f = self.open(headers)
+        except HTTPError as e:
+            if e.code != 416 or not headers:
+                raise
+            # the range is beyond the end, the partial file may be
+            # complete, i.e., `Content-Range: bytes */<size>`
+            total = e.headers.get('Content-Range', '').rpartition('/')[2]
+            e.close()
+            if total == str(self.size):
+                return None, True
+            self.restart()
+            return self.open({}), False
+        if headers and f.code == 206:
+            matched = content_range_re.match(f.headers.get('Content-Range', ''))
+            if matched and int(matched.group(1)) == self.size:
+                return f, True
+            f.close()
+            self.restart()
+            return self.open({}), False
+        # the whole file is sent
+        self.restart()
+        return f, False
+
+    def write(self, f, resumed):
+        if not resumed:
+            self.save_state(f.headers)
+        with open(self.part_path, 'ab' if resumed else 'wb') as out:
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                if self.size == 0 and self.magic and not chunk.startswith(self.magic):
+                    raise DownloadError('{} is not a {} file.'.format(
+                        self.url, self.magic.decode('ascii').strip('%')))
+                self.size += len(chunk)
+                if self.size > self.max_size:
+                    raise DownloadError('{} is larger than {} bytes.'.format(
+                        self.url, self.max_size))
+                self.md5.update(chunk)
+                out.write(chunk)
+
+    def run(self):
+        """Download the file. Return a tuple `(fingerprint, size)`, the
+        fingerprint is the md5 of the content like `files`."""
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname, exist_ok=True)
+        f, resumed = self.request()
+        self.resumed = self.size if resumed else 0
+        if f is not None:
+            try:
+                with f:
+                    self.write(f, resumed)
+            except DownloadError:
+                self.discard()
+                raise
+        os.replace(self.part_path, self.path)
+        if os.path.isfile(self.state_path):
+            os.remove(self.state_path)
+        return self.md5.hexdigest(), self.size
+
+
+def get_host(url):
+    spider_class = SpiderFactory.registry.match_url(url)
+    if spider_class is not None:
+        return spider_class.host
+    return urlsplit(url).hostname
+
+
+def get_file_url(name):
+    try:
+        return files_collection.url(name)
+    except RuntimeError:
+        # the external url can't be built by a worker without the
+        # `SERVER_NAME` config, so it's relative to the site
+        with current_app.test_request_context():
+            return url_for('_uploads.uploaded_file',
+                setname=files_collection.name, filename=name)
+
+
+def save_download(path, fingerprint, user):
+    """Move the downloaded file into the upload folder of `files` unless
+    the same file is there. Return the `File`."""
+    file_model = File.query.filter_by(fingerprint=fingerprint).first()
+    if file_model is not None:
+        os.remove(path)
+    else:
+        file_model = create_file(path, fingerprint)
+    add_ownership(file_model, user)
+    return file_model
+
+
+def create_file(path, fingerprint):
+    """Move the file into the upload folder of `files`, and create its
+    `File`. Return the `File` of the same fingerprint if it exists."""
+    dirname = get_upload_folder(current_app)
+    while True:
+        filename = file_uniquename(ext='pdf')
+        folder = filename[:2]
+        if not os.path.isfile(os.path.join(dirname, folder, filename)):
+            break
+    os.makedirs(os.path.join(dirname, folder), exist_ok=True)
+    os.replace(path, os.path.join(dirname, folder, filename))
+    uuid = uuid_generator()
+    while File.query.filter_by(uuid=uuid).first() is not None:
+        uuid = uuid_generator()
+    file_model = File(
+        uuid=uuid,
+        url=get_file_url(os.path.join(folder, filename)),
+        fingerprint=fingerprint,
+        dirname=folder,
+        filename=filename
+    )
+    db.session.add(file_model)
+    try:
+        db.session.flush()
+    except sa.exc.IntegrityError:
+        # another worker saved the same file meanwhile
+        db.session.rollback()
+        os.remove(os.path.join(dirname, folder, filename))
+        file_model = File.query.filter_by(fingerprint=fingerprint).first()
+        if file_model is None:
+            raise
+    return file_model
+
+
+def add_ownership(file_model, user):
+    ownership = FileOwnership.query.filter(sa.and_(
+        FileOwnership.user_id == user.id,
+        FileOwnership.file_id == file_model.id
+    )).first()
+    if ownership is None:
+        db.session.add(FileOwnership(file=file_model, user=user))
+
+
+def download_source(source, user, spider_options):
+    """Download the PDF of the source for the user in the current app
+    context. Return the `File`."""
+    if not source.download_link:
+        raise DownloadError('{} has no download link.'.format(source.url))
+    dirname = os.path.join(get_upload_folder(current_app),
+        spider_download_partial_dirname)
+    download = Download(source.download_link,
+        os.path.join(dirname, '{}.pdf'.format(source.urlhash)),
+        transport=get_live_transport(spider_options.get('transport')))
+    # the jobs downloading the same source share its partial file, they
+    # wait for each other, and the later ones take the saved file
+    with file_lock(download.path + '.lock'):
+        db.session.refresh(source)
+        file_model = None
+        if source.download_hash:
+            file_model = File.query.filter_by(
+                fingerprint=source.download_hash).first()
+        if file_model is not None:
+            add_ownership(file_model, user)
+            fingerprint = file_model.fingerprint
+        else:
+            scheduler = spider_options.get('scheduler')
+            if scheduler is not None:
+                # the publishers limit the downloads as the pages
+                scheduler.acquire(get_host(source.download_link))
+            fingerprint, size = download.run()
+            file_model = save_download(download.path, fingerprint, user)
+        source.download_hash = fingerprint
+        source.download_count = source.__class__.download_count + 1
+        db.session.commit()
+    return file_model
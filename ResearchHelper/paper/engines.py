@@ -0,0 +1,206 @@
+import time
+import asyncio
+from io import BytesIO
+from urllib.parse import urlencode
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from .spiders import SpiderError, SpiderRequestError, SpiderRequestHTTPError, \
+    SpiderRequestTimeoutError, SpiderRequestUnknowError, SpiderCacheError, \
+    SpiderRequestUnavailableError
+from .transports import HTTPConnectionPool
+
+
+class AsyncFetchEngine(object):
+    """Fetch the urls of spiders on an asyncio event loop.
+
+    Only the network part of `BaseSpider.pull()` is replaced, the cache
+    and `BaseSpider.process()` are the same, so the `parse()` of spiders
+    don't need any change. Thousands of spiders can be pending on the
+    loop, while the opened connections are limited by `limit` and
+    `limit_per_host`. The cache is read and written in the default
+    executor, since the stores are blocking.
+
+    A spider with a record or replay `transport` is requested by the
+    transport in the executor instead of aiohttp, but not the one with
+    `transports.HTTPConnectionPool`, aiohttp pools the connections itself.
+
+    Requires the optional `aiohttp` package.
+    """
+
+    # the max number of opened connections
+    limit = 1000
+    # the max number of opened connections to the same host
+    limit_per_host = 8
+
+    def __init__(self, limit=None, limit_per_host=None, parse_in_executor=True):
+        if aiohttp is None:
+            raise SpiderError('The asyncio engine requires aiohttp installed.')
+        self.limit = limit or self.limit
+        self.limit_per_host = limit_per_host or self.limit_per_host
+        # parse in the default executor, so that a big document doesn't 
+        # block the loop.
+        self.parse_in_executor = parse_in_executor
+
+    async def fetch(self, session, spider, data, timeout, headers=None):
+        if isinstance(data, dict):
+            data = urlencode(data).encode('utf-8')
+        method = 'GET' if data is None else 'POST'
+        scheduler = spider.scheduler
+        retries = spider.throttle_retries if scheduler is not None else 0
+        for i in range(retries + 1):
+            if scheduler is not None:
+                # wait for the turn of the host without blocking the loop,
+                # the shared scheduler is a SQLite file
+                wait = await self.run_blocking(scheduler.reserve, spider.host)
+                await asyncio.sleep(wait)
+            start = time.perf_counter()
+            async with session.request(method, spider.url, data=data,
+                headers=headers, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                # the latency until the response headers like `BaseSpider.open()`
+                if spider.metrics is not None:
+                    spider.metrics.observe('fetch_seconds', spider.host,
+                        time.perf_counter() - start)
+                throttled = (response.status >= 400
+                    and spider.throttle(response.status, response.headers))
+                if throttled and i < retries:
+                    continue
+                response.raise_for_status()
+                return response.status, response.headers, await self.read(spider, response)
+
+    async def read(self, spider, response):
+        """Read the response until the stop condition of the spider."""
+        stop = spider.get_stop_condition()
+        if stop is None:
+            content = await response.read()
+            spider.count('bytes', amount=len(content))
+            return content
+        chunks = []
+        async for chunk in response.content.iter_chunked(spider.stream_chunk_size):
+            spider.count('bytes', amount=len(chunk))
+            chunks.append(stop.feed(chunk))
+            if stop.stopped:
+                spider.truncated = True
+                break
+        return b''.join(chunks)
+
+    def is_transient(self, spider, error):
+        if isinstance(error, aiohttp.ClientResponseError):
+            return error.status in spider.retry_statuses
+        return isinstance(error, (asyncio.TimeoutError,
+            aiohttp.ClientConnectionError, aiohttp.ClientPayloadError))
+
+    async def download(self, session, spider, data, timeout, headers=None):
+        """Like `fetch()`, but the transient errors of GET requests are
+        retried by the retry policy of the spider, and its circuit breaker
+        is checked."""
+        attempt = 0
+        while True:
+            spider.check_breaker()
+            try:
+                result = await self.fetch(session, spider, data, timeout, headers)
+            except Exception as e:
+                transient = self.is_transient(spider, e)
+                if transient or isinstance(e, aiohttp.ClientResponseError):
+                    spider.record_host(transient)
+                policy = spider.retry_policy
+                if (not transient or data is not None or policy is None
+                    or attempt >= policy.retries):
+                    raise
+                await asyncio.sleep(policy.get_backoff(attempt))
+                attempt += 1
+                continue
+            spider.record_host(False)
+            return result
+
+    async def run_blocking(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, func, *args)
+
+    async def request(self, session, spider, data, timeout):
+        try:
+            buf = await self.run_blocking(spider.get_cache)
+            if buf is not None:
+                return buf
+            headers = {}
+            if data is None:
+                headers = await self.run_blocking(spider.get_cache_validators)
+            status, headers, content = await self.download(session, spider,
+                data, timeout, headers)
+            if status == 304:
+                buf = await self.run_blocking(spider.refresh_cache, headers)
+                if buf is not None:
+                    return buf
+                status, headers, content = await self.download(session, spider,
+                    data, timeout)
+            await self.run_blocking(spider.put_cache, content, headers)
+            return BytesIO(content)
+        except SpiderRequestUnavailableError as e:
+            raise
+        except aiohttp.ClientResponseError as e:
+            raise SpiderRequestHTTPError('HTTP error, {}: {}'.format(e.status, e.message), e.status)
+        except asyncio.TimeoutError as e:
+            raise SpiderRequestTimeoutError('Request url timeout.')
+        except aiohttp.ClientError as e:
+            raise SpiderRequestUnknowError('Request url error.')
+        except SpiderCacheError as e:
+            raise SpiderCacheError('There is something wrong when cache the url.')
+        except Exception as e:
+            raise SpiderRequestError('There is something wrong when request the url.')
+
+    def uses_transport(self, spider):
+        return (spider.transport is not None
+            and not isinstance(spider.transport, HTTPConnectionPool))
+
+    async def pull(self, session, spider, data, timeout):
+        if data is None:
+            try:
+                spider.check_failure()
+            except SpiderError as e:
+                # the kept failure isn't kept again, or it never expires
+                return spider, e
+        try:
+            if self.uses_transport(spider):
+                buf = await self.run_blocking(spider.retrieve, data, timeout)
+            else:
+                buf = await self.request(session, spider, data, timeout)
+            if self.parse_in_executor:
+                await self.run_blocking(spider.process, buf)
+            else:
+                spider.process(buf)
+        except SpiderError as e:
+            spider.count('errors', type(e).__name__)
+            if data is None:
+                spider.put_failure(e)
+            return spider, e
+        return spider, None
+
+    async def open_session(self):
+        connector = aiohttp.TCPConnector(limit=self.limit,
+            limit_per_host=self.limit_per_host)
+        return aiohttp.ClientSession(connector=connector)
+
+    def pull_many(self, spiders, data=None, timeout=20):
+        """Pull the spiders on a new event loop.
+        Yield a tuple `(spider, error)` as soon as a spider is finished.
+        """
+        loop = asyncio.new_event_loop()
+        session = loop.run_until_complete(self.open_session())
+        pending = set(loop.create_task(self.pull(session, spider, data, timeout))
+            for spider in spiders)
+        try:
+            while pending:
+                done, pending = loop.run_until_complete(asyncio.wait(pending,
+                    return_when=asyncio.FIRST_COMPLETED))
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                loop.run_until_complete(asyncio.wait(pending))
+            loop.run_until_complete(session.close())
+            loop.close()
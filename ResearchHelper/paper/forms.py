@@ -12,6 +12,7 @@ from wtforms.validators import DataRequired, InputRequired, Email,\
 from . import BaseForm
 from . import CommaListField
 from .spiders import SpiderFactory
+from .config import spider_batch_limit
 
 
 # class FooBarForm(BaseForm):
@@ -25,19 +26,37 @@ class SearchForm(BaseForm):
         URL(message="Link is invalid.")
     ])
 
-    def link_validator(self, field):
+    def validate_link(self, field):
+        # the link is pulled by the workers later, so the unsupported
+        # sites are rejected right now
         url = field.data
         if ((not url.startswith('http://'))
             and (not url.startswith('https://'))
             and (not url.startswith('//'))):
             url = '//' + url
-        netloc = urlparse(url).netloc
-        flag = False
-        for spider in SpiderFactory.spiders:
-            if netloc.endswith(spider.host):
-                flag = True
-        if not flag:
-            raise ValidationError('Site [%s] is not supported yet' % netloc)
+        parsed = urlparse(url)
+        if SpiderFactory.registry.match(parsed.hostname or '') is None:
+            raise ValidationError('Site [%s] is not supported yet' % parsed.netloc)
+
+class BatchSearchForm(BaseForm):
+    links = TextAreaField("Links", validators=[
+        DataRequired(message="links are required.")
+    ], render_kw={'rows': 10})
+
+    def validate_links(self, field):
+        links = [link.strip() for link in field.data.splitlines()]
+        links = [link for link in links if link]
+        if not links:
+            raise ValidationError('links are required.')
+        if len(links) > spider_batch_limit:
+            raise ValidationError(
+                'At most %d links can be pulled at once.' % spider_batch_limit)
+        for link in links:
+            parsed = urlparse(link)
+            if parsed.scheme not in ('http', 'https') or not parsed.netloc:
+                raise ValidationError('Link [%s] is invalid.' % link)
+        field.data = links
+
 
 class MetadataForm(BaseForm):
     title = StringField('Title', validators=[
@@ -0,0 +1,89 @@
+import time
+
+from .config import spider_import_batch_size, spider_batch_workers, \
+    spider_batch_engine, spider_async_limit, spider_async_limit_per_host
+from .models import Source, Metadata, md5_hash
+from .spiders import SpiderFactory
+
+
+def get_batch_engine():
+    """The engine of `SpiderFactory.pull_many()` by `spider_batch_engine`."""
+    if spider_batch_engine == 'asyncio':
+        from .engines import AsyncFetchEngine
+        return AsyncFetchEngine(limit=spider_async_limit,
+            limit_per_host=spider_async_limit_per_host)
+    return spider_batch_engine
+
+
+def iter_urls(lines):
+    """Yield the urls of lines, the blank lines and the comments starting
+    with `#` are skipped."""
+    for line in lines:
+        url = line.strip()
+        if url and not url.startswith('#'):
+            yield url
+
+
+def iter_batches(urls, batch_size, result):
+    """Yield the lists of unique urls, the duplicated urls are counted in
+    `result['duplicated']`."""
+    seen = set()
+    batch = []
+    for url in urls:
+        urlhash = md5_hash(url)
+        if urlhash in seen:
+            result['duplicated'] += 1
+            continue
+        seen.add(urlhash)
+        batch.append(url)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_urls(lines, user, spider_options, batch_size=spider_import_batch_size,
+    max_workers=spider_batch_workers, engine='thread', progress=None):
+    """Pull the urls of lines in batches, and save their sources and the
+    metadata for the user in a transaction per batch, in the current app
+    context. The urls whose source exists are not pulled again.
+
+    :param lines: an iterable of lines, e.g., a file, it's read lazily.
+    :param user: the user who imports the urls.
+    :param spider_options: the keyword arguments used to create spiders.
+    :param progress: a function called with the result after each batch.
+    Return the result, i.e., the numbers of `urls`, `duplicated`, `existing`,
+    `pulled`, `incomplete` urls and `created` metadata, the list of
+    `failures` as `(url, error)`, and the `seconds` taken.
+    """
+    result = {'urls': 0, 'duplicated': 0, 'existing': 0, 'pulled': 0,
+        'incomplete': 0, 'created': 0, 'failures': [], 'seconds': 0.0}
+    start = time.time()
+    for batch in iter_batches(iter_urls(lines), batch_size, result):
+        urlhashes = [md5_hash(url) for url in batch]
+        existing = set(row[0] for row in Source.query.with_entities(
+            Source.urlhash).filter(Source.urlhash.in_(urlhashes)))
+        urls = [url for url, urlhash in zip(batch, urlhashes)
+            if urlhash not in existing]
+        items = []
+        pulled = SpiderFactory.pull_many(urls, max_workers=max_workers,
+            engine=engine, **spider_options) if urls else ()
+        for url, item, error in pulled:
+            if error is not None:
+                result['failures'].append((url, str(error)))
+            else:
+                items.append(item)
+        if items:
+            counts = Source.bulk_update_or_create(items, pulled=True)
+            result['incomplete'] += counts['incomplete']
+            result['pulled'] += len(items) - counts['incomplete']
+        sources = Source.query.filter(Source.urlhash.in_(urlhashes)).all()
+        result['created'] += Metadata.bulk_get_or_create(sources, user)
+        result['urls'] += len(batch)
+        result['existing'] += len(existing)
+        result['seconds'] = time.time() - start
+        if progress is not None:
+            progress(result)
+    result['seconds'] = time.time() - start
+    return result
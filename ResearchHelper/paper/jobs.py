@@ -0,0 +1,75 @@
+import os
+import time
+import socket
+
+from flask import current_app
+
+from . import db
+from .config import spider_job_poll_interval, spider_metrics_publish_interval, \
+    get_spider_options, get_spider_stats, get_spider_metrics_folder
+from .metrics import MetricsPublisher
+from .models import Source, Metadata, PullJob
+from .spiders import SpiderFactory
+from .downloads import download_source
+
+
+def get_worker_name():
+    return '{}@{}'.format(os.getpid(), socket.gethostname())
+
+
+def run_job(job, spider_options):
+    """Pull the url of the job, and save the result for its user, or
+    download the PDF of its source for the `download` jobs."""
+    try:
+        if job.kind == 'download':
+            source = job.source
+            download_source(source, job.user, spider_options)
+        else:
+            spider = SpiderFactory.pull_spider(job.url, **spider_options)
+            source = Source.update_or_create(**spider.get_item())
+            Metadata.get_or_create(source, job.user)
+    except Exception as e:
+        db.session.rollback()
+        job.fail(str(e))
+    else:
+        job.finish(source)
+    return job
+
+
+def work(burst=False, interval=spider_job_poll_interval, limit=None, worker=None):
+    """Consume the pull and download jobs in the current app context.
+
+    :param burst: quit when there isn't any job, otherwise wait for the
+        new jobs forever.
+    :param interval: the seconds to wait before polling jobs again.
+    :param limit: quit after the number of jobs are done.
+    :param worker: the name of worker, default to `<pid>@<hostname>`.
+    Return the number of jobs done.
+    """
+    worker = worker or get_worker_name()
+    spider_options = get_spider_options(current_app)
+    # the metrics and the circuit breakers of the worker are shown by
+    # `/paper/metrics` of the web processes
+    publisher = None
+    if spider_options['metrics'] is not None:
+        app = current_app._get_current_object()
+        publisher = MetricsPublisher(get_spider_metrics_folder(app), worker,
+            spider_options['metrics'], spider_metrics_publish_interval,
+            lambda: get_spider_stats(app))
+    count = 0
+    try:
+        while limit is None or count < limit:
+            if publisher is not None:
+                publisher.publish()
+            job = PullJob.claim(worker)
+            if job is None:
+                if burst:
+                    break
+                time.sleep(interval)
+                continue
+            run_job(job, spider_options)
+            count += 1
+    finally:
+        if publisher is not None:
+            publisher.publish(force=True)
+    return count
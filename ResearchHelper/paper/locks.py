@@ -0,0 +1,105 @@
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # there isn't a lock file on Windows, only the threads are coalesced
+    fcntl = None
+
+
+@contextmanager
+def file_lock(filename):
+    """Hold an exclusive lock of the file across processes.
+
+    The lock file is removed when it's released, so a waiter may get the
+    lock of a removed file, it checks the file is still there after the
+    lock is got, otherwise it tries again.
+    """
+    if fcntl is None:
+        yield
+        return
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname, exist_ok=True)
+    while True:
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                locked = os.stat(filename).st_ino == os.fstat(fd).st_ino
+            except FileNotFoundError:
+                locked = False
+        except BaseException:
+            os.close(fd)
+            raise
+        if locked:
+            break
+        os.close(fd)
+    try:
+        yield
+    finally:
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        os.close(fd)
+
+
+class Flight(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesce the concurrent calls with the same key, only the first
+    caller runs the function and the others wait for its result.
+
+    Threads are coalesced in the process, and processes are serialized
+    by the lock file if it's given, so the later ones are able to reuse
+    what the first one leaves, e.g., the cache.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def do(self, key, func, lock_file=None):
+        """Return a tuple `(result, shared)`, `shared` means the result is
+        returned by the call of another thread. The exception raised by
+        the function is raised for all of callers.
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        try:
+            if lock_file is None:
+                flight.result = func()
+            else:
+                with file_lock(lock_file):
+                    flight.result = func()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.event.set()
+        return flight.result, False
+
+    def in_flight(self, key):
+        with self.lock:
+            return key in self.flights
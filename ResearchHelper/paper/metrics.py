@@ -0,0 +1,250 @@
+import os
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+from .caches import atomic_write
+
+
+# the upper bounds of histogram buckets in seconds
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram(object):
+    """Count the observed values by buckets, like the Prometheus histogram,
+    the quantiles are estimated by the upper bounds of buckets."""
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = tuple(sorted(buckets))
+        # the last one counts the values larger than all of bounds
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def snapshot(self):
+        """The raw state of the histogram, able to be merged by others."""
+        return {
+            'buckets': list(self.buckets),
+            'counts': list(self.counts),
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+        }
+
+    def merge(self, snapshot):
+        """Add the values of a `snapshot()` into the histogram, a bucket
+        of other bounds is counted by the least bound not less than it."""
+        bounds = list(snapshot['buckets']) + [float('inf')]
+        for bound, count in zip(bounds, snapshot['counts']):
+            self.counts[bisect.bisect_left(self.buckets, bound)] += count
+        self.count += snapshot['count']
+        self.sum += snapshot['sum']
+        self.max = max(self.max, snapshot['max'])
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return self.max
+
+    def stats(self):
+        cumulative = {}
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            cumulative[str(bound)] = total
+        cumulative['+Inf'] = self.count
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'buckets': cumulative,
+        }
+
+
+class MetricsRegistry(object):
+    """The thread-safe counters and histograms of spiders in the process,
+    shared by all of spiders in the app as their `metrics`.
+
+    A metric has a value per key, e.g., the fetch latency per host, or
+    the parse time per spider.
+    """
+
+    def __init__(self, buckets=None):
+        """
+        :param buckets: the bucket bounds of histograms by their names,
+            the others use `default_buckets`.
+        """
+        self.buckets = buckets or {}
+        self.lock = threading.Lock()
+        # name -> key -> value
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, key, amount=1):
+        with self.lock:
+            counter = self.counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0) + amount
+
+    def observe(self, name, key, value):
+        with self.lock:
+            histograms = self.histograms.setdefault(name, {})
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = Histogram(
+                    self.buckets.get(name, default_buckets))
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, key):
+        """Observe the seconds taken by the block, even if it fails."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, key, time.perf_counter() - start)
+
+    def clear(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def snapshot(self):
+        """The raw state of the metrics, it's JSON serializable and able
+        to be merged into the registry of another process."""
+        with self.lock:
+            return {
+                'counters': {name: dict(counter)
+                    for name, counter in self.counters.items()},
+                'histograms': {name: {key: histogram.snapshot()
+                    for key, histogram in histograms.items()}
+                    for name, histograms in self.histograms.items()},
+            }
+
+    def merge(self, snapshot):
+        """Add the metrics of a `snapshot()` into the registry."""
+        for name, counter in snapshot.get('counters', {}).items():
+            for key, amount in counter.items():
+                self.inc(name, key, amount)
+        with self.lock:
+            for name, items in snapshot.get('histograms', {}).items():
+                histograms = self.histograms.setdefault(name, {})
+                for key, value in items.items():
+                    histogram = histograms.get(key)
+                    if histogram is None:
+                        histogram = histograms[key] = Histogram(
+                            self.buckets.get(name, default_buckets))
+                    histogram.merge(value)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'counters': {name: dict(counter)
+                    for name, counter in self.counters.items()},
+                'histograms': {name: {key: histogram.stats()
+                    for key, histogram in histograms.items()}
+                    for name, histograms in self.histograms.items()},
+            }
+
+
+class MetricsPublisher(object):
+    """Publish the metrics of a worker process as a JSON file in the
+    folder shared by the processes of the app, so that `/paper/metrics`
+    shows the metrics of all of workers, see `read_snapshots()`.
+
+    A file is rewritten at most once per `interval` seconds, unless it's
+    forced, e.g., when the worker quits.
+    """
+
+    def __init__(self, dirname, name, registry, interval=10, stats=None):
+        """
+        :param dirname: the folder of the snapshot files.
+        :param name: the name of the worker, it's the filename as well.
+        :param registry: the `MetricsRegistry` of the worker.
+        :param stats: a function returns the stats of other objects of
+            the worker, e.g., the circuit breakers.
+        """
+        self.path = os.path.join(dirname, '{}.json'.format(
+            name.replace(os.sep, '_')))
+        self.name = name
+        self.registry = registry
+        self.interval = interval
+        self.stats = stats
+        self.published = None
+
+    def publish(self, force=False):
+        """Write the snapshot if it's time, return True if written."""
+        now = time.time()
+        if (not force and self.published is not None
+            and now - self.published < self.interval):
+            return False
+        snapshot = {
+            'name': self.name,
+            'pid': os.getpid(),
+            'time': now,
+            'metrics': self.registry.snapshot(),
+            'stats': self.stats() if self.stats is not None else {},
+        }
+        atomic_write(self.path, json.dumps(snapshot).encode('utf-8'))
+        self.published = now
+        return True
+
+
+def read_snapshots(dirname, expire=None):
+    """Return the snapshots published by `MetricsPublisher` in the folder,
+    the files not updated in `expire` seconds are removed, e.g., the ones
+    of the workers quit long ago."""
+    snapshots = []
+    if not os.path.isdir(dirname):
+        return snapshots
+    now = time.time()
+    for filename in sorted(os.listdir(dirname)):
+        if not filename.endswith('.json'):
+            continue
+        path = os.path.join(dirname, filename)
+        try:
+            if expire and now - os.path.getmtime(path) > expire:
+                os.remove(path)
+                continue
+            with open(path, 'rb') as f:
+                snapshots.append(json.loads(f.read().decode('utf-8')))
+        except (OSError, ValueError):
+            # removed or being replaced by others
+            continue
+    return snapshots
+
+
+def cache_hit_ratios(counters):
+    """The cache hit ratio per host of the counters of spiders, the stale
+    cache revalidated by the site(HTTP 304) is taken as a hit. A pull is
+    counted once by `cache_hit`, `cache_miss` or `cache_stale`, and the
+    revalidated one is counted by `cache_stale` as well."""
+    ratios = {}
+    hosts = set()
+    for name in ('cache_hit', 'cache_revalidated', 'cache_miss', 'cache_stale'):
+        hosts.update(counters.get(name, {}))
+    for host in hosts:
+        hits = sum(counters.get(name, {}).get(host, 0)
+            for name in ('cache_hit', 'cache_revalidated'))
+        total = sum(counters.get(name, {}).get(host, 0)
+            for name in ('cache_hit', 'cache_miss', 'cache_stale'))
+        ratios[host] = hits / total if total else 0.0
+    return ratios
@@ -1,7 +1,10 @@
 import hashlib
+import datetime
+
+from sqlalchemy.exc import IntegrityError
 
 from . import db, TimestampModelMixin, User
-from .config import mod_name
+from .config import mod_name, spider_job_lease, spider_job_max_attempts
 
 
 def md5_hash(data):
@@ -40,6 +43,15 @@ class Source(db.Model, TimestampModelMixin):
 
     @classmethod
     def update_or_create(cls, url, **kwargs):
+        try:
+            return cls._update_or_create(url, **kwargs)
+        except IntegrityError:
+            # the source is created by another worker meanwhile
+            db.session.rollback()
+            return cls._update_or_create(url, **kwargs)
+
+    @classmethod
+    def _update_or_create(cls, url, **kwargs):
         urlhash = md5_hash(url)
         source = cls.query.filter_by(urlhash=urlhash).first()
         created = False
@@ -50,17 +62,58 @@ class Source(db.Model, TimestampModelMixin):
             if value:
                 setattr(source, key, value)
         source.urlhash = urlhash
-        source.pull_count = source.pull_count + 1
+        source.pull_count = cls.pull_count + 1 if not created else 1
         if created:
             db.session.add(source)
         db.session.commit()
         return source
 
+    @classmethod
+    def bulk_update_or_create(cls, items, pulled=False):
+        """Update or create the sources of items in a transaction.
+        Their pull counts are increased only if the items are `pulled`,
+        e.g., not for the items parsed from the cache again.
+        Return a dict of the numbers of `created`, `updated` sources and
+        `incomplete` items, which can't create a source without title or
+        abstract.
+        """
+        try:
+            return cls._bulk_update_or_create(items, pulled)
+        except IntegrityError:
+            db.session.rollback()
+            return cls._bulk_update_or_create(items, pulled)
+
+    @classmethod
+    def _bulk_update_or_create(cls, items, pulled):
+        items = {md5_hash(item['url']): item for item in items}
+        sources = {source.urlhash: source for source in
+            cls.query.filter(cls.urlhash.in_(list(items))).all()}
+        result = {'created': 0, 'updated': 0, 'incomplete': 0}
+        for urlhash, item in items.items():
+            source = sources.get(urlhash)
+            if source is None:
+                if not (item.get('title') and item.get('abstract')):
+                    result['incomplete'] += 1
+                    continue
+                source = cls(url=item['url'], urlhash=urlhash,
+                    pull_count=1 if pulled else 0)
+                db.session.add(source)
+                result['created'] += 1
+            else:
+                if pulled:
+                    source.pull_count = cls.pull_count + 1
+                result['updated'] += 1
+            for key, value in item.items():
+                if value and key != 'url':
+                    setattr(source, key, value)
+        db.session.commit()
+        return result
+
     def __repr__(self):
         return "<Source title=%r>" % self.title
 
     def is_downloaded(self):
-        return self.download_pull > 0
+        return self.download_count > 0
 
 
 class Metadata(db.Model, TimestampModelMixin):
@@ -107,4 +160,138 @@ class Metadata(db.Model, TimestampModelMixin):
             )
             db.session.add(metadata)
             db.session.commit()
-        return metadata
\ No newline at end of file
+        return metadata
+
+    @classmethod
+    def bulk_get_or_create(cls, sources, user):
+        """Create the missing metadata of sources for the user in a
+        transaction. Return the number of created metadata."""
+        sources = {source.id: source for source in sources}
+        existing = set(row[0] for row in db.session.query(cls.source_id).filter(
+            cls.user_id == user.id, cls.source_id.in_(list(sources))))
+        created = 0
+        for source_id, source in sources.items():
+            if source_id in existing:
+                continue
+            db.session.add(cls(
+                user_id=user.id,
+                source_id=source_id,
+                title=source.title,
+                abstract=source.abstract,
+                published=source.published,
+                toc=source.toc,
+                authors=source.authors,
+                categories=source.categories,
+                keywords=source.keywords,
+                highlights=source.highlights
+            ))
+            created += 1
+        db.session.commit()
+        return created
+
+
+class PullJob(db.Model, TimestampModelMixin):
+    """A queued pull of the url, it's consumed by `flask paper worker`.
+    The status goes from `pending` to `running`, then `done` or `failed`.
+    The kind is `pull` for the page of paper, or `download` for the PDF
+    of its source.
+    """
+    __tableprefix__ = mod_name
+
+    id = db.Column(db.Integer, primary_key=True)
+    url = db.Column(db.String, nullable=False)
+    kind = db.Column(db.String, nullable=False, default='pull', index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey(User.id), nullable=False)
+    status = db.Column(db.String, nullable=False, default='pending', index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    worker = db.Column(db.String)
+    error = db.Column(db.Text)
+    started = db.Column(db.DateTime)
+    finished = db.Column(db.DateTime)
+    source_id = db.Column(db.Integer, db.ForeignKey(Source.id))
+
+    source = db.relationship(Source, lazy=True)
+    user = db.relationship(User, lazy=True)
+
+    @property
+    def serialize(self):
+        return {
+            "id": self.id,
+            "url": self.url,
+            "kind": self.kind,
+            "status": self.status,
+            "position": self.position,
+            "attempts": self.attempts,
+            "error": self.error,
+            "source_id": self.source_id
+        }
+
+    @property
+    def position(self):
+        """The number of pending jobs ahead of this one."""
+        if self.status != 'pending':
+            return 0
+        return PullJob.query.filter(PullJob.status == 'pending',
+            PullJob.id < self.id).count()
+
+    @classmethod
+    def submit(cls, url, user, kind='pull', source=None):
+        job = cls(url=url, kind=kind, user_id=user.id, status='pending',
+            attempts=0, source_id=source.id if source is not None else None)
+        db.session.add(job)
+        db.session.commit()
+        return job
+
+    @classmethod
+    def claim(cls, worker, lease=spider_job_lease,
+        max_attempts=spider_job_max_attempts):
+        """Take the oldest pending job, or a running job whose worker has
+        not finished it in `lease` seconds. Return None if there isn't.
+
+        Workers in different processes may race for the same job, the
+        job is only taken if its row isn't changed since it's read.
+        """
+        now = datetime.datetime.utcnow()
+        deadline = now - datetime.timedelta(seconds=lease)
+        while True:
+            job = cls.query.filter(db.or_(
+                cls.status == 'pending',
+                db.and_(cls.status == 'running', cls.started < deadline)
+            )).order_by(cls.id).first()
+            if job is None:
+                return None
+            if job.attempts >= max_attempts:
+                job.status = 'failed'
+                job.error = 'The job is abandoned {} times.'.format(job.attempts)
+                job.finished = now
+                db.session.commit()
+                continue
+            claimed = cls.query.filter(cls.id == job.id,
+                cls.status == job.status,
+                cls.attempts == job.attempts
+            ).update({
+                'status': 'running',
+                'worker': worker,
+                'started': now,
+                'attempts': job.attempts + 1
+            }, synchronize_session=False)
+            db.session.commit()
+            if claimed:
+                db.session.refresh(job)
+                return job
+
+    def finish(self, source):
+        self.status = 'done'
+        self.source_id = source.id
+        self.error = None
+        self.finished = datetime.datetime.utcnow()
+        db.session.commit()
+
+    def fail(self, error):
+        self.status = 'failed'
+        self.error = error
+        self.finished = datetime.datetime.utcnow()
+        db.session.commit()
+
+    def __repr__(self):
+        return "<PullJob url=%r status=%r>" % (self.url, self.status)
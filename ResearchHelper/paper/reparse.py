@@ -0,0 +1,125 @@
+import os
+import json
+import multiprocessing
+from io import BytesIO
+
+from .config import spider_reparse_batch_size
+from .caches import atomic_write
+from .models import Source
+from .spiders import SpiderFactory, SpiderError
+
+
+class Checkpoint(object):
+    """The state of a reparse kept in a JSON file, i.e., the last cache key
+    whose source is saved and the counters."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def save(self, state):
+        atomic_write(self.path, json.dumps(state).encode('utf-8'))
+
+    def clear(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+def iter_cache_entries(store, after=''):
+    """Yield a tuple `(key, url, content)` of cache entries in order of
+    keys, `content` is None if there isn't a spider of the url or the
+    entry is gone."""
+    for key in store.iter_keys(after):
+        url = store.meta(key).get('url')
+        content = None
+        if url and SpiderFactory.registry.match_url(url) is not None:
+            content = store.read(key)
+        yield key, url, content
+
+
+def reparse_entry(entry):
+    """Parse the cached content by the spider of its url in a worker
+    process. Return a tuple `(key, item, error)`, both `item` and `error`
+    are None if the entry is skipped."""
+    key, url, content = entry
+    if content is None:
+        return key, None, None
+    spider = SpiderFactory.create_spider(url, cache_enabled=False)
+    try:
+        spider.process(BytesIO(content))
+    except SpiderError as e:
+        return key, None, str(e)
+    return key, spider.get_item(), None
+
+
+def get_pool(processes=None):
+    # the forked workers inherit the spiders registered in this process
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork').Pool(processes)
+    return multiprocessing.Pool(processes)
+
+
+def reparse(store, checkpoint=None, processes=None,
+    batch_size=spider_reparse_batch_size, chunksize=8, progress=None):
+    """Parse all of the cached pages again in a process pool, and update
+    or create their sources in batches, in the current app context.
+
+    :param store: the spider cache store.
+    :param checkpoint: a `Checkpoint` to resume from, and it's saved after
+        each batch, it's cleared once all of pages are parsed.
+    :param processes: the number of worker processes, default to the
+        number of CPUs.
+    :param batch_size: the number of sources saved in a transaction.
+    :param chunksize: the number of pages sent to a worker at once.
+    :param progress: a function called with the state after each batch.
+    Return the state, i.e., the numbers of `parsed`, `failed`, `skipped`
+    pages and `created`, `updated`, `incomplete` sources.
+    """
+    state = {'key': '', 'parsed': 0, 'failed': 0, 'skipped': 0,
+        'created': 0, 'updated': 0, 'incomplete': 0}
+    if checkpoint is not None:
+        state.update(checkpoint.load())
+
+    def save(items, key):
+        if items:
+            result = Source.bulk_update_or_create(items)
+            for name, count in result.items():
+                state[name] += count
+        state['key'] = key
+        if checkpoint is not None:
+            checkpoint.save(state)
+        if progress is not None:
+            progress(state)
+
+    with get_pool(processes) as pool:
+        # the results are in order of keys, so the checkpoint is the last
+        # key of a saved batch
+        results = pool.imap(reparse_entry,
+            iter_cache_entries(store, state['key']), chunksize)
+        items = []
+        count = 0
+        key = state['key']
+        for key, item, error in results:
+            count += 1
+            if error is not None:
+                state['failed'] += 1
+            elif item is None:
+                state['skipped'] += 1
+            else:
+                state['parsed'] += 1
+                items.append(item)
+            if count >= batch_size:
+                save(items, key)
+                items = []
+                count = 0
+        if count:
+            save(items, key)
+    if checkpoint is not None:
+        checkpoint.clear()
+    return state
@@ -0,0 +1,284 @@
+import os
+import time
+import threading
+import multiprocessing
+from io import BytesIO
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from .config import spider_parse_sandbox_processes, spider_parse_sandbox_max_jobs, \
+    spider_parse_sandbox_memory_limit, spider_parse_sandbox_timeout
+
+
+class SandboxError(Exception):
+    pass
+
+
+class SandboxTimeoutError(SandboxError):
+    pass
+
+
+class SandboxMemoryError(SandboxError):
+    pass
+
+
+def get_rss(pid):
+    """The resident memory of the process in bytes, None if it's unknown,
+    it's read from `/proc`, so it's only known on Linux."""
+    try:
+        with open('/proc/{}/statm'.format(pid), 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def get_peak_memory():
+    """The peak memory of this process in bytes, i.e., the peak virtual
+    memory limited by `RLIMIT_AS` on Linux, otherwise the peak RSS."""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmPeak:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    if resource is None:
+        return None
+    # in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def set_memory_limit(memory_limit):
+    # the allocations of lxml fail beyond the limit, instead of taking the
+    # memory of the host
+    if resource is None or not memory_limit:
+        return
+    try:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    except (ValueError, OSError):
+        pass
+
+
+def parse_content(spider_class, url, content, options):
+    """Parse the content by a spider of the class, return its item."""
+    spider = spider_class(url, cache_enabled=False, parse_sandbox=None,
+        metrics=None, **options)
+    tree = spider.html_parse(BytesIO(content))
+    spider.parse(tree)
+    return spider.get_item()
+
+
+def sandbox_worker(conn, max_jobs, memory_limit):
+    """Parse the jobs received from the connection until `max_jobs` are
+    done or the memory is nearly exhausted, then quit, so the memory kept
+    by lxml is released with the process.
+
+    The result of a job is a tuple `(status, value)`, the status is `ok`,
+    `error` or `memory` if it fails for the memory limit.
+    """
+    set_memory_limit(memory_limit)
+    for i in range(max_jobs):
+        try:
+            job = conn.recv()
+        except (EOFError, OSError):
+            break
+        if job is None:
+            break
+        try:
+            result = ('ok', parse_content(*job))
+        except BaseException as e:
+            message = '{}: {}'.format(type(e).__name__, e)
+            # lxml reports the failed allocations as the syntax errors
+            peak = get_peak_memory()
+            exhausted = (isinstance(e, MemoryError) or (memory_limit
+                and peak is not None and peak > memory_limit * 0.9))
+            result = ('memory' if exhausted else 'error', message)
+        try:
+            conn.send(result)
+        except (OSError, ValueError):
+            break
+        if result[0] == 'memory':
+            break
+    conn.close()
+
+
+class SandboxWorker(object):
+    """A worker process of `ParseSandbox` and its connection."""
+
+    def __init__(self, context, max_jobs, memory_limit):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=sandbox_worker,
+            args=(child_conn, max_jobs, memory_limit))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def run(self, job, timeout, memory_limit, interval=0.05):
+        """Send the job and wait for its result, the process is killed if
+        the job takes more than `timeout` seconds. The memory is limited by
+        `RLIMIT_AS` in the worker, the resident memory is checked here as
+        well in case the limit isn't supported."""
+        try:
+            self.conn.send(job)
+        except (BrokenPipeError, ConnectionResetError):
+            raise SandboxError('The parse worker exited with code {}.'.format(
+                self.process.exitcode))
+        self.jobs += 1
+        deadline = time.monotonic() + timeout
+        while not self.conn.poll(interval):
+            if not self.process.is_alive():
+                raise SandboxError('The parse worker exited with code {}.'.format(
+                    self.process.exitcode))
+            if time.monotonic() > deadline:
+                self.kill()
+                raise SandboxTimeoutError(
+                    'The parse takes more than {} seconds.'.format(timeout))
+            rss = get_rss(self.pid)
+            if memory_limit and rss is not None and rss > memory_limit:
+                self.kill()
+                raise SandboxMemoryError(
+                    'The parse takes more than {} bytes of memory.'.format(memory_limit))
+        try:
+            status, result = self.conn.recv()
+        except (EOFError, OSError):
+            raise SandboxError('The parse worker exited with code {}.'.format(
+                self.process.exitcode))
+        if status == 'memory':
+            # the worker quits after it, see `sandbox_worker()`
+            self.stop()
+            raise SandboxMemoryError(
+                'The parse takes more than {} bytes of memory, {}'.format(
+                    memory_limit, result))
+        if status != 'ok':
+            raise SandboxError(result)
+        return result
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.conn.close()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.kill()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class ParseSandbox(object):
+    """Parse the pages of spiders in a pool of worker processes instead of
+    the threads of spiders, so a pathological page can't take the memory
+    or hang the serving process.
+
+    A worker is killed once a page takes more than `timeout` seconds, the
+    memory of a worker is limited by `memory_limit`, and it's restarted
+    after `max_jobs` pages or the memory is nearly exhausted.
+
+    The workers are started by a fork server, or spawned, instead of being
+    forked from this process, which may hold the locks of other threads,
+    so the spider classes must be importable.
+    """
+
+    def __init__(self, processes=spider_parse_sandbox_processes,
+        max_jobs=spider_parse_sandbox_max_jobs,
+        memory_limit=spider_parse_sandbox_memory_limit,
+        timeout=spider_parse_sandbox_timeout):
+        self.processes = processes
+        self.max_jobs = max_jobs
+        self.memory_limit = memory_limit
+        self.timeout = timeout
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            self.context = multiprocessing.get_context('forkserver')
+            # the workers are forked from the server with the spiders loaded
+            self.context.set_forkserver_preload(['ResearchHelper.paper.spiders'])
+        else:
+            self.context = multiprocessing.get_context('spawn')
+        self.lock = threading.Lock()
+        # at most `processes` pages are parsed at the same time
+        self.slots = threading.BoundedSemaphore(processes)
+        self.idle = []
+        self.started = 0
+        self.jobs = 0
+        self.timeouts = 0
+        self.memory_kills = 0
+        self.failures = 0
+
+    def get_worker(self):
+        with self.lock:
+            while self.idle:
+                worker = self.idle.pop()
+                if worker.is_alive():
+                    return worker
+                worker.stop()
+            self.started += 1
+        return SandboxWorker(self.context, self.max_jobs, self.memory_limit)
+
+    def put_worker(self, worker):
+        # the worker quits by itself after `max_jobs`
+        if worker.jobs >= self.max_jobs or not worker.is_alive():
+            worker.stop()
+            return
+        with self.lock:
+            self.idle.append(worker)
+
+    def parse(self, spider, content):
+        """Parse the content by a spider of the same class in a worker.
+        Return the item, or raise `SandboxError`."""
+        job = (type(spider), spider.url, content, {'encoding': spider.encoding})
+        with self.slots:
+            worker = self.get_worker()
+            try:
+                item = worker.run(job, self.timeout, self.memory_limit)
+            except SandboxError as e:
+                with self.lock:
+                    self.jobs += 1
+                    if isinstance(e, SandboxTimeoutError):
+                        self.timeouts += 1
+                    elif isinstance(e, SandboxMemoryError):
+                        self.memory_kills += 1
+                    else:
+                        self.failures += 1
+                if worker.is_alive():
+                    self.put_worker(worker)
+                raise
+            except BaseException:
+                # e.g., the spider class can't be pickled
+                worker.kill()
+                raise
+            with self.lock:
+                self.jobs += 1
+            self.put_worker(worker)
+            return item
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for worker in idle:
+            worker.stop()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'processes': self.processes,
+                'idle': len(self.idle),
+                'started': self.started,
+                'jobs': self.jobs,
+                'timeouts': self.timeouts,
+                'memory_kills': self.memory_kills,
+                'failures': self.failures,
+            }
@@ -0,0 +1,266 @@
+import time
+import datetime
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from email.utils import parsedate_to_datetime
+
+from .caches import SqliteConnectionMixin
+
+
+def parse_retry_after(value, now=None):
+    """The seconds of `Retry-After` header, which is either seconds or a
+    HTTP date. Return None if it's missing or invalid."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if date is None:
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    now = time.time() if now is None else now
+    return max(date.timestamp() - now, 0.0)
+
+
+class TokenBucket(object):
+    """A token bucket refilled `rate` tokens per second up to `burst`.
+
+    A token is reserved even if the bucket is empty, the caller should
+    wait for the returned delay, so the waiters are served in order.
+    """
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.clock = clock
+        self.tokens = self.burst
+        self.updated = clock()
+        # no token is given before it, see `pause()`
+        self.paused_until = 0.0
+
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self):
+        """The seconds until a token is available, without taking it."""
+        now = self.clock()
+        self.refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.paused_until - now, 0.0)
+
+    def reserve(self):
+        """Take a token, return the seconds to wait before using it."""
+        wait = self.delay()
+        self.tokens -= 1
+        return wait
+
+    def pause(self, seconds):
+        """Give no token in the seconds, e.g., the server asks to retry
+        after them."""
+        now = self.clock()
+        self.paused_until = max(self.paused_until, now + seconds)
+        # the tokens are drained, so the requests restart slowly
+        self.refill(now)
+        self.tokens = min(self.tokens, 0.0)
+
+
+class HostScheduler(object):
+    """Limit the request rate of spiders per host by token buckets.
+
+    It's shared by all of spiders in the app as their `scheduler`, the
+    hosts are the `host` of spiders, so `ieeexplore.ieee.org` and
+    `www.ieee.org` share the bucket of `ieee.org`.
+    """
+
+    def __init__(self, rate=2, burst=4, limits=None, max_pause=60,
+        clock=time.monotonic, sleep=time.sleep):
+        """
+        :param rate: the default number of requests per second of hosts.
+        :param burst: the default max number of requests sent at once.
+        :param limits: a dict of `host -> (rate, burst)` overrides the
+            default limits.
+        :param max_pause: the max seconds a host is paused by `Retry-After`.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.limits = dict(limits or {})
+        self.max_pause = max_pause
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.throttled = 0
+
+    def get_limit(self, host):
+        """The tuple `(rate, burst)` of the host."""
+        return self.limits.get(host, (self.rate, self.burst))
+
+    def get_bucket(self, host):
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            rate, burst = self.get_limit(host)
+            bucket = self.buckets[host] = TokenBucket(rate, burst, self.clock)
+        return bucket
+
+    @contextmanager
+    def bucket(self, host):
+        """The token bucket of the host used in the block."""
+        with self.lock:
+            yield self.get_bucket(host)
+
+    def delay(self, host):
+        """The seconds until the host is able to be requested."""
+        with self.bucket(host) as bucket:
+            return bucket.delay()
+
+    def reserve(self, host):
+        """Take a token of the host, return the seconds to wait before
+        sending the request, it's for the callers can't block, e.g., the
+        coroutines."""
+        with self.bucket(host) as bucket:
+            return bucket.reserve()
+
+    def acquire(self, host):
+        """Block until the host is able to be requested."""
+        wait = self.reserve(host)
+        if wait > 0:
+            self.sleep(wait)
+
+    def throttle(self, host, retry_after=None):
+        """The host responds 429/503, pause it for `Retry-After` seconds,
+        or a second per token of its rate if the header is missing."""
+        with self.bucket(host) as bucket:
+            seconds = retry_after if retry_after is not None else 1 / bucket.rate
+            bucket.pause(min(seconds, self.max_pause))
+        with self.lock:
+            self.throttled += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'throttled': self.throttled,
+                'delay': {host: bucket.delay()
+                    for host, bucket in self.buckets.items()},
+            }
+
+
+class SharedHostScheduler(SqliteConnectionMixin, HostScheduler):
+    """Like `HostScheduler`, but the token buckets are kept in a SQLite
+    file, so the limits of a host are shared by all of processes of the
+    app, e.g., the workers of `flask paper worker`, instead of each one
+    sending the requests at the full rate.
+
+    A bucket is read and written back in a write transaction, so the
+    processes take the tokens in turn. The clock is the wall clock, which
+    is the same for the processes.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS bucket (
+            host TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated REAL NOT NULL,
+            paused_until REAL NOT NULL
+        )
+    """
+
+    def __init__(self, db_path, rate=2, burst=4, limits=None, max_pause=60,
+        clock=time.time, sleep=time.sleep, timeout=30):
+        """
+        :param db_path: the path of SQLite file.
+        The others are the same as `HostScheduler`.
+        """
+        super().__init__(rate, burst, limits, max_pause, clock, sleep)
+        self.db_path = db_path
+        self.timeout = timeout
+        self.local = threading.local()
+        with self.connection as conn:
+            conn.execute(self.schema)
+
+    def load_bucket(self, conn, host):
+        rate, burst = self.get_limit(host)
+        bucket = TokenBucket(rate, burst, self.clock)
+        row = conn.execute('SELECT tokens, updated, paused_until FROM bucket '
+            'WHERE host = ?', (host,)).fetchone()
+        if row is not None:
+            bucket.tokens, bucket.updated, bucket.paused_until = row
+        return bucket
+
+    @contextmanager
+    def bucket(self, host):
+        conn = self.connection
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            bucket = self.load_bucket(conn, host)
+            yield bucket
+            conn.execute('INSERT OR REPLACE INTO bucket '
+                '(host, tokens, updated, paused_until) VALUES (?, ?, ?, ?)',
+                (host, bucket.tokens, bucket.updated, bucket.paused_until))
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    def stats(self):
+        # the throttled count is of this process
+        conn = self.connection
+        hosts = [row[0] for row in conn.execute('SELECT host FROM bucket')]
+        return {
+            'throttled': self.throttled,
+            'delay': {host: self.load_bucket(conn, host).delay()
+                for host in hosts},
+        }
+
+
+class FairQueue(object):
+    """Queue items of hosts in round robin, a host which is rate limited
+    by the scheduler is skipped, so the items of other hosts are taken
+    first instead of waiting for it.
+    """
+
+    def __init__(self, scheduler=None):
+        self.scheduler = scheduler
+        # host -> items, in the order of the next turn
+        self.queues = OrderedDict()
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def put(self, host, item):
+        self.queues.setdefault(host, deque()).append(item)
+
+    def next(self, skip=()):
+        """The first host in turn which is ready, or the host will be
+        ready soonest. Return a tuple `(host, delay)`, `delay` is the
+        seconds until the host is ready, or None if there isn't any host
+        except the skipped.
+        """
+        chosen, delay = None, None
+        for host in self.queues:
+            if host in skip:
+                continue
+            wait = self.scheduler.delay(host) if self.scheduler is not None else 0.0
+            if delay is None or wait < delay:
+                chosen, delay = host, wait
+            if wait <= 0:
+                break
+        if chosen is None:
+            return None
+        return chosen, delay
+
+    def get(self, host):
+        """Take the next item of the host, the host waits for the other
+        hosts to take their turn."""
+        queue = self.queues.pop(host)
+        item = queue.popleft()
+        if queue:
+            self.queues[host] = queue
+        return item
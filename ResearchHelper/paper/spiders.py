@@ -4,16 +4,26 @@ import hashlib
 import socket
 import json
 import datetime
+import threading
 from io import BytesIO
-from dateutil import parser as date_parser
-from urllib.request import urlopen
-from urllib.parse import urlparse, urlencode, urljoin
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.request import urlopen, Request
+from urllib.parse import urlsplit, urlencode, urljoin
 from urllib.error import URLError, HTTPError
+from http import client as http_client
 from html import escape as html_escape
 from html import unescape as html_unescape
 
 from lxml import etree
 
+from .caches import FileCacheStore
+from .dates import date_normalizer
+from .locks import SingleFlight
+from .schedulers import FairQueue, parse_retry_after
+from .sandbox import SandboxError
+
 
 class SpiderError(Exception):
     pass
@@ -25,11 +35,18 @@ class SpiderRequestUnknowError(SpiderRequestError):
     pass
 
 class SpiderRequestHTTPError(SpiderRequestError):
-    pass
+
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        # the HTTP status code
+        self.code = code
 
 class SpiderRequestTimeoutError(SpiderRequestError):
     pass
 
+class SpiderRequestUnavailableError(SpiderRequestError):
+    pass
+
 class SpiderCacheError(SpiderError):
     pass
 
@@ -45,11 +62,193 @@ class SpiderCacheWriteError(SpiderCacheError):
 class SpiderParseError(SpiderError):
     pass
 
+# the errors able to be kept by the negative cache
+failure_errors = {error.__name__: error for error in (SpiderRequestHTTPError,
+    SpiderRequestTimeoutError, SpiderRequestUnknowError, SpiderParseError)}
+
+
+class StopCondition(object):
+    """Cut the content of a response once the markers are read in order,
+    or the budget of bytes is used up, so that the rest of the response
+    is never downloaded.
+    """
+
+    def __init__(self, markers=(), max_bytes=None):
+        """
+        :param markers: a list of bytes, e.g., `[b'<div id="abs"', b'</div>']`
+            stops after the first `</div>` following the abstract.
+        :param max_bytes: the max number of bytes read.
+        """
+        self.markers = list(markers)
+        self.max_bytes = max_bytes
+        self.size = 0
+        # the end of the read content, where the next marker may begin
+        self.tail = b''
+        self.stopped = False
+
+    def feed(self, chunk):
+        """Return the part of the chunk before the stop."""
+        if self.stopped:
+            return b''
+        end = len(chunk)
+        start = 0
+        while self.markers:
+            marker = self.markers[0]
+            tail = self.tail
+            window = tail + chunk[start:]
+            index = window.find(marker)
+            if index < 0:
+                self.tail = window[max(len(window) - len(marker) + 1, 0):]
+                break
+            start += index + len(marker) - len(tail)
+            self.tail = b''
+            self.markers.pop(0)
+            if not self.markers:
+                end = start
+                self.stopped = True
+        if self.max_bytes is not None and self.size + end >= self.max_bytes:
+            end = self.max_bytes - self.size
+            self.stopped = True
+        self.size += end
+        return chunk[:end]
+
+
+class ParserPool(object):
+    """A thread-local pool of lxml parsers keyed by their kind and options.
+
+    A parser can't be used by more than one thread, so each thread keeps
+    its own idle parsers. A parser is taken out of the pool while it's
+    used, so nested parses get different parsers.
+    """
+
+    parser_classes = {
+        'html': etree.HTMLParser,
+        'xml': etree.XMLParser,
+    }
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def get_idle(self, key):
+        idle = getattr(self.local, 'idle', None)
+        if idle is None:
+            idle = self.local.idle = {}
+        return idle.setdefault(key, [])
+
+    @contextmanager
+    def parser(self, kind, **options):
+        """Take an idle parser or create a new one, it's returned to the
+        pool unless the parse failed."""
+        idle = self.get_idle((kind, tuple(sorted(options.items()))))
+        parser = idle.pop() if idle else self.parser_classes[kind](**options)
+        yield parser
+        idle.append(parser)
+
+
+parser_pool = ParserPool()
+
+
+def domain_labels(domain):
+    """The reversed labels of the domain, the port is ignored."""
+    domain = domain.lower().rsplit('@', 1)[-1]
+    if not domain.startswith('['):
+        domain = domain.split(':', 1)[0]
+    return [label for label in reversed(domain.strip('.').split('.')) if label]
+
+
+def domain_matched(hostname, domain):
+    """Whether the hostname is the domain or one of its subdomains."""
+    labels = domain_labels(domain)
+    return domain_labels(hostname)[:len(labels)] == labels if labels else False
+
+
+def iter_entry_points(group):
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        from pkg_resources import iter_entry_points
+        return iter_entry_points(group)
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        return eps.select(group=group)
+    return eps.get(group, [])
+
+
+class SpiderRegistry(object):
+    """Map domains to spiders by a trie of reversed domain labels, e.g.,
+    `ieee.org` is stored as `org -> ieee`. A hostname is dispatched to the
+    spider of its longest registered suffix, so `ieeexplore.ieee.org`
+    matches `ieee.org` but `notieee.org` doesn't.
+    """
+
+    # the key of the spider in a trie node, it isn't a valid label
+    spider_key = ''
+
+    def __init__(self, spiders=()):
+        self.root = {}
+        self.spiders = []
+        for spider_cls in spiders:
+            self.register(spider_cls)
+
+    def register(self, spider_cls, *hosts):
+        """Register the spider for its `host` and the extra hosts, the
+        spider previously registered for the same host is replaced.
+        Return the spider class, so it can be used as a decorator.
+        """
+        for host in (spider_cls.host,) + hosts:
+            labels = domain_labels(host)
+            if not labels:
+                raise SpiderError('Spider [{}] has no host.'.format(spider_cls.name))
+            node = self.root
+            for label in labels:
+                node = node.setdefault(label, {})
+            node[self.spider_key] = spider_cls
+        if spider_cls not in self.spiders:
+            self.spiders.append(spider_cls)
+        return spider_cls
+
+    def load_entry_points(self, group):
+        """Register the spiders exported by the entry points of the group,
+        e.g., `entry_points={'ResearchHelper.spiders': ['acm = pkg:ACMSpider']}`.
+        """
+        for entry_point in iter_entry_points(group):
+            self.register(entry_point.load())
+
+    def match(self, hostname):
+        """Return the spider of the hostname, or None if not supported."""
+        spider_cls = None
+        node = self.root
+        for label in domain_labels(hostname):
+            node = node.get(label)
+            if node is None:
+                break
+            spider_cls = node.get(self.spider_key, spider_cls)
+        return spider_cls
+
+    def match_url(self, url):
+        try:
+            hostname = urlsplit(url).hostname
+        except ValueError as e:
+            return None
+        return self.match(hostname) if hostname else None
+
+
+# the spiders of sites are registered by `register_spider` decorator
+spider_registry = SpiderRegistry()
+register_spider = spider_registry.register
+
 
 class PaperItem(object):
 
-    def __init__(self, url):
+    def __init__(self, url, date_key=None):
+        """
+        :param date_key: the key of `date_normalizer` learns the format of
+            dates, e.g., the name of spider.
+        """
         self.url = url
+        self.date_key = date_key
+        # the `dates.DateResult` of the last published date
+        self.published_result = None
         self.download_link = ''
         self.doi_link = ''
         self._title = ''
@@ -100,13 +299,10 @@ class PaperItem(object):
     
     @published.setter
     def published(self, value):
-        try:
-            dt = date_parser.parse(str(value))
-        except Exception as e:
-            pass
-            # self._date = str(value)
-        else:
-            self._published = dt
+        # the unparseable date is kept in `published_result` instead
+        self.published_result = date_normalizer.parse(value, self.date_key)
+        if self.published_result.value is not None:
+            self._published = self.published_result.value
 
     @published.deleter
     def published(self):
@@ -187,39 +383,105 @@ class BaseSpider(object):
     cache_enabled = False
     # 0 means that cache never expire, negative means never cache
     cache_expire = 0
+    # where the cache is stored, see `caches.FileCacheStore`, None means
+    # the plain files in `cache_dir`
+    cache_store = None
+    # revalidate the expired cache via ETag/Last-Modified
+    cache_revalidate = True
+    # the XPath expressions used by `parse()`, they are compiled once per
+    # spider class, see `xpath()`
+    xpaths = {}
+    # the names of `xpaths` whose result is the value of the item field
+    item_fields = ()
+    # feed the response into the parser while downloading
+    stream_enabled = False
+    stream_chunk_size = 16 * 1024
+    # stop reading the response once the markers are read in order, or the
+    # bytes are read, if the metadata is at the top of the page, see
+    # `StopCondition`, None means the whole response is read
+    stop_markers = None
+    stop_bytes = None
+    # an object has `urlopen()` like `urllib.request.urlopen()`, e.g.,
+    # `transports.HTTPConnectionPool`, None means urllib is used.
+    transport = None
+    # `schedulers.HostScheduler` limits the request rate per host, None
+    # means no limit
+    scheduler = None
+    # the times a throttled(429, or 503 with Retry-After) request is
+    # retried after the host is paused
+    throttle_retries = 2
+    # `breakers.RetryPolicy` retries the transient errors, None means the
+    # request fails at the first error
+    retry_policy = None
+    # the HTTP status codes of transient errors
+    retry_statuses = (500, 502, 503, 504)
+    # `breakers.CircuitBreakers` fails fast the requests of the hosts
+    # keep failing, None means no circuit breaker
+    breakers = None
+    # `caches.NegativeCache` keeps the failures of urls for a while, and
+    # the url isn't pulled again until its failure expired
+    negative_cache = None
+    # `caches.ParseCache` keeps the items parsed from the contents, so an
+    # unchanged content isn't parsed again, None means no cache
+    parse_cache = None
+    # bump it once `parse()` is changed, so the items parsed by the other
+    # versions of the spider are not used
+    version = 1
+    # `metrics.MetricsRegistry` records the fetch latency, bytes, cache
+    # hits and parse time, None means nothing is recorded
+    metrics = None
+    # `sandbox.ParseSandbox` parses the pages in worker processes with
+    # memory and time limits, None means they're parsed in this thread
+    parse_sandbox = None
+    # where the lock files of urls being pulled are kept, the processes
+    # pulling the same url wait for each other, None means no lock file
+    lock_dir = None
+    # the options of parsers taken from `parser_pool`, besides encoding
+    parser_options = {
+        'html': {'recover': True},
+        'xml': {'recover': True, 'ns_clean': True},
+    }
 
     @classmethod
     def host_matched(cls, url):
         try:
-            netloc = urlparse(url).netloc
-            return netloc.endswith(cls.host)
+            hostname = urlsplit(url).hostname or ''
         except Exception as e:
             return False
+        return domain_matched(hostname, cls.host)
 
     def __init__(self, url, **kwargs):
         for key, value in kwargs.items():
             setattr(self, key, value)
         self.url = url
-        self.item = PaperItem(self.url)
+        self.item = PaperItem(self.url, self.name)
         self.urlhash = hashlib.md5(self.url.encode('utf-8')).hexdigest()
-        self.filename = os.path.join(self.cache_dir, self.urlhash[:3], self.urlhash)
-        self.xml_parser = etree.XMLParser(
-            recover=True, 
-            ns_clean=True,
-            encoding=self.encoding
-        )
-        self.html_parser = etree.HTMLParser(
-            recover=True, 
-            encoding=self.encoding
-        )
+        if self.cache_store is None:
+            self.cache_store = FileCacheStore(self.cache_dir)
+        # the error logs of the last parser runs
+        self.parser_errors = {}
+        # whether the content is cut by the stop condition
+        self.truncated = False
+
+    def get_lock_file(self):
+        if self.lock_dir is None:
+            return None
+        return os.path.join(self.lock_dir, '{}.lock'.format(self.urlhash))
 
     def get_parser_errors(self, parser='html'):
         # lists the errors and warnings of the last parser run
-        if parser == 'html':
-            return self.html_parser.error_log
-        elif parser == 'xml':
-            return self.xml_parser.error_log
-        return []
+        return self.parser_errors.get(parser, [])
+
+    @contextmanager
+    def parser(self, kind='html'):
+        """Take a parser of the kind from the `parser_pool`, and keep its
+        error log when it's done."""
+        options = dict(self.parser_options[kind], encoding=self.encoding)
+        with parser_pool.parser(kind, **options) as parser:
+            try:
+                yield parser
+            finally:
+                self.parser_errors[kind] = parser.error_log
 
     def get_cache(self):
         try:
@@ -227,35 +489,85 @@ class BaseSpider(object):
                 or (not self.cache_enabled)):
                 return None
 
-            if not os.path.isfile(self.filename):
+            mtime = self.cache_store.stat(self.urlhash)
+            if mtime is None:
+                self.count('cache_miss')
                 return None
             
-            content = b''
             now = time.time()
-            mtime = os.path.getmtime(self.filename)
             if (self.cache_expire == 0
                 or mtime + self.cache_expire >= now):
-                with open(self.filename, 'rb') as f:
-                    content = f.read()
+                content = self.cache_store.read(self.urlhash)
+                if content is None:
+                    self.count('cache_miss')
+                    return None
+                self.cache_store.record_access(self.urlhash)
+                self.count('cache_hit')
                 return BytesIO(content)
             else:
+                self.count('cache_stale')
                 return None
         except Exception as e:
             raise SpiderCacheReadError(e)
 
-    def put_cache(self, content):
+    def get_cache_validators(self):
+        """The conditional request headers of the stale cache."""
+        try:
+            if ((self.cache_expire < 0)
+                or (not self.cache_enabled)
+                or (not self.cache_revalidate)):
+                return {}
+            if self.cache_store.stat(self.urlhash) is None:
+                return {}
+            meta = self.cache_store.meta(self.urlhash)
+            headers = {}
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+            return headers
+        except Exception as e:
+            raise SpiderCacheReadError(e)
+
+    def get_cache_meta(self, headers=None):
+        # the response validators are stored with the cached content
+        headers = headers or {}
+        return {
+            'url': self.url,
+            'etag': headers.get('ETag', ''),
+            'last_modified': headers.get('Last-Modified', ''),
+            'truncated': self.truncated
+        }
+
+    def put_cache(self, content, headers=None):
         try:
             if not self.cache_enabled:
                 return False
-            dirname = os.path.dirname(self.filename)
-            if not os.path.isdir(dirname):
-                os.makedirs(dirname)
-            with open(self.filename, 'wb') as f:
-                f.write(content)
+            self.cache_store.put(self.urlhash, content,
+                self.get_cache_meta(headers))
+            self.count('cache_write')
             return True
         except Exception as e:
             raise SpiderCacheWriteError(e)
 
+    def refresh_cache(self, headers=None):
+        """The stale cache is still valid(HTTP 304), renew its mtime
+        and validators, then return its content. Return None if the
+        cache is gone."""
+        try:
+            content = self.cache_store.read(self.urlhash)
+            if content is None:
+                return None
+            meta = None
+            if headers and (headers.get('ETag') or headers.get('Last-Modified')):
+                meta = self.get_cache_meta(headers)
+            self.cache_store.touch(self.urlhash, meta)
+            self.cache_store.record_access(self.urlhash)
+            self.count('cache_revalidated')
+            return BytesIO(content)
+        except Exception as e:
+            raise SpiderCacheWriteError(e)
+
     def urljoin(self, url):
         # wrapper of the urllib.parse.urljoin
         return urljoin(self.url, url)
@@ -265,23 +577,213 @@ class BaseSpider(object):
         if buf is not None:
             return buf
 
+        # only GET request can be revalidated
+        headers = self.get_cache_validators() if data is None else {}
+        status, headers, content = self.fetch(data, timeout, headers)
+        if status == 304:
+            buf = self.refresh_cache(headers)
+            if buf is not None:
+                return buf
+            # the cache is evicted meanwhile
+            status, headers, content = self.fetch(data, timeout)
+        self.put_cache(content, headers)
+
+        return BytesIO(content)
+
+    def stream(self, data, timeout):
+        """Like `request()`, but the response is fed into the html parser
+        chunk by chunk and written into the cache at the same time, so
+        that the whole content is never kept in memory.
+        Return the parsed tree, or the content buffer from the cache.
+        """
+        buf = self.get_cache()
+        if buf is not None:
+            return buf
+
+        headers = self.get_cache_validators() if data is None else {}
+        f = self.open(data, timeout, headers)
+        if f.code == 304:
+            f.close()
+            buf = self.refresh_cache(f.headers)
+            if buf is not None:
+                return buf
+            f = self.open(data, timeout)
+
+        with f:
+            return self.feed(f)
+
+    def feed(self, f):
+        # tee the response into the parser and the cache writer
+        writer = None
+        if self.cache_enabled:
+            writer = self.cache_store.writer(self.urlhash)
+        try:
+            with self.parser('html') as parser:
+                for chunk in self.iter_content(f):
+                    parser.feed(chunk)
+                    if writer is not None:
+                        writer.write(chunk)
+                try:
+                    root = parser.close()
+                except etree.LxmlError as e:
+                    raise SpiderParseError('There is something wrong when parse the url.')
+        except BaseException:
+            if writer is not None:
+                writer.abort()
+            raise
+        if writer is not None:
+            try:
+                writer.commit(self.get_cache_meta(f.headers))
+            except Exception as e:
+                raise SpiderCacheWriteError(e)
+            self.count('cache_write')
+        return root.getroottree()
+
+    def open(self, data, timeout, headers=None):
+        """Open the url without cache, return a file-like response object
+        which has `code`, `headers` and `read()`.
+        The request waits for its turn of the host if there is a scheduler.
+        """
         if isinstance(data, dict):
             data = urlencode(data).encode('utf-8')
-        content = b''
-        with urlopen(self.url, data=data, timeout=timeout) as f:
-            content = f.read()
-
-        self.put_cache(content)
+        headers = headers or {}
+        self.check_breaker()
+        retries = self.throttle_retries if self.scheduler is not None else 0
+        for i in range(retries + 1):
+            if self.scheduler is not None:
+                self.scheduler.acquire(self.host)
+            try:
+                # the latency until the response headers, the content is
+                # read by the caller
+                with self.timer('fetch_seconds'):
+                    if self.transport is None:
+                        f = urlopen(Request(self.url, data=data, headers=headers),
+                            timeout=timeout)
+                    else:
+                        f = self.transport.urlopen(self.url, data=data,
+                            headers=headers, timeout=timeout)
+            except HTTPError as e:
+                # urllib takes 304 Not Modified as an error
+                if e.code == 304 and headers:
+                    f = e
+                else:
+                    throttled = self.throttle(e.code, e.headers)
+                    if throttled and i < retries:
+                        continue
+                    if not throttled and not self.is_transient(e):
+                        # the host is fine, it's the url
+                        self.record_host(False)
+                    raise
+            self.record_host(False)
+            return f
+
+    def get_stop_condition(self):
+        if self.stop_markers is None and self.stop_bytes is None:
+            return None
+        return StopCondition(self.stop_markers or (), self.stop_bytes)
+
+    def iter_content(self, f):
+        """Yield the chunks of the response until the stop condition."""
+        stop = self.get_stop_condition()
+        while True:
+            chunk = f.read(self.stream_chunk_size)
+            if not chunk:
+                break
+            self.count('bytes', amount=len(chunk))
+            if stop is not None:
+                chunk = stop.feed(chunk)
+                if stop.stopped:
+                    # the connection is closed with the unread content
+                    self.truncated = True
+                    if chunk:
+                        yield chunk
+                    break
+            yield chunk
+
+    def count(self, name, key=None, amount=1):
+        """Add the amount to the counter of metrics, the key defaults
+        to the host."""
+        if self.metrics is not None:
+            self.metrics.inc(name, key or self.host, amount)
+
+    @contextmanager
+    def timer(self, name, key=None):
+        """Observe the seconds taken by the block in the histogram of
+        metrics, the key defaults to the host."""
+        if self.metrics is None:
+            yield
+            return
+        with self.metrics.timer(name, key or self.host):
+            yield
+
+    def check_breaker(self):
+        """Fail fast if the circuit breaker of the host is open."""
+        if self.breakers is not None and not self.breakers.allow(self.host):
+            raise SpiderRequestUnavailableError(
+                'Site [{}] is unavailable now, please try later.'.format(self.host))
+
+    def record_host(self, failed):
+        # the circuit breaker of the host learns from the result
+        if self.breakers is not None:
+            self.breakers.record(self.host, failed)
+
+    def is_transient(self, error):
+        """Whether the request error is transient, and worth a retry."""
+        if isinstance(error, HTTPError):
+            return error.code in self.retry_statuses
+        if isinstance(error, URLError):
+            # not e.g. an unknown url type or host
+            return isinstance(error.reason, (socket.timeout, ConnectionError))
+        return isinstance(error, (socket.timeout, ConnectionError,
+            http_client.HTTPException))
+
+    def download(self, data, timeout):
+        """`stream()` or `request()` the url, the transient errors are
+        retried with backoff by the retry policy. A POST request may not
+        be idempotent, so it's never retried."""
+        attempt = 0
+        while True:
+            try:
+                # the stream is parsed in this thread, not in the sandbox
+                if self.stream_enabled and self.parse_sandbox is None:
+                    return self.stream(data, timeout)
+                return self.request(data, timeout)
+            except Exception as e:
+                if not self.is_transient(e):
+                    raise
+                self.record_host(True)
+                if (data is not None or self.retry_policy is None
+                    or not self.retry_policy.wait(attempt)):
+                    raise
+                attempt += 1
+
+    def throttle(self, status, headers):
+        """Pause the host if the response asks to slow down.
+        Return True if the host is throttled."""
+        if self.scheduler is None:
+            return False
+        retry_after = parse_retry_after(headers.get('Retry-After')) if headers else None
+        if status == 429 or (status == 503 and retry_after is not None):
+            self.scheduler.throttle(self.host, retry_after)
+            return True
+        return False
 
-        return BytesIO(content)
+    def fetch(self, data, timeout, headers=None):
+        """Download the url content without cache.
+        Return a tuple `(status, headers, content)`.
+        """
+        with self.open(data, timeout, headers) as f:
+            return f.code, f.headers, b''.join(self.iter_content(f))
 
     def xml_parse(self, buf):
         # http://lxml.de/parsing.html
-        return etree.parse(buf, self.xml_parser)
+        with self.parser('xml') as parser:
+            return etree.parse(buf, parser)
 
     def html_parse(self, buf):
         # http://lxml.de/parsing.html#parsing-html
-        return etree.parse(buf, self.html_parser)
+        with self.parser('html') as parser:
+            return etree.parse(buf, parser)
 
     def pull(self, data=None, timeout=20):
         """Request and parse the url.
@@ -291,24 +793,143 @@ class BaseSpider(object):
             dict.
         :param timeout: request timeout.
         """
+        # only the failures of GET request are kept
+        if data is None:
+            self.check_failure()
+        try:
+            buf = self.retrieve(data, timeout)
+            self.process(buf)
+        except SpiderError as e:
+            self.count('errors', type(e).__name__)
+            if data is None:
+                self.put_failure(e)
+            raise
+
+    def get_failure_kind(self, error):
+        """The kind of failure kept by the negative cache, e.g., a 404
+        is kept longer than a timeout. None means it's not kept."""
+        if isinstance(error, SpiderRequestHTTPError):
+            if error.code is None or error.code == 429:
+                return None
+            return 'http_4xx' if error.code < 500 else 'http_5xx'
+        if isinstance(error, SpiderRequestTimeoutError):
+            return 'timeout'
+        if isinstance(error, SpiderRequestUnknowError):
+            return 'network'
+        if isinstance(error, SpiderParseError):
+            return 'parse'
+        return None
+
+    def check_failure(self):
+        """Raise the failure of the url kept by the negative cache."""
+        if self.negative_cache is None:
+            return
         try:
-            buf = self.request(data, timeout)
+            failure = self.negative_cache.get(self.urlhash)
+        except Exception as e:
+            raise SpiderCacheReadError(e)
+        if failure is None:
+            return
+        self.count('negative_cache_hit')
+        error_cls = failure_errors[failure['error']]
+        if issubclass(error_cls, SpiderRequestHTTPError):
+            raise error_cls(failure['message'], failure['code'])
+        raise error_cls(failure['message'])
+
+    def put_failure(self, error):
+        kind = self.get_failure_kind(error)
+        if self.negative_cache is None or kind is None:
+            return
+        try:
+            self.negative_cache.put(self.urlhash, kind,
+                type(error).__name__, str(error), getattr(error, 'code', None))
+        except Exception as e:
+            # the failure of the url is more important
+            pass
+
+    def retrieve(self, data, timeout):
+        """Download the url, the errors are translated to `SpiderError`."""
+        try:
+            return self.download(data, timeout)
+        except SpiderRequestUnavailableError as e:
+            raise
         except HTTPError as e:
-            raise SpiderRequestHTTPError('HTTP error, {}: {}'.format(e.code, e.reason))
+            raise SpiderRequestHTTPError('HTTP error, {}: {}'.format(e.code, e.reason), e.code)
         except URLError as e:
             raise SpiderRequestUnknowError('Request url error.')
         except socket.timeout as e:
             raise SpiderRequestTimeoutError('Request url timeout.')
+        except SpiderParseError as e:
+            raise
         except SpiderCacheError as e:
             raise SpiderCacheError('There is something wrong when cache the url.')
         except Exception as e:
             raise SpiderRequestError('There is something wrong when request the url.')
-        
+
+    def process(self, buf):
+        """Parse the content buffer returned by the request, or the tree
+        has been parsed by the stream. The item parsed from the same
+        content before is taken from the parse cache instead."""
+        digest = None
+        if self.parse_cache is not None and isinstance(buf, BytesIO):
+            digest = hashlib.sha1(buf.getvalue()).hexdigest()
+            if self.load_parsed(digest):
+                return
         try:
-            tree = self.html_parse(buf)
-            self.parse(tree)
+            if (self.parse_sandbox is not None
+                and not isinstance(buf, etree._ElementTree)):
+                self.sandbox_parse(buf)
+            else:
+                if isinstance(buf, etree._ElementTree):
+                    tree = buf
+                else:
+                    with self.timer('html_parse_seconds', self.name):
+                        tree = self.html_parse(buf)
+                with self.timer('parse_seconds', self.name):
+                    self.parse(tree)
+        except SandboxError as e:
+            raise SpiderParseError(str(e))
         except Exception as e:
             raise SpiderParseError('There is something wrong when parse the url.')
+        if digest is not None:
+            self.save_parsed(digest)
+
+    def sandbox_parse(self, buf):
+        """`html_parse()` and `parse()` the content in the parse sandbox,
+        and fill the item by the result."""
+        with self.timer('parse_seconds', self.name):
+            content = buf.getvalue() if isinstance(buf, BytesIO) else buf.read()
+            item = self.parse_sandbox.parse(self, content)
+        for key, value in item.items():
+            if key != 'url':
+                self.update_item(key, value)
+
+    @classmethod
+    def get_spider_key(cls):
+        # the spider class of the items in the parse cache
+        return '{}.{}'.format(cls.__module__, cls.__qualname__)
+
+    def load_parsed(self, digest):
+        """Fill the item by the parse cache, return True if it's found."""
+        try:
+            item = self.parse_cache.get(self.urlhash, digest,
+                self.get_spider_key(), self.version)
+        except Exception as e:
+            # parse the content if the cache is broken
+            return False
+        if item is None:
+            return False
+        for key, value in item.items():
+            if key != 'url':
+                self.update_item(key, value)
+        return True
+
+    def save_parsed(self, digest):
+        try:
+            self.parse_cache.put(self.urlhash, digest, self.get_spider_key(),
+                self.version, self.get_item())
+        except Exception as e:
+            pass
 
     def update_item(self, key, value):
         setattr(self.item, key, value)
@@ -316,18 +937,42 @@ class BaseSpider(object):
     def get_item(self):
         return self.item.to_dict()
 
+    @classmethod
+    def compiled_xpaths(cls):
+        """The XPath expressions of `xpaths` compiled once per spider class."""
+        compiled = cls.__dict__.get('_compiled_xpaths')
+        if compiled is None:
+            compiled = {name: etree.XPath(expression)
+                for name, expression in cls.xpaths.items()}
+            cls._compiled_xpaths = compiled
+        return compiled
+
+    def xpath(self, name, node):
+        """Evaluate the XPath expression `xpaths[name]` on the node."""
+        return self.compiled_xpaths()[name](node)
+
+    def parse_fields(self, tree):
+        # the fields of item are the results of their XPath expression
+        for name in self.item_fields:
+            self.update_item(name, self.xpath(name, tree))
+
     def parse(self, tree):
         # your should parse html and store results into self.item
-        pass
+        self.parse_fields(tree)
 
 
+@register_spider
 class IEEESpider(BaseSpider):
     name = 'ieee'
     host = 'ieee.org'
+    xpaths = {
+        'metadata': '//script[contains(text(), "global.document.metadata")]/text()',
+    }
+    # the full text and references follow the metadata script
+    stop_markers = (b'global.document.metadata=', b'</script>')
 
     def parse(self, tree):
-        xpath = '//script[contains(text(), "global.document.metadata")]/text()'
-        script = tree.xpath(xpath)
+        script = self.xpath('metadata', tree)
         metadata = {}
         if script:
             for line in script[0].split(';\n'):
@@ -355,101 +1000,223 @@ class IEEESpider(BaseSpider):
 
 
 
+@register_spider
 class SpringerSpider(BaseSpider):
     name = 'springer'
     host = 'springer.com'
+    xpaths = {
+        'title': '//h1[contains(@class, "ArticleTitle")]/text()',
+        'authors': '//*[@class="authors__list"]//*[@class="authors__name"]/text()',
+        'keywords': '//*[contains(@class, "KeywordGroup")]//*[contains(@class, "Keyword")]/text()',
+        'download_link': '//*[@id="article-actions"]//*[contains(@class, "download-article")]/a[1]/@href',
+        'doi_link': '//*[@id="doi-url"]/text()',
+    }
+    item_fields = ('title', 'keywords')
 
     def parse(self, tree):
-        xpath = '//h1[contains(@class, "ArticleTitle")]/text()'
-        self.update_item('title', tree.xpath(xpath))
-        xpath = '//*[@class="authors__list"]//*[@class="authors__name"]/text()'
-        authors = tree.xpath(xpath)
+        self.parse_fields(tree)
+        authors = self.xpath('authors', tree)
         authors = [html_unescape(author) for author in authors]
         self.update_item('authors', authors)
-        xpath = '//*[contains(@class, "KeywordGroup")]//*[contains(@class, "Keyword")]/text()'
-        keywords = tree.xpath(xpath)
-        self.update_item('keywords', keywords)
-        xpath = '//*[@id="article-actions"]//*[contains(@class, "download-article")]/a[1]/@href'
-        download_link = tree.xpath(xpath)
+        download_link = self.xpath('download_link', tree)
         download_link = self.urljoin(download_link[0]) if download_link else ''
         self.update_item('download_link', download_link)
-        xpath = '//*[@id="doi-url"]/text()'
-        doi_link = tree.xpath(xpath)
+        doi_link = self.xpath('doi_link', tree)
         doi_link = doi_link[0] if doi_link else ''
         self.update_item('doi_link', doi_link)
 
 
+@register_spider
 class ScienceDirectSpider(BaseSpider):
     name = 'sciencedirect'
     host = 'sciencedirect.com'
+    xpaths = {
+        'title': '//h1[contains(@class, "Head")]/*[contains(@class, "title-text")]/text()',
+        'authors': '//*[@id="author-group"]/a/span[@class="content"]',
+        # relative to the author node
+        'givenname': '*[contains(@class, "given-name")]/text()',
+        'surname': '*[contains(@class, "surname")]/text()',
+        'highlights': '//*[@id="abstracts"]/*[contains(@class, "abstract")][1]//*[contains(@class, "list")]/*[contains(@class, "list-description")]//text()',
+        'abstract': 'string(//*[@id="abstracts"]/*[contains(@class, "abstract")][2]/div)',
+        'keywords': '//*[@class="Keywords"]//*[@class="keyword"]//text()',
+        'json': '//script[@type="application/json"]/text()',
+        'doi_link': '//*[@id="doi-link"]/a[contains(@class, "doi")]/@href',
+    }
+    item_fields = ('title', 'highlights', 'abstract', 'keywords')
 
     def parse(self, tree):
-        xpath = '//h1[contains(@class, "Head")]/*[contains(@class, "title-text")]/text()'
-        self.update_item('title', tree.xpath(xpath))
-        xpath = '//*[@id="author-group"]/a/span[@class="content"]'
-        authors = tree.xpath(xpath)
+        self.parse_fields(tree)
+        authors = self.xpath('authors', tree)
         value = []
         for author in authors:
-            xpath = '*[contains(@class, "given-name")]/text()'
-            givenname = author.xpath(xpath)
+            givenname = self.xpath('givenname', author)
             givenname = givenname[0].strip() if givenname else ''
-            xpath = '*[contains(@class, "surname")]/text()'
-            surname = author.xpath(xpath)
+            surname = self.xpath('surname', author)
             surname = surname[0].strip() if surname else ''
             value.append(' '.join([givenname, surname]))
         self.update_item('authors', value)
-        xpath = '//*[@id="abstracts"]/*[contains(@class, "abstract")][1]//*[contains(@class, "list")]/*[contains(@class, "list-description")]//text()'
-        self.update_item('highlights', tree.xpath(xpath))
-        xpath = 'string(//*[@id="abstracts"]/*[contains(@class, "abstract")][2]/div)'
-        self.update_item('abstract', tree.xpath(xpath))
-        xpath = '//*[@class="Keywords"]//*[@class="keyword"]//text()'
-        self.update_item('keywords', tree.xpath(xpath))
-        xpath = '//script[@type="application/json"]/text()'
-        obj = json.loads(''.join(tree.xpath(xpath)))
+        obj = json.loads(''.join(self.xpath('json', tree)))
         date = obj.get('article', {}).get('dates', {}).get('Publication date', '')
         self.update_item('published', date)
         download_link = obj.get('article', {}).get('pdfDownload', {}).get('linkToPdf', '')
         download_link = self.urljoin(download_link) if download_link else ''
         self.update_item('download_link', download_link)
-        xpath = '//*[@id="doi-link"]/a[contains(@class, "doi")]/@href'
-        doi_link = tree.xpath(xpath)
+        doi_link = self.xpath('doi_link', tree)
         doi_link = doi_link[0] if doi_link else ''
         self.update_item('doi_link', doi_link)
 
 
+@register_spider
 class ArxivSpider(BaseSpider):
     name = 'arxiv'
     host = 'arxiv.org'
+    xpaths = {
+        'title': '//*[@id="abs"]//h1[contains(@class, "title")]/text()',
+        'authors': '//*[@id="abs"]//div[contains(@class, "authors")]/a/text()',
+        'published': '//*[@id="abs"]//div[contains(@class, "submission-history")]/b[last()]',
+        'abstract': '//*[@id="abs"]//blockquote[contains(@class, "abstract")]/text()',
+        'categories': '//*[@id="abs"]//div[contains(@class, "subheader")]/h1/text()',
+        'download_link': '//*[@id="abs"]//div[contains(@class, "extra-services")]//a[contains(@href, "pdf")]/@href',
+    }
+    item_fields = ('title', 'authors', 'abstract')
+    # the submission history is the last of the abstract block, the class
+    # name alone is also in the inline style and script of the head
+    stop_markers = (b'class="submission-history"', b'</div>')
 
     def parse(self, tree):
-        xpath = '//*[@id="abs"]//h1[contains(@class, "title")]/text()'
-        self.update_item('title', tree.xpath(xpath))
-        xpath = '//*[@id="abs"]//div[contains(@class, "authors")]/a/text()'
-        self.update_item('authors', tree.xpath(xpath))
-        xpath ='//*[@id="abs"]//div[contains(@class, "submission-history")]/b[last()]'
-        date = tree.xpath(xpath)
+        self.parse_fields(tree)
+        date = self.xpath('published', tree)
         date = date[0].tail.split('(')[0] if date else ''
         self.update_item('published', date)
-        xpath = '//*[@id="abs"]//blockquote[contains(@class, "abstract")]/text()'
-        self.update_item('abstract', tree.xpath(xpath))
-        xpath = '//*[@id="abs"]//div[contains(@class, "subheader")]/h1/text()'
-        categories = tree.xpath(xpath)
+        categories = self.xpath('categories', tree)
         categories = categories[0].split('>') if categories else []
         self.update_item('categories', categories)
-        xpath = '//*[@id="abs"]//div[contains(@class, "extra-services")]//a[contains(@href, "pdf")]/@href'
-        download_link = tree.xpath(xpath)
+        download_link = self.xpath('download_link', tree)
         download_link = self.urljoin(download_link[0]) if download_link else ''
         self.update_item('download_link', download_link)
 
 
 class SpiderFactory(object):
 
-    spiders = [SpringerSpider, ArxivSpider, ScienceDirectSpider, IEEESpider]
+    # dispatch urls to spiders by their hosts
+    registry = spider_registry
+    # the default size of thread pool used by batch pulling
+    max_workers = 8
+    # coalesce the concurrent pulls of the same url
+    single_flight = SingleFlight()
 
     @classmethod
     def create_spider(cls, url, **kwargs):
-        for spider_cls in cls.spiders:
-            if spider_cls.host_matched(url):
-                spider = spider_cls(url, **kwargs)
-                return spider
-        return None
\ No newline at end of file
+        spider_cls = cls.registry.match_url(url)
+        if spider_cls is None:
+            return None
+        return spider_cls(url, **kwargs)
+
+    @classmethod
+    def pull_spider(cls, url, data=None, timeout=20, **kwargs):
+        """Create a spider for the url and pull it.
+        Return the pulled spider, raise SpiderError if failed.
+        """
+        spider = cls.create_spider(url, **kwargs)
+        if spider is None:
+            raise SpiderError('Site [{}] is not supported yet.'.format(url))
+        if data is not None:
+            spider.pull(data=data, timeout=timeout)
+            return spider
+
+        # the concurrent pulls of the url share the item of a single pull,
+        # the pulls in other processes wait for it and then hit the cache
+        def pull():
+            spider.pull(timeout=timeout)
+            return spider.item
+        spider.item = cls.single_flight.do(spider.urlhash, pull,
+            spider.get_lock_file())[0]
+        return spider
+
+    @classmethod
+    def pull_many(cls, urls, max_workers=None, data=None, timeout=20,
+        engine='thread', **kwargs):
+        """Pull a batch of urls concurrently in a bounded thread pool.
+        
+        Yield a tuple `(url, item, error)` for each url as soon as its
+        spider is finished, `item` is the dict of the pulled `PaperItem`
+        (None if failed) and `error` is the raised exception (None if
+        succeed). The duplicated urls will be pulled only once.
+
+        :param urls: an iterable of urls.
+        :param max_workers: the max number of spiders pull at the same
+            time, default to `SpiderFactory.max_workers`.
+        :param data: same as `BaseSpider.pull()`.
+        :param timeout: same as `BaseSpider.pull()`.
+        :param engine: `thread` pulls each spider in a thread, `asyncio`
+            fetches all of urls on an event loop. It's also able to be
+            an engine instance, e.g., `engines.AsyncFetchEngine`.
+        :param kwargs: the spider attributes, see `create_spider()`.
+        """
+        urls = list(OrderedDict.fromkeys(url.strip() for url in urls if url.strip()))
+        if not urls:
+            return
+        if engine == 'asyncio':
+            from .engines import AsyncFetchEngine
+            engine = AsyncFetchEngine()
+        if engine != 'thread':
+            spiders = []
+            for url in urls:
+                spider = cls.create_spider(url, **kwargs)
+                if spider is None:
+                    yield url, None, SpiderError(
+                        'Site [{}] is not supported yet.'.format(url))
+                else:
+                    spiders.append(spider)
+            for spider, error in engine.pull_many(spiders, data, timeout):
+                item = spider.get_item() if error is None else None
+                yield spider.url, item, error
+            return
+        # the urls are taken by hosts in turn, and a host limited by the
+        # scheduler waits while the urls of other hosts are pulled
+        scheduler = kwargs.get('scheduler')
+        queue = FairQueue(scheduler)
+        for url in urls:
+            spider_cls = cls.registry.match_url(url)
+            if spider_cls is None:
+                yield url, None, SpiderError(
+                    'Site [{}] is not supported yet.'.format(url))
+            else:
+                queue.put(spider_cls.host, url)
+        if not len(queue):
+            return
+        max_workers = max_workers or cls.max_workers
+        max_workers = min(max_workers, len(queue))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            running = {}
+            while len(queue) or futures:
+                delay = None
+                while len(queue) and len(futures) < max_workers:
+                    # at most a burst of spiders wait for the same host
+                    busy = set()
+                    if scheduler is not None:
+                        busy = set(host for host, count in running.items()
+                            if count >= scheduler.get_limit(host)[1])
+                    turn = queue.next(busy)
+                    if turn is None:
+                        break
+                    host, delay = turn
+                    if delay > 0 and futures:
+                        break
+                    url = queue.get(host)
+                    future = executor.submit(cls.pull_spider, url,
+                        data=data, timeout=timeout, **kwargs)
+                    futures[future] = (url, host)
+                    running[host] = running.get(host, 0) + 1
+                    delay = None
+                done, _ = wait(futures, timeout=delay, return_when=FIRST_COMPLETED)
+                for future in done:
+                    url, host = futures.pop(future)
+                    running[host] -= 1
+                    try:
+                        spider = future.result()
+                    except Exception as e:
+                        yield url, None, e
+                    else:
+                        yield url, spider.get_item(), None
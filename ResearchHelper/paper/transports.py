@@ -0,0 +1,432 @@
+import ssl
+import time
+import base64
+import socket
+import threading
+from io import BytesIO
+from http import client as http_client
+from urllib.parse import urlsplit, urljoin, unquote
+from urllib.error import URLError, HTTPError
+from urllib.request import Request, urlopen, getproxies, proxy_bypass_environment
+
+from .archives import ArchiveRecord, open_archive
+
+
+class PooledResponse(object):
+    """A file-like response object returned by `HTTPConnectionPool.urlopen()`.
+    The connection is returned to the pool when the response is closed
+    after its content was read completely, otherwise it's closed.
+    """
+
+    def __init__(self, pool, key, conn, response, url):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.code = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.status
+
+    def info(self):
+        return self.headers
+
+    def read(self, amt=None):
+        return self.response.read(amt)
+
+    def close(self):
+        if self.conn is None:
+            return
+        conn, self.conn = self.conn, None
+        if self.response.isclosed() and not self.response.will_close:
+            # the body is consumed, the connection can be reused
+            self.pool.put_connection(self.key, conn)
+        else:
+            self.response.close()
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class HTTPConnectionPool(object):
+    """A thread-safe pool of keep-alive HTTP(S) connections per host.
+
+    It can be shared by spiders in different threads as their `transport`,
+    `urlopen()` behaves like `urllib.request.urlopen()`, i.e., it follows
+    redirections, raises `HTTPError`/`URLError`, and honours the proxies
+    of `http_proxy`, `https_proxy` and `no_proxy`. The HTTPS requests are
+    tunnelled through the proxy, so their connections are kept as well.
+    """
+
+    connection_classes = {
+        'http': http_client.HTTPConnection,
+        'https': http_client.HTTPSConnection,
+    }
+    user_agent = 'Mozilla/5.0 (compatible; ResearchHelper)'
+
+    def __init__(self, maxsize=4, idle_timeout=60, max_redirects=5, proxies=None):
+        """
+        :param maxsize: the max number of idle connections kept per host.
+        :param idle_timeout: the seconds that an idle connection will be
+            discarded after.
+        :param max_redirects: the max number of redirections to follow.
+        :param proxies: a dict of `scheme -> proxy url` and `no -> hosts`
+            like `urllib.request.getproxies()`, default to the environment.
+        """
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.max_redirects = max_redirects
+        self.proxies = getproxies() if proxies is None else dict(proxies)
+        self.ssl_context = ssl.create_default_context()
+        self.lock = threading.Lock()
+        # (scheme, host, port) -> [(connection, last used time), ...]
+        self.idle = {}
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.discarded = 0
+        self.stale = 0
+
+    def get_proxy(self, scheme, host):
+        """The tuple `(host, port, headers)` of the proxy of the host, the
+        headers authorize the proxy. None if the host isn't proxied."""
+        proxy = self.proxies.get(scheme)
+        if not proxy or proxy_bypass_environment(host, self.proxies):
+            return None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        parts = urlsplit(proxy)
+        if not parts.hostname:
+            return None
+        headers = {}
+        if parts.username is not None:
+            credentials = '{}:{}'.format(unquote(parts.username),
+                unquote(parts.password or ''))
+            headers['Proxy-Authorization'] = 'Basic {}'.format(
+                base64.b64encode(credentials.encode('utf-8')).decode('ascii'))
+        return parts.hostname, parts.port or 8080, headers
+
+    def get_connection(self, key, timeout, proxy=None):
+        """Take an idle connection of the host or create a new one, the
+        new one connects to the proxy if any.
+        Return a tuple `(connection, reused)`.
+        """
+        now = time.time()
+        conn = None
+        expired = []
+        with self.lock:
+            idle = self.idle.get(key, [])
+            while idle:
+                candidate, last_used = idle.pop()
+                if now - last_used > self.idle_timeout:
+                    expired.append(candidate)
+                    continue
+                conn = candidate
+                break
+            self.expired += len(expired)
+            if conn is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        for candidate in expired:
+            candidate.close()
+
+        if conn is not None:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            return conn, True
+
+        scheme, host, port = key
+        kwargs = {'timeout': timeout}
+        if scheme == 'https':
+            kwargs['context'] = self.ssl_context
+        if proxy is None:
+            conn = self.connection_classes[scheme](host, port, **kwargs)
+        elif scheme == 'https':
+            # the TLS connection to the host in the tunnel of the proxy
+            conn = self.connection_classes[scheme](proxy[0], proxy[1], **kwargs)
+            conn.set_tunnel(host, port, headers=proxy[2])
+        else:
+            conn = self.connection_classes[scheme](proxy[0], proxy[1], **kwargs)
+        return conn, False
+
+    def put_connection(self, key, conn):
+        """Return a connection to the pool."""
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append((conn, time.time()))
+                return
+            self.discarded += 1
+        conn.close()
+
+    def clear(self):
+        """Close all of idle connections."""
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for conn, last_used in conns:
+                conn.close()
+
+    def stats(self):
+        """The statistics of the pool."""
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / requests if requests else 0.0,
+                'expired': self.expired,
+                'discarded': self.discarded,
+                'stale': self.stale,
+                'idle': {'{}://{}:{}'.format(*key): len(conns)
+                    for key, conns in self.idle.items() if conns},
+            }
+
+    def send(self, url, data, headers, timeout):
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in self.connection_classes or not parts.hostname:
+            raise URLError('unknown url type: {}'.format(url))
+        port = parts.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path = '{}?{}'.format(path, parts.query)
+        headers = dict(headers or {})
+        proxy = self.get_proxy(scheme, parts.hostname)
+        if proxy is not None and scheme == 'http':
+            # the proxy takes the absolute url
+            path = '{}://{}:{}{}'.format(scheme, parts.hostname, port, path)
+            headers.update(proxy[2])
+        headers.setdefault('User-Agent', self.user_agent)
+        headers.setdefault('Connection', 'keep-alive')
+        headers.setdefault('Accept-Encoding', 'identity')
+        if data is not None:
+            headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+        method = 'GET' if data is None else 'POST'
+
+        while True:
+            conn, reused = self.get_connection(key, timeout, proxy)
+            try:
+                conn.request(method, path, body=data, headers=headers)
+                response = conn.getresponse()
+            except socket.timeout:
+                conn.close()
+                raise
+            except (http_client.HTTPException, OSError) as e:
+                conn.close()
+                if reused:
+                    # the server closed the idle connection, try a new one
+                    with self.lock:
+                        self.stale += 1
+                    continue
+                raise URLError(e)
+            return PooledResponse(self, key, conn, response, url)
+
+    def urlopen(self, url, data=None, headers=None, timeout=20):
+        """Open the url with a pooled connection.
+
+        :param url: the url.
+        :param data: the bytes of POST request body, None means GET.
+        :param headers: the extra request headers.
+        :param timeout: the socket timeout.
+        """
+        for i in range(self.max_redirects + 1):
+            response = self.send(url, data, headers, timeout)
+            location = response.headers.get('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                response.read()
+                response.close()
+                url = urljoin(url, location)
+                if response.status in (301, 302, 303):
+                    data = None
+                continue
+            if response.status >= 400:
+                fp = BytesIO(response.read())
+                response.close()
+                raise HTTPError(url, response.status, response.reason,
+                    response.headers, fp)
+            return response
+        raise HTTPError(url, response.status, 'Too many redirections.',
+            response.headers, None)
+
+
+def make_headers(items):
+    headers = http_client.HTTPMessage()
+    for name, value in items:
+        headers[name] = value
+    return headers
+
+
+class ArchiveResponse(object):
+    """A file-like response object of an archived record."""
+
+    def __init__(self, record):
+        self.url = record.url
+        self.status = record.status
+        self.code = record.status
+        self.reason = record.reason
+        self.headers = make_headers(record.headers)
+        self.fp = BytesIO(record.body)
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.status
+
+    def info(self):
+        return self.headers
+
+    def read(self, amt=None):
+        return self.fp.read(amt)
+
+    def close(self):
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_record(record):
+    """Return the response of the record, or raise `HTTPError` as
+    `urlopen()` does."""
+    if record.status >= 400:
+        raise HTTPError(record.url, record.status, record.reason,
+            make_headers(record.headers), BytesIO(record.body))
+    return ArchiveResponse(record)
+
+
+class ReplayTransport(object):
+    """Serve the responses of spiders from a WARC or HAR archive without
+    touching the network, so the pulls are reproducible, e.g., for the
+    benchmarks. The url not in the archive raises `URLError`.
+
+    The responses are looked up by urls, the request body is ignored.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.records = {}
+        # the later record of a url wins, like a re-recorded one
+        for record in open_archive(path):
+            self.records[record.url] = record
+        self.hits = 0
+        self.misses = 0
+
+    def urlopen(self, url, data=None, headers=None, timeout=20):
+        record = self.records.get(url)
+        with self.lock:
+            if record is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if record is None:
+            raise URLError('{} is not in the archive {}'.format(url, self.path))
+        return open_record(record)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'mode': 'replay',
+                'records': len(self.records),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+class RecordTransport(object):
+    """Fetch the responses of spiders by the live transport and append
+    them into a WARC or HAR archive, which is replayed by
+    `ReplayTransport` later.
+
+    The conditional request headers are dropped, so the archive always
+    has the full responses instead of `304 Not Modified`.
+    """
+
+    conditional_headers = ('if-none-match', 'if-modified-since')
+    # the body is recorded as it's decoded, so are not its headers
+    skipped_headers = ('transfer-encoding', 'content-length', 'connection')
+
+    def __init__(self, path, transport=None):
+        """
+        :param path: the filename of archive, see `archives.open_archive()`.
+        :param transport: the live transport, e.g., `HTTPConnectionPool`,
+            None means urllib is used.
+        """
+        self.path = path
+        self.archive = open_archive(path)
+        self.transport = transport
+        self.lock = threading.Lock()
+        self.recorded = 0
+
+    def fetch(self, url, data, headers, timeout):
+        if self.transport is None:
+            return urlopen(Request(url, data=data, headers=headers),
+                timeout=timeout)
+        return self.transport.urlopen(url, data=data, headers=headers,
+            timeout=timeout)
+
+    def record(self, url, response):
+        body = response.read()
+        items = [(name, value) for name, value in response.headers.items()
+            if name.lower() not in self.skipped_headers]
+        items.append(('Content-Length', str(len(body))))
+        record = ArchiveRecord(url=url, status=response.code,
+            reason=response.reason or '', headers=items, body=body, date=None)
+        self.archive.append(record)
+        with self.lock:
+            self.recorded += 1
+        return record
+
+    def urlopen(self, url, data=None, headers=None, timeout=20):
+        headers = {name: value for name, value in (headers or {}).items()
+            if name.lower() not in self.conditional_headers}
+        try:
+            response = self.fetch(url, data, headers, timeout)
+        except HTTPError as e:
+            if e.fp is None:
+                raise
+            try:
+                record = self.record(url, e)
+            finally:
+                e.close()
+        else:
+            with response:
+                record = self.record(url, response)
+        return open_record(record)
+
+    def stats(self):
+        with self.lock:
+            stats = {'mode': 'record', 'recorded': self.recorded}
+        if self.transport is not None and hasattr(self.transport, 'stats'):
+            stats['transport'] = self.transport.stats()
+        return stats
+
+
+def get_live_transport(transport):
+    """The transport fetches from the network, i.e., the one wrapped by
+    `RecordTransport`, or None(urllib) instead of `ReplayTransport`, e.g.,
+    the downloads of PDFs are neither recorded nor replayed."""
+    if isinstance(transport, RecordTransport):
+        return transport.transport
+    if isinstance(transport, ReplayTransport):
+        return None
+    return transport
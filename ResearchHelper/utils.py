@@ -91,4 +91,21 @@ def comma_separated_string_split(value=''):
     output = StringIO(value)
     reader = csv.reader(output, 
         delimiter=',', quotechar='"', quoting=csv.QUOTE_ALL)
-    return next(reader)
\ No newline at end of file
+    return next(reader)
+
+size_units = ['B', 'K', 'M', 'G', 'T']
+
+def parse_size(value):
+    """Convert a human readable size string(e.g. `512M`, `2G`) to bytes."""
+    value = str(value).strip().upper().rstrip('B') or '0'
+    if value[-1] in size_units:
+        return int(float(value[:-1]) * 1024 ** size_units.index(value[-1]))
+    return int(float(value))
+
+def format_size(size):
+    """Convert bytes to a human readable size string."""
+    for unit in size_units[:-1]:
+        if abs(size) < 1024:
+            return '{:.1f}{}'.format(size, unit)
+        size = size / 1024
+    return '{:.1f}{}'.format(size, size_units[-1])
@@ -0,0 +1,89 @@
+"""Compare parsing the published dates of papers with `dates.DateNormalizer`
+to parsing them with `dateutil`, which is what `PaperItem.published` did.
+
+Usage: python benchmarks/bench_dates.py [FILE] [-n NUMBER]
+
+FILE contains the dates to parse, one per line, optionally prefixed with
+the name of spider and a tab, e.g., `arxiv<TAB>Mon, 1 Jan 2018`. The dates
+in the common formats of publishers are used if it's not given.
+"""
+import argparse
+import timeit
+
+from dateutil import parser as date_parser
+
+from ResearchHelper import create_app
+
+
+samples = [
+    ('sciencedirect', '1 January 2018'),
+    ('sciencedirect', '15 March 2017'),
+    ('sciencedirect', 'September 2016'),
+    ('arxiv', 'Mon, 1 Jan 2018 00:00:00 UTC'),
+    ('arxiv', 'Tue, 13 Feb 2018 18:21:09 GMT'),
+    ('ieee', 'Jan. 12, 2018'),
+    ('ieee', 'December 5, 2017'),
+    ('springer', '2018-01-02'),
+    ('springer', '2017-11-30T10:00:00Z'),
+    ('springer', '2016'),
+]
+
+
+def read_samples(filename):
+    with open(filename, 'r', encoding='utf-8') as f:
+        lines = [line.rstrip('\n') for line in f if line.strip()]
+    return [tuple(line.split('\t', 1)) if '\t' in line else (None, line)
+        for line in lines]
+
+
+def dateutil_parse(text):
+    # the former `PaperItem.published` setter
+    try:
+        return date_parser.parse(str(text))
+    except Exception as e:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('file', nargs='?')
+    parser.add_argument('-n', '--number', type=int, default=2000)
+    args = parser.parse_args()
+
+    with create_app().app_context():
+        from ResearchHelper.paper.dates import DateNormalizer
+
+        dates = read_samples(args.file) if args.file else samples
+        normalizer = DateNormalizer()
+
+        def baseline():
+            for key, text in dates:
+                dateutil_parse(text)
+
+        def normalized():
+            for key, text in dates:
+                normalizer.parse(text, key)
+
+        results = [min(timeit.repeat(func, number=args.number, repeat=3))
+            for func in (baseline, normalized)]
+        print('{} dates: dateutil {:.3f}s, normalizer {:.3f}s, speedup {:.2f}x'.format(
+            len(dates), results[0], results[1], results[0] / results[1]))
+
+        formats = {}
+        for key, text in dates:
+            result = normalizer.parse(text, key)
+            name = result.format or 'unparseable'
+            formats[name] = formats.get(name, 0) + 1
+            # the time zones are ignored by the normalizer
+            expected = dateutil_parse(text)
+            if expected is not None:
+                expected = expected.replace(tzinfo=None)
+            if result.value != expected:
+                print('differs: {!r} -> {}, dateutil {}'.format(
+                    text, result.value, expected))
+        print(', '.join('{}: {}'.format(name, count)
+            for name, count in sorted(formats.items())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Measure the throughput of the full pull-parse-store path of spiders,
+the responses are replayed from an archive, so the results don't depend
+on the network or the publishers.
+
+Usage: python benchmarks/bench_replay.py ARCHIVE [-n NUMBER] [-w WORKERS]
+
+ARCHIVE is a WARC(`.warc`, `.warc.gz`) or HAR(`.har`) file, e.g., the one
+recorded with `spider_transport_mode = 'record'`. The urls without a
+spider are skipped.
+"""
+import sys
+import time
+import tempfile
+import argparse
+
+from ResearchHelper import create_app
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('archive')
+    parser.add_argument('-n', '--number', type=int, default=3)
+    parser.add_argument('-w', '--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    dirname = tempfile.mkdtemp()
+    app = create_app({
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///{}/db.sqlite3'.format(dirname),
+    })
+    with app.app_context():
+        from ResearchHelper.db import db
+        from ResearchHelper.paper.models import Source
+        from ResearchHelper.paper.spiders import SpiderFactory
+        from ResearchHelper.paper.transports import ReplayTransport
+
+        db.create_all()
+        transport = ReplayTransport(args.archive)
+        urls = [url for url in transport.records
+            if SpiderFactory.registry.match_url(url) is not None]
+        if not urls:
+            print('no url of spiders in the archive', file=sys.stderr)
+            return
+        # no cache, no rate limit, every pull parses the replayed response
+        options = {'cache_enabled': False, 'transport': transport}
+        for i in range(args.number):
+            start = time.time()
+            errors = 0
+            results = SpiderFactory.pull_many(urls,
+                max_workers=args.workers, **options)
+            for url, item, error in results:
+                if error is not None:
+                    errors += 1
+                    continue
+                try:
+                    Source.update_or_create(**item)
+                except Exception as e:
+                    db.session.rollback()
+                    errors += 1
+            elapsed = time.time() - start
+            print('round {}: {} urls, {} errors, {:.3f}s, {:.1f} urls/s'.format(
+                i + 1, len(urls), errors, elapsed, len(urls) / elapsed))
+
+
+if __name__ == '__main__':
+    main()
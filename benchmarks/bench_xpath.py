@@ -0,0 +1,98 @@
+"""Compare parsing with the precompiled XPath expressions of spiders to
+parsing with XPath strings.
+
+Usage: python benchmarks/bench_xpath.py [DIRECTORY] [-n NUMBER]
+
+DIRECTORY contains the recorded pages named `<spider name>*.html`, e.g.
+`sciencedirect-1.html`, synthetic pages are used if it's not given.
+"""
+import os
+import sys
+import argparse
+import timeit
+
+from lxml import etree
+
+from ResearchHelper import create_app
+
+
+def synthetic_pages():
+    authors = ''.join(
+        '<a><span class="content"><span class="given-name">Given{0}</span> '
+        '<span class="surname">Surname{0}</span></span></a>'.format(i)
+        for i in range(20))
+    keywords = ''.join(
+        '<div class="keyword"><span>keyword {}</span></div>'.format(i)
+        for i in range(10))
+    sciencedirect = (
+        '<html><body><h1 class="Head"><span class="title-text">Title</span></h1>'
+        '<div id="author-group">{}</div>'
+        '<div id="abstracts"><div class="abstract"><ul class="list">'
+        '<li class="list-description"><p>highlight</p></li></ul></div>'
+        '<div class="abstract"><div>abstract</div></div></div>'
+        '<div class="Keywords">{}</div>'
+        '<div id="doi-link"><a class="doi" href="https://doi.org/10.1/x">doi</a></div>'
+        '<script type="application/json">{{"article": {{}}}}</script>'
+        '</body></html>').format(authors, keywords)
+    arxiv = (
+        '<html><body><div id="abs"><div class="subheader"><h1>cs &gt; AI</h1></div>'
+        '<h1 class="title">Title</h1><div class="authors">{}</div>'
+        '<blockquote class="abstract">abstract</blockquote>'
+        '<div class="extra-services"><a href="/pdf/1">pdf</a></div>'
+        '<div class="submission-history"><b>v1</b> Mon, 1 Jan 2018 (1 KB)</div>'
+        '</div></body></html>').format(''.join(
+            '<a>Author {}</a>'.format(i) for i in range(20)))
+    return {'sciencedirect': [sciencedirect], 'arxiv': [arxiv]}
+
+
+def recorded_pages(directory):
+    pages = {}
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.html'):
+            continue
+        with open(os.path.join(directory, filename), 'rb') as f:
+            pages.setdefault(filename.split('-')[0].split('.')[0], []).append(f.read())
+    return pages
+
+
+def uncompiled(spider_class):
+    """A subclass of the spider evaluating XPath strings on each call."""
+    def xpath(self, name, node):
+        return node.xpath(self.xpaths[name])
+    return type('Uncompiled' + spider_class.__name__, (spider_class,), {'xpath': xpath})
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directory', nargs='?')
+    parser.add_argument('-n', '--number', type=int, default=1000)
+    args = parser.parse_args()
+
+    with create_app().app_context():
+        from ResearchHelper.paper.spiders import SpiderFactory
+
+        pages = recorded_pages(args.directory) if args.directory else synthetic_pages()
+        spiders = {spider.name: spider for spider in SpiderFactory.registry.spiders}
+        for name, contents in sorted(pages.items()):
+            if name not in spiders:
+                print('{}: no such spider, skipped'.format(name), file=sys.stderr)
+                continue
+            html_parser = etree.HTMLParser(encoding='utf-8')
+            trees = [etree.fromstring(content, html_parser).getroottree()
+                for content in contents]
+            results = []
+            for spider_class in (uncompiled(spiders[name]), spiders[name]):
+                spider = spider_class('http://{}/'.format(spider_class.host),
+                    cache_enabled=False)
+
+                def parse():
+                    for tree in trees:
+                        spider.parse(tree)
+
+                results.append(min(timeit.repeat(parse, number=args.number, repeat=3)))
+            print('{}: {} pages, string {:.3f}s, compiled {:.3f}s, speedup {:.2f}x'.format(
+                name, len(trees), results[0], results[1], results[0] / results[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -29,6 +29,9 @@ setup(
             'pytest',
             'coverage',
         ],
+        'async': [
+            'aiohttp',
+        ],
     },
     setup_requires=[
         "pytest-runner"
@@ -119,4 +119,125 @@ def test_get_invitation_command(runner, monkeypatch):
     Recorder.called = False
     result = runner.invoke(args=['invitation', 'get', '--count', 10])
     assert Recorder.called
-    assert Recorder.count == 10
\ No newline at end of file
+    assert Recorder.count == 10
+
+
+def test_gc_spider_cache_command(runner, monkeypatch):
+    class Recorder(object):
+        called = False
+        quota = -1
+        dry_run = None
+
+    def fake_gc_spider_cache(quota, dry_run):
+        Recorder.called = True
+        Recorder.quota = quota
+        Recorder.dry_run = dry_run
+        return {'accesses': 0, 'size': 100, 'evicted': 1,
+            'evicted_size': 10, 'swept': 0, 'swept_size': 0}
+
+    monkeypatch.setattr(cli, 'gc_spider_cache', fake_gc_spider_cache)
+    monkeypatch.setattr(cli, 'purge_parse_cache', lambda: 3)
+
+    result = runner.invoke(args=['paper', 'cache', 'gc'])
+    assert 'evicted' in result.output
+    assert '3 parsed items' in result.output
+    assert Recorder.called
+    assert Recorder.quota is None
+    assert not Recorder.dry_run
+
+    Recorder.called = False
+    result = runner.invoke(args=[
+        'paper', 'cache', 'gc', '--quota', '1K', '--dry-run'])
+    assert 'going to be evicted' in result.output
+    assert 'parsed items' not in result.output
+    assert Recorder.called
+    assert Recorder.quota == 1024
+    assert Recorder.dry_run
+
+
+def test_spider_cache_stats_command(runner, monkeypatch):
+    class Recorder(object):
+        called = False
+        quota = -1
+
+    def fake_get_spider_cache_stats(quota):
+        Recorder.called = True
+        Recorder.quota = quota
+        return {'units': 3, 'size': 100, 'quota': 1024, 'usage': 100 / 1024,
+            'oldest_access': None, 'newest_access': None,
+            'access_log_size': 0}
+
+    monkeypatch.setattr(cli, 'get_spider_cache_stats',
+        fake_get_spider_cache_stats
+    )
+
+    result = runner.invoke(args=['paper', 'cache', 'stats'])
+    assert 'entries: 3' in result.output
+    assert Recorder.called
+    assert Recorder.quota is None
+
+def test_pull_worker_command(runner, monkeypatch):
+    class Recorder(object):
+        called = False
+        burst = None
+        limit = None
+
+    def fake_run_pull_worker(burst, interval, limit):
+        Recorder.called = True
+        Recorder.burst = burst
+        Recorder.limit = limit
+        return 3
+
+    monkeypatch.setattr(cli, 'run_pull_worker', fake_run_pull_worker)
+
+    result = runner.invoke(args=['paper', 'worker', '--burst', '--limit', '5'])
+    assert '3 pull jobs are done.' in result.output
+    assert Recorder.called
+    assert Recorder.burst
+    assert Recorder.limit == 5
+
+def test_reparse_spider_cache_command(runner, monkeypatch):
+    class Recorder(object):
+        called = False
+        restart = None
+
+    def fake_reparse_spider_cache(processes, batch_size, restart, progress):
+        Recorder.called = True
+        Recorder.restart = restart
+        state = {'parsed': 2, 'failed': 1, 'skipped': 0,
+            'created': 1, 'updated': 1, 'incomplete': 0}
+        progress(state)
+        return state
+
+    monkeypatch.setattr(cli, 'reparse_spider_cache', fake_reparse_spider_cache)
+
+    result = runner.invoke(args=['paper', 'reparse', '--restart'])
+    assert '2 parsed, 1 failed, 0 skipped.' in result.output
+    assert '1 sources are created, 1 updated, 0 incomplete.' in result.output
+    assert Recorder.called
+    assert Recorder.restart
+
+def test_import_paper_urls_command(runner, monkeypatch, tmpdir):
+    class Recorder(object):
+        urls = None
+        username = None
+
+    def fake_import_paper_urls(lines, username, batch_size, progress):
+        Recorder.urls = [line.strip() for line in lines]
+        Recorder.username = username
+        result = {'urls': 2, 'duplicated': 0, 'existing': 0, 'pulled': 1,
+            'incomplete': 0, 'created': 1, 'seconds': 0.5,
+            'failures': [('http://fake.test/broken', 'broken')]}
+        progress(result)
+        return result
+
+    monkeypatch.setattr(cli, 'import_paper_urls', fake_import_paper_urls)
+
+    path = tmpdir.join('urls.txt')
+    path.write('http://fake.test/1\nhttp://fake.test/broken\n')
+    result = runner.invoke(args=['paper', 'import', str(path), '--user', 'test'])
+    assert Recorder.urls == ['http://fake.test/1', 'http://fake.test/broken']
+    assert Recorder.username == 'test'
+    assert '2 urls in 0.5s (4.0 urls/s), 1 pulled' in result.output
+    assert '1 failed.' in result.output
+    assert 'http://fake.test/broken: broken' in result.output
@@ -0,0 +1,566 @@
+import os
+import json
+import hashlib
+import datetime
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+import pytest
+
+from ResearchHelper.db import db
+from ResearchHelper.models import User
+
+
+# The paper package can be imported only after the app is created, so
+# it's loaded via the `app` fixture.
+@pytest.fixture
+def paper(app, monkeypatch):
+    from ResearchHelper.paper import spiders, jobs, models
+
+    class FakeSpider(spiders.BaseSpider):
+        name = 'fake'
+        host = 'fake.test'
+
+        def pull(self, data=None, timeout=20):
+            if self.url.endswith('/broken'):
+                raise spiders.SpiderParseError('broken')
+            self.update_item('title', 'Title of ' + self.url)
+            self.update_item('abstract', 'abstract')
+
+    monkeypatch.setattr(spiders.SpiderFactory, 'registry',
+        spiders.SpiderRegistry([FakeSpider]))
+    with app.app_context():
+        user = User(username='puller', password='puller', email='puller@test.com')
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+    return models, jobs, user_id
+
+
+class PdfHandler(BaseHTTPRequestHandler):
+    """Serve `/<name>.pdf` as a PDF which supports `Range` requests, its
+    ETag is `server.etag`, and `/<name>.html` as a page."""
+    protocol_version = 'HTTP/1.1'
+    content = b'%PDF-1.4\n' + bytes(range(256)) * 64
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        if not self.path.endswith('.pdf'):
+            self.send_body(200, b'<html>login</html>', {})
+            return
+        headers = {'ETag': self.server.etag}
+        body = self.content
+        ranged = self.headers.get('Range')
+        if ranged and self.headers.get('If-Range', self.server.etag) == self.server.etag:
+            start = int(ranged.split('=')[1].rstrip('-'))
+            if start >= len(body):
+                headers['Content-Range'] = 'bytes */{}'.format(len(body))
+                self.send_body(416, b'', headers)
+                return
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+                start, len(body) - 1, len(body))
+            self.send_body(206, body[start:], headers)
+            return
+        self.send_body(200, body, headers)
+
+    def send_body(self, code, body, headers):
+        self.send_response(code)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class PdfServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def pdf_server():
+    server = PdfServer(('127.0.0.1', 0), PdfHandler)
+    server.requests = []
+    server.etag = '"v1"'
+    server.url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def login(client, user_id):
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+
+
+def test_pull_job(app, client, paper):
+    models, jobs, user_id = paper
+    login(client, user_id)
+    headers = {'Accept': 'application/json'}
+
+    response = client.post('/paper/', data={'link': 'http://fake.test/1'},
+        headers=headers)
+    job = response.get_json()['data']['job']
+    assert job['status'] == 'pending'
+    assert job['source_id'] is None
+    response = client.post('/paper/', data={'link': 'http://fake.test/broken'})
+    assert response.status_code == 302
+    broken_id = job['id'] + 1
+    response = client.get('/paper/api/jobs/{}'.format(broken_id))
+    assert response.get_json()['data']['job']['position'] == 1
+
+    # the unsupported site is rejected at once
+    response = client.post('/paper/', data={'link': 'http://unknown.test/1'},
+        headers=headers)
+    assert b'not supported' in response.data
+
+    with app.app_context():
+        assert jobs.work(burst=True) == 2
+        assert jobs.work(burst=True) == 0
+
+    data = client.get('/paper/api/jobs/{}'.format(job['id'])).get_json()['data']
+    assert data['job']['status'] == 'done'
+    assert data['job']['attempts'] == 1
+    source_id = data['job']['source_id']
+    assert data['job']['redirect'].endswith('/metadata/{}/update'.format(source_id))
+    data = client.get('/paper/api/jobs/{}'.format(broken_id)).get_json()['data']
+    assert data['job']['status'] == 'failed'
+    assert 'broken' in data['job']['error']
+    with app.app_context():
+        source = models.Source.query.get(source_id)
+        assert source.title == 'Title of http://fake.test/1'
+        assert models.Metadata.query.filter_by(user_id=user_id).count() == 1
+
+    # the jobs of others are invisible
+    with app.app_context():
+        other = User(username='other', password='other', email='other@test.com')
+        db.session.add(other)
+        db.session.commit()
+        login(client, other.id)
+    assert client.get('/paper/api/jobs/{}'.format(job['id'])).status_code == 404
+
+
+def test_batch_jobs(app, client, paper):
+    models, jobs, user_id = paper
+    login(client, user_id)
+    links = 'http://fake.test/1\n\nhttp://fake.test/broken\nhttp://fake.test/1\n'
+
+    # the links are submitted as jobs, not pulled in the request
+    response = client.post('/paper/batch', data={'links': links},
+        headers={'Accept': 'application/json'})
+    submitted = response.get_json()['data']['jobs']
+    assert [job['url'] for job in submitted] == [
+        'http://fake.test/1', 'http://fake.test/broken']
+    assert all(job['status'] == 'pending' for job in submitted)
+    with app.app_context():
+        assert models.Source.query.count() == 0
+
+    response = client.post('/paper/batch', data={'links': 'http://fake.test/2'})
+    assert response.status_code == 302
+    assert 'jobs=' in response.headers['Location']
+    with app.app_context():
+        assert jobs.work(burst=True) == 3
+
+    job_ids = ','.join(str(job['id']) for job in submitted)
+    response = client.get('/paper/batch?jobs=' + job_ids)
+    assert response.status_code == 200
+    for job in submitted:
+        assert '/paper/api/jobs/{}'.format(job['id']).encode() in response.data
+    assert client.get('/paper/batch?jobs=999').status_code == 404
+
+
+def test_pull_job_claim(app, paper):
+    models, jobs, user_id = paper
+    PullJob = models.PullJob
+    with app.app_context():
+        user = User.query.get(user_id)
+        first = PullJob.submit('http://fake.test/1', user)
+        second = PullJob.submit('http://fake.test/2', user)
+        assert PullJob.claim('a').id == first.id
+        assert PullJob.claim('b').id == second.id
+        assert PullJob.claim('c') is None
+
+        # the job abandoned by its worker is claimed again
+        first.started = datetime.datetime.utcnow() - datetime.timedelta(seconds=600)
+        db.session.commit()
+        job = PullJob.claim('c', lease=300)
+        assert job.id == first.id
+        assert job.worker == 'c'
+        assert job.attempts == 2
+
+        # until it's abandoned too many times
+        job.started = datetime.datetime.utcnow() - datetime.timedelta(seconds=600)
+        db.session.commit()
+        assert PullJob.claim('d', lease=300, max_attempts=2) is None
+        assert PullJob.query.get(first.id).status == 'failed'
+
+
+def test_api_spiders(app, client, paper):
+    models, jobs, user_id = paper
+    login(client, user_id)
+    breakers = app.extensions['spider_breakers']
+    breakers.record('ieee.org', True)
+    data = client.get('/paper/api/spiders').get_json()['data']
+    assert data['breakers']['ieee.org']['state'] == 'closed'
+    assert data['breakers']['ieee.org']['error_rate'] == 1.0
+    assert 'hit_ratio' in data['transport']
+    assert 'throttled' in data['scheduler']
+
+
+def test_metrics(app, client, paper, tmpdir):
+    from ResearchHelper.paper.config import get_spider_metrics_folder
+    from ResearchHelper.paper.metrics import MetricsRegistry, MetricsPublisher
+
+    models, jobs, user_id = paper
+    app.instance_path = str(tmpdir)
+    assert client.get('/paper/metrics').status_code == 302
+    login(client, user_id)
+    metrics = app.extensions['spider_metrics']
+    metrics.inc('cache_hit', 'ieee.org')
+    metrics.inc('cache_miss', 'ieee.org')
+    metrics.observe('fetch_seconds', 'ieee.org', 0.3)
+    data = client.get('/paper/metrics').get_json()['data']
+    assert data['counters']['cache_hit'] == {'ieee.org': 1}
+    assert data['cache_hit_ratio'] == {'ieee.org': 0.5}
+    fetch = data['histograms']['fetch_seconds']['ieee.org']
+    assert fetch['count'] == 1
+    assert fetch['p50'] == 0.5
+    assert 'hit_ratio' in data['transport']
+    assert 'throttled' in data['scheduler']
+    assert data['workers'] == {}
+
+    # the metrics published by the workers are merged
+    registry = MetricsRegistry()
+    registry.inc('cache_miss', 'ieee.org', 2)
+    registry.observe('fetch_seconds', 'ieee.org', 3)
+    publisher = MetricsPublisher(get_spider_metrics_folder(app), '1@worker',
+        registry, stats=lambda: {'breakers': {'ieee.org': {'state': 'open'}}})
+    assert publisher.publish()
+    assert not publisher.publish()
+    data = client.get('/paper/metrics').get_json()['data']
+    assert data['counters']['cache_miss'] == {'ieee.org': 3}
+    assert data['cache_hit_ratio'] == {'ieee.org': 0.25}
+    fetch = data['histograms']['fetch_seconds']['ieee.org']
+    assert fetch['count'] == 2
+    assert fetch['max'] == 3
+    worker = data['workers']['1@worker']
+    assert worker['breakers']['ieee.org']['state'] == 'open'
+    assert worker['pid'] == os.getpid()
+
+    # the worker publishes its metrics when it quits
+    with app.app_context():
+        jobs.work(burst=True, worker='2@worker')
+    data = client.get('/paper/metrics').get_json()['data']
+    assert set(data['workers']) == {'1@worker', '2@worker'}
+    assert 'breakers' in data['workers']['2@worker']
+
+    # the snapshots of the workers quit long ago are removed
+    path = os.path.join(get_spider_metrics_folder(app), '1@worker.json')
+    os.utime(path, (0, 0))
+    data = client.get('/paper/metrics').get_json()['data']
+    assert set(data['workers']) == {'2@worker'}
+    assert not os.path.exists(path)
+
+
+@pytest.mark.parametrize('store', ['file', 'compressed', 'sqlite'])
+def test_reparse(app, paper, tmpdir, monkeypatch, store):
+    models, jobs, user_id = paper
+    from ResearchHelper.paper import spiders
+    from ResearchHelper.paper.caches import create_cache_store
+    from ResearchHelper.paper.reparse import Checkpoint, reparse
+
+    class PageSpider(spiders.BaseSpider):
+        name = 'page'
+        host = 'page.test'
+
+        def parse(self, tree):
+            if tree.xpath('//p[@class="broken"]'):
+                raise ValueError('broken')
+            self.update_item('title', tree.xpath('string(//h1)'))
+            self.update_item('abstract', tree.xpath('string(//p)'))
+
+    monkeypatch.setattr(spiders.SpiderFactory, 'registry',
+        spiders.SpiderRegistry([PageSpider]))
+    cache_store = create_cache_store(store, str(tmpdir.join('cache')))
+    pages = {'http://page.test/{}'.format(i):
+        '<h1>Title {0}</h1><p>abstract {0}</p>'.format(i) for i in range(5)}
+    pages['http://page.test/broken'] = '<h1>Broken</h1><p class="broken">x</p>'
+    pages['http://page.test/incomplete'] = '<h1>Incomplete</h1>'
+    pages['http://unknown.test/1'] = '<h1>Unknown</h1><p>abstract</p>'
+    for url, page in pages.items():
+        spider = PageSpider(url)
+        cache_store.put(spider.urlhash, page.encode('utf-8'), {'url': url})
+    with app.app_context():
+        models.Source.update_or_create(url='http://page.test/0',
+            title='Old title', abstract='old abstract')
+
+    # the reparse is interrupted after the first batch
+    class Interrupted(Exception):
+        pass
+
+    def interrupt(state):
+        raise Interrupted()
+
+    checkpoint = Checkpoint(str(tmpdir.join('reparse.json')))
+    with app.app_context():
+        with pytest.raises(Interrupted):
+            reparse(cache_store, checkpoint, processes=2, batch_size=3,
+                progress=interrupt)
+        first = checkpoint.load()
+        assert sum(first[name] for name in ('parsed', 'failed', 'skipped')) == 3
+
+        state = reparse(cache_store, checkpoint, processes=2, batch_size=3)
+        assert state['parsed'] == 6
+        assert state['failed'] == 1
+        assert state['skipped'] == 1
+        assert state['incomplete'] == 1
+        assert state['created'] + state['updated'] == 5
+        assert not os.path.exists(checkpoint.path)
+
+        assert models.Source.query.count() == 5
+        source = models.Source.query.filter_by(url='http://page.test/0').one()
+        assert source.title == 'Title 0'
+        assert source.abstract == 'abstract 0'
+        assert source.pull_count == 1
+
+
+def test_import_urls(app, paper):
+    models, jobs, user_id = paper
+    from ResearchHelper.paper.imports import import_urls
+
+    lines = [
+        '# reading list\n',
+        'http://fake.test/1\n',
+        '\n',
+        'http://fake.test/2\n',
+        'http://fake.test/1\n',
+        'http://fake.test/broken\n',
+        'http://unknown.test/1\n',
+        'http://fake.test/3\n',
+    ]
+    batches = []
+    with app.app_context():
+        models.Source.update_or_create(url='http://fake.test/3',
+            title='Existing', abstract='abstract')
+        user = User.query.get(user_id)
+        result = import_urls(lines, user, {}, batch_size=2,
+            progress=lambda result: batches.append(result['urls']))
+        assert batches == [2, 4, 5]
+        assert result['urls'] == 5
+        assert result['duplicated'] == 1
+        assert result['existing'] == 1
+        assert result['pulled'] == 2
+        assert result['created'] == 3
+        assert sorted(url for url, error in result['failures']) == [
+            'http://fake.test/broken', 'http://unknown.test/1']
+
+        assert models.Source.query.count() == 3
+        source = models.Source.query.filter_by(url='http://fake.test/3').one()
+        assert source.title == 'Existing'
+        assert source.pull_count == 1
+        source = models.Source.query.filter_by(url='http://fake.test/1').one()
+        assert source.pull_count == 1
+        assert models.Metadata.query.filter_by(user_id=user_id).count() == 3
+
+        # imported again, nothing is pulled or added
+        result = import_urls(lines[:4], user, {})
+        assert result['existing'] == 2
+        assert result['pulled'] == 0
+        assert result['created'] == 0
+
+
+def test_download_resume(app, paper, pdf_server, tmpdir):
+    from ResearchHelper.paper.downloads import Download, DownloadError
+    content = PdfHandler.content
+    fingerprint = hashlib.md5(content).hexdigest()
+    url = pdf_server.url + '/paper.pdf'
+    path = str(tmpdir.join('paper.pdf'))
+
+    def interrupt(size):
+        # a download interrupted after `size` bytes
+        download = Download(url, path, chunk_size=1024)
+        download.run()
+        os.replace(path, path + '.part')
+        with open(path + '.part', 'r+b') as f:
+            f.truncate(size)
+        with open(path + '.part.json', 'w') as f:
+            json.dump({'url': url, 'etag': pdf_server.etag,
+                'last_modified': ''}, f)
+
+    interrupt(5000)
+    del pdf_server.requests[:]
+    download = Download(url, path, chunk_size=1024)
+    assert download.run() == (fingerprint, len(content))
+    assert download.resumed == 5000
+    assert pdf_server.requests[0]['Range'] == 'bytes=5000-'
+    assert pdf_server.requests[0]['If-Range'] == '"v1"'
+    assert not os.path.exists(path + '.part')
+    assert not os.path.exists(path + '.part.json')
+    with open(path, 'rb') as f:
+        assert f.read() == content
+
+    # the partial file is complete already
+    interrupt(len(content))
+    download = Download(url, path)
+    assert download.run() == (fingerprint, len(content))
+    assert download.resumed == len(content)
+
+    # the file is changed since, so it's downloaded again
+    interrupt(5000)
+    pdf_server.etag = '"v2"'
+    download = Download(url, path, chunk_size=1024)
+    assert download.run() == (fingerprint, len(content))
+    assert download.resumed == 0
+
+    # the bad partial files are discarded, not resumed by the next attempt
+    with pytest.raises(DownloadError, match='larger'):
+        Download(url, path, max_size=1000).run()
+    assert not os.path.exists(path + '.part')
+    assert not os.path.exists(path + '.part.json')
+    login_url = pdf_server.url + '/login.html'
+    with pytest.raises(DownloadError, match='not a PDF'):
+        Download(login_url, path).run()
+    assert not os.path.exists(path + '.part')
+    del pdf_server.requests[:]
+    with pytest.raises(DownloadError, match='not a PDF'):
+        Download(login_url, path).run()
+    assert 'Range' not in pdf_server.requests[0]
+
+
+def test_download_job(app, client, paper, pdf_server):
+    models, jobs, user_id = paper
+    from ResearchHelper.files.models import File, FileOwnership
+    from ResearchHelper.files.config import get_upload_folder
+    fingerprint = hashlib.md5(PdfHandler.content).hexdigest()
+    login(client, user_id)
+    headers = {'Accept': 'application/json'}
+
+    with app.app_context():
+        user = User.query.get(user_id)
+        other = User(username='other', password='other', email='other@test.com')
+        db.session.add(other)
+        db.session.commit()
+        sources = []
+        for i, link in enumerate(['/a.pdf', '/b.pdf', '/login.html', None]):
+            source = models.Source.update_or_create(
+                url='http://fake.test/{}'.format(i), title='Title',
+                abstract='abstract',
+                download_link=pdf_server.url + link if link else None)
+            models.Metadata.get_or_create(source, user)
+            sources.append(source.id)
+        models.Metadata.get_or_create(models.Source.query.get(sources[1]), other)
+        other_id = other.id
+
+    job_ids = []
+    for source_id in sources[:3]:
+        response = client.post('/paper/metadata/{}/download'.format(source_id),
+            headers=headers)
+        job = response.get_json()['data']['job']
+        assert job['kind'] == 'download'
+        assert job['source_id'] == source_id
+        job_ids.append(job['id'])
+    assert client.post('/paper/metadata/{}/download'.format(
+        sources[3])).status_code == 404
+    login(client, other_id)
+    response = client.post('/paper/metadata/{}/download'.format(sources[1]))
+    assert response.status_code == 302
+    job_ids.append(job_ids[-1] + 1)
+
+    with app.app_context():
+        assert jobs.work(burst=True) == 4
+        statuses = [models.PullJob.query.get(job_id).status for job_id in job_ids]
+        assert statuses == ['done', 'done', 'failed', 'done']
+        assert 'not a PDF' in models.PullJob.query.get(job_ids[2]).error
+
+        # the same PDF is saved once, and owned by both users
+        assert File.query.count() == 1
+        file_model = File.query.one()
+        assert file_model.fingerprint == fingerprint
+        assert FileOwnership.query.filter_by(file_id=file_model.id).count() == 2
+        assert os.path.isfile(os.path.join(get_upload_folder(app),
+            file_model.dirname, file_model.filename))
+        source = models.Source.query.get(sources[1])
+        assert source.download_hash == fingerprint
+        assert source.download_count == 2
+        assert source.is_downloaded()
+        assert not models.Source.query.get(sources[2]).is_downloaded()
+
+
+def test_download_race(app, paper, pdf_server, tmpdir):
+    models, jobs, user_id = paper
+    from ResearchHelper.paper.downloads import download_source, create_file
+    from ResearchHelper.files.models import File
+    content = PdfHandler.content
+    fingerprint = hashlib.md5(content).hexdigest()
+
+    with app.app_context():
+        source = models.Source.update_or_create(url='http://fake.test/1',
+            title='Title', abstract='abstract',
+            download_link=pdf_server.url + '/a.pdf')
+        source_id = source.id
+
+    # the jobs of the same source wait for each other
+    errors = []
+
+    def download():
+        with app.app_context():
+            try:
+                download_source(models.Source.query.get(source_id),
+                    User.query.get(user_id), {})
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=download) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    # the later jobs take the file saved by the first one
+    assert len(pdf_server.requests) == 1
+    with app.app_context():
+        assert File.query.count() == 1
+        source = models.Source.query.get(source_id)
+        assert source.download_hash == fingerprint
+        assert source.download_count == 4
+
+        # the file saved by another worker meanwhile is taken
+        path = str(tmpdir.join('copy.pdf'))
+        with open(path, 'wb') as f:
+            f.write(content)
+        file_model = create_file(path, fingerprint)
+        assert file_model.id == File.query.one().id
+        assert File.query.count() == 1
+
+
+def test_download_transport(app, paper, pdf_server, tmpdir):
+    models, jobs, user_id = paper
+    from ResearchHelper.paper.downloads import download_source
+    from ResearchHelper.paper.transports import HTTPConnectionPool, \
+        RecordTransport, ReplayTransport
+    fingerprint = hashlib.md5(PdfHandler.content).hexdigest()
+
+    # the PDFs are neither recorded nor replayed, but downloaded by the
+    # live transport
+    archive = str(tmpdir.join('archive.warc'))
+    pool = HTTPConnectionPool()
+    for i, transport in enumerate([RecordTransport(archive, pool),
+        ReplayTransport(archive)]):
+        with app.app_context():
+            source = models.Source.update_or_create(
+                url='http://fake.test/{}'.format(i), title='Title',
+                abstract='abstract',
+                download_link=pdf_server.url + '/{}.pdf'.format(i))
+            file_model = download_source(source, User.query.get(user_id),
+                {'transport': transport})
+            assert file_model.fingerprint == fingerprint
+    assert len(pdf_server.requests) == 2
+    assert pool.stats()['misses'] == 1
+    assert not os.path.exists(archive)
+
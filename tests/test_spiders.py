@@ -0,0 +1,1253 @@
+import os
+import time
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+import pytest
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    """Serve `/<anything>` as a paper page, `/status/<code>` as an error,
+    `/sleep/<seconds>` as a slow page, `/etag/<tag>` as a page which
+    can be revalidated, `/big/<n>` as a page has n paragraphs and
+    `/throttle/<n>` as a page responds 429 for the first n requests and
+    `/flaky/<n>` as a page responds 503 for the first n requests."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        self.server.requests.append(self.path)
+        if path.startswith('/status/'):
+            self.send_page(int(path.split('/')[2]), b'error')
+            return
+        if path.startswith('/throttle/'):
+            if self.server.requests.count(self.path) <= int(path.split('/')[2]):
+                self.send_page(429, b'slow down', {'Retry-After': '0'})
+                return
+        if path.startswith('/flaky/'):
+            if self.server.requests.count(self.path) <= int(path.split('/')[2]):
+                self.send_page(503, b'unavailable')
+                return
+        if path.startswith('/sleep/'):
+            time.sleep(float(path.split('/')[2]))
+        headers = {}
+        if path.startswith('/etag/'):
+            headers['ETag'] = '"{}"'.format(path.split('/')[2])
+            if self.headers.get('If-None-Match') == headers['ETag']:
+                self.send_page(304, b'', headers)
+                return
+        body = '<html><body><h1 class="ArticleTitle">{}</h1>{}</body></html>'
+        paragraphs = ''
+        if path.startswith('/big/'):
+            paragraphs = '<p>paragraph</p>' * int(path.split('/')[2])
+        body = body.format(self.path, paragraphs).encode('utf-8')
+        self.send_page(200, body, headers)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.do_GET()
+
+    def send_page(self, code, body, headers=None):
+        self.server.responses.append(code)
+        self.send_response(code)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class PageServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def http_server():
+    server = PageServer(('127.0.0.1', 0), PageHandler)
+    server.requests = []
+    server.responses = []
+    server.url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+# The paper package can be imported only after the app is created, so
+# the spiders module is loaded via the `app` fixture.
+@pytest.fixture
+def spiders(app):
+    from ResearchHelper.paper import spiders
+    return spiders
+
+
+@pytest.fixture
+def sleep_spiders(spiders, monkeypatch):
+    class SleepSpider(spiders.BaseSpider):
+        name = 'sleep'
+        host = 'sleep.test'
+
+        def pull(self, data=None, timeout=20):
+            time.sleep(0.2)
+            if self.url.endswith('/broken'):
+                raise spiders.SpiderParseError('broken')
+            self.update_item('title', self.url)
+
+    monkeypatch.setattr(spiders.SpiderFactory, 'registry',
+        spiders.SpiderRegistry([SleepSpider]))
+    return spiders
+
+
+def test_pull_many(sleep_spiders):
+    SpiderFactory = sleep_spiders.SpiderFactory
+    urls = ['http://sleep.test/{}'.format(i) for i in range(10)]
+    urls += ['http://sleep.test/broken', 'http://unknown.test/', urls[0]]
+    start = time.time()
+    results = list(SpiderFactory.pull_many(urls, max_workers=12))
+    assert time.time() - start < 1.0
+
+    results = {url: (item, error) for url, item, error in results}
+    assert len(results) == 12
+    for url in urls[:10]:
+        item, error = results[url]
+        assert error is None
+        assert item['title'] == url
+    assert isinstance(results['http://sleep.test/broken'][1],
+        sleep_spiders.SpiderParseError)
+    assert isinstance(results['http://unknown.test/'][1],
+        sleep_spiders.SpiderError)
+
+
+def test_pull_many_empty(sleep_spiders):
+    assert list(sleep_spiders.SpiderFactory.pull_many(['', ' '])) == []
+
+
+@pytest.fixture
+def local_spiders(spiders, http_server, monkeypatch):
+    class LocalSpider(spiders.SpringerSpider):
+        name = 'local'
+        host = '127.0.0.1'
+
+    monkeypatch.setattr(spiders.SpiderFactory, 'registry',
+        spiders.SpiderRegistry([LocalSpider]))
+    return spiders
+
+
+def test_pull_many_asyncio(local_spiders, http_server):
+    pytest.importorskip('aiohttp')
+    from ResearchHelper.paper.engines import AsyncFetchEngine
+
+    urls = ['{}/sleep/0.2?{}'.format(http_server.url, i) for i in range(20)]
+    urls.append(http_server.url + '/status/404')
+    engine = AsyncFetchEngine(limit_per_host=20)
+    start = time.time()
+    results = list(local_spiders.SpiderFactory.pull_many(urls, engine=engine))
+    assert time.time() - start < 2.0
+
+    results = {url: (item, error) for url, item, error in results}
+    assert len(results) == 21
+    for url in urls[:20]:
+        item, error = results[url]
+        assert error is None
+        assert item['title'] == url[len(http_server.url):]
+    item, error = results[http_server.url + '/status/404']
+    assert isinstance(error, local_spiders.SpiderRequestHTTPError)
+
+
+def test_pull_many_asyncio_transport(local_spiders, http_server, tmpdir):
+    pytest.importorskip('aiohttp')
+    from ResearchHelper.paper.engines import AsyncFetchEngine
+    from ResearchHelper.paper.transports import HTTPConnectionPool, \
+        RecordTransport, ReplayTransport
+
+    # the recorded responses are replayed by the transport, not by aiohttp
+    archive = str(tmpdir.join('archive.warc'))
+    urls = ['{}/{}'.format(http_server.url, i) for i in range(4)]
+    recorder = RecordTransport(archive, HTTPConnectionPool())
+    for url in urls:
+        local_spiders.SpiderFactory.pull_spider(url, transport=recorder)
+    count = len(http_server.requests)
+    replay = ReplayTransport(archive)
+    results = list(local_spiders.SpiderFactory.pull_many(urls,
+        engine=AsyncFetchEngine(), transport=replay))
+    assert sorted(url for url, item, error in results) == sorted(urls)
+    for url, item, error in results:
+        assert error is None
+        assert item['title'] == url[len(http_server.url):]
+    assert replay.stats()['hits'] == 4
+    assert len(http_server.requests) == count
+
+
+def test_pull_many_asyncio_app_options(app, local_spiders, http_server):
+    pytest.importorskip('aiohttp')
+    from ResearchHelper.paper.config import get_spider_options
+    from ResearchHelper.paper.engines import AsyncFetchEngine
+
+    # the connection pool of the app is left to aiohttp
+    with app.app_context():
+        options = get_spider_options(app)
+    options['cache_enabled'] = False
+    pool = options['transport']
+    assert pool is not None
+    urls = ['{}/{}'.format(http_server.url, i) for i in range(4)]
+    results = list(local_spiders.SpiderFactory.pull_many(urls,
+        engine=AsyncFetchEngine(limit_per_host=4), **options))
+    assert len(results) == 4
+    for url, item, error in results:
+        assert error is None
+        assert item['title'] == url[len(http_server.url):]
+    stats = pool.stats()
+    assert stats['hits'] + stats['misses'] == 0
+
+
+def test_connection_pool(local_spiders, http_server):
+    from ResearchHelper.paper.transports import HTTPConnectionPool
+
+    pool = HTTPConnectionPool(maxsize=2)
+    urls = ['{}/{}'.format(http_server.url, i) for i in range(10)]
+    for url in urls:
+        spider = local_spiders.SpiderFactory.pull_spider(url, transport=pool)
+        assert spider.get_item()['title'] == url[len(http_server.url):]
+    stats = pool.stats()
+    assert stats['misses'] == 1
+    assert stats['hits'] == 9
+
+    with pytest.raises(local_spiders.SpiderRequestHTTPError):
+        local_spiders.SpiderFactory.pull_spider(
+            http_server.url + '/status/500', transport=pool)
+    pool.clear()
+    assert pool.stats()['idle'] == {}
+
+
+def test_connection_pool_proxy(http_server):
+    from ResearchHelper.paper.transports import HTTPConnectionPool
+
+    # the test server takes the absolute urls as the proxy
+    pool = HTTPConnectionPool(proxies={'http': http_server.url})
+    with pool.urlopen('http://paper.test/1') as f:
+        assert b'http://paper.test:80/1' in f.read()
+    assert http_server.requests == ['http://paper.test:80/1']
+    with pool.urlopen('http://paper.test/2') as f:
+        f.read()
+    assert pool.stats()['hits'] == 1
+
+    # the hosts of `no_proxy` are requested directly
+    pool = HTTPConnectionPool(proxies={'http': 'http://127.0.0.1:9',
+        'no': '127.0.0.1'})
+    with pool.urlopen(http_server.url + '/3') as f:
+        assert b'<h1 class="ArticleTitle">/3</h1>' in f.read()
+    assert pool.get_proxy('http', '127.0.0.1') is None
+
+    pool = HTTPConnectionPool(proxies={'https': 'user:p%40ss@proxy.test:3128'})
+    assert pool.get_proxy('http', 'paper.test') is None
+    host, port, headers = pool.get_proxy('https', 'paper.test')
+    assert (host, port) == ('proxy.test', 3128)
+    assert headers == {'Proxy-Authorization': 'Basic dXNlcjpwQHNz'}
+
+
+@pytest.mark.parametrize('transport', [None, 'pool'])
+@pytest.mark.parametrize('store', ['file', 'compressed', 'sqlite'])
+def test_cache_revalidate(local_spiders, http_server, tmpdir, transport, store):
+    from ResearchHelper.paper.transports import HTTPConnectionPool
+    from ResearchHelper.paper.caches import create_cache_store
+
+    url = http_server.url + '/etag/v1'
+    kwargs = {
+        'cache_enabled': True,
+        'cache_dir': str(tmpdir),
+        'cache_expire': 3600,
+        'cache_store': create_cache_store(store, str(tmpdir.join('cache'))),
+        'transport': HTTPConnectionPool() if transport else None
+    }
+    spider = local_spiders.SpiderFactory.pull_spider(url, **kwargs)
+    assert spider.get_item()['title'] == '/etag/v1'
+    assert len(http_server.requests) == 1
+
+    # fresh cache, no request
+    local_spiders.SpiderFactory.pull_spider(url, **kwargs)
+    assert len(http_server.requests) == 1
+
+    # stale cache is revalidated, the server responses 304
+    kwargs['cache_expire'] = 1
+    time.sleep(1.1)
+    spider = local_spiders.SpiderFactory.pull_spider(url, **kwargs)
+    assert http_server.responses == [200, 304]
+    assert spider.get_item()['title'] == '/etag/v1'
+    assert spider.cache_store.stat(spider.urlhash) > time.time() - 1
+
+
+@pytest.mark.parametrize('compression', ['zlib', 'lzma'])
+def test_compressed_cache_store(spiders, tmpdir, compression):
+    from ResearchHelper.paper.caches import CompressedCacheStore
+
+    store = CompressedCacheStore(str(tmpdir), compression=compression)
+    content = b'<html>' + b'boilerplate ' * 10000 + b'</html>'
+    assert store.stat('a' * 32) is None
+    store.put('a' * 32, content, {'url': 'http://a'})
+    store.put('b' * 32, content, {'url': 'http://b'})
+    assert store.read('a' * 32) == content
+    assert store.read('b' * 32) == content
+    assert store.meta('b' * 32) == {'url': 'http://b'}
+    assert store.stat('a' * 32) is not None
+
+    # the identical contents are stored once
+    objects = tmpdir.join('objects').visit(fil=lambda p: p.isfile())
+    objects = list(objects)
+    assert len(objects) == 1
+    assert objects[0].size() < len(content) // 10
+
+    store.touch('a' * 32, {'url': 'http://a', 'etag': 'v2'})
+    assert store.meta('a' * 32)['etag'] == 'v2'
+    store.delete('a' * 32)
+    assert store.stat('a' * 32) is None
+    assert store.read('b' * 32) == content
+
+
+@pytest.mark.parametrize('store', ['file', 'compressed', 'sqlite'])
+def test_cache_manager_gc(spiders, tmpdir, store):
+    import lzma
+    from ResearchHelper.paper.caches import create_cache_store, CacheManager
+
+    store = create_cache_store(store, str(tmpdir.join('cache')))
+    keys = ['{:032x}'.format(i) for i in range(10)]
+    now = time.time()
+    for i, key in enumerate(keys):
+        # incompressible contents of the same size
+        store.put(key, lzma.compress(key.encode('ascii') * 200), {})
+        # the later keys are accessed recently
+        store.access(key, now - (10 - i) * 3600)
+    store.record_access(keys[0])
+
+    manager = CacheManager(store, quota=1)
+    size = manager.stats()['size']
+    assert manager.stats()['units'] == 10
+
+    manager.quota = size // 2
+    result = manager.gc(dry_run=True)
+    assert result['evicted'] > 0
+    assert all(store.stat(key) is not None for key in keys)
+
+    result = manager.gc()
+    # keys[0] is accessed just now via the access log
+    assert result['accesses'] == 1
+    assert result['size'] - result['evicted_size'] <= manager.quota
+    assert store.read(keys[0]) is not None
+    assert store.read(keys[-1]) is not None
+    assert store.read(keys[1]) is None
+    assert manager.stats()['access_log_size'] == 0
+    # the broken entries are swept
+    assert store.stat(keys[1]) is None
+
+
+@pytest.mark.parametrize('legacy', [False, True])
+def test_sqlite_cache_store_sweep(spiders, tmpdir, legacy):
+    import sqlite3
+    from ResearchHelper.paper.caches import SqliteCacheStore
+
+    cache_dir = tmpdir.join('cache')
+    db_path = str(cache_dir.join(SqliteCacheStore.filename))
+    if legacy:
+        # a store created before the incremental auto vacuum is enabled
+        cache_dir.ensure(dir=True)
+        conn = sqlite3.connect(db_path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(SqliteCacheStore.schema)
+        conn.commit()
+        conn.close()
+    store = SqliteCacheStore(str(cache_dir))
+    assert store.query('PRAGMA auto_vacuum')[0] == 2
+
+    keys = ['{:032x}'.format(i) for i in range(200)]
+    for key in keys:
+        store.put(key, os.urandom(20000), {})
+    store.query('PRAGMA wal_checkpoint(TRUNCATE)')
+    size = os.path.getsize(db_path)
+    assert size > 3 * 1024 * 1024
+    for key in keys:
+        store.delete(key)
+    freed = sum(store.sweep())
+    # the file and its WAL shrink by the freed size
+    assert freed > size - 64 * 1024
+    assert store.get_file_size() < 64 * 1024
+    assert store.query('PRAGMA freelist_count')[0] == 0
+    assert list(store.sweep()) == []
+
+
+@pytest.mark.parametrize('store', ['file', 'compressed', 'sqlite'])
+def test_pull_stream(local_spiders, http_server, tmpdir, store):
+    from ResearchHelper.paper.caches import create_cache_store
+
+    url = http_server.url + '/big/10000'
+    kwargs = {
+        'cache_enabled': True,
+        'cache_expire': 3600,
+        'cache_store': create_cache_store(store, str(tmpdir.join('cache'))),
+        'stream_enabled': True,
+        'stream_chunk_size': 1024
+    }
+    spider = local_spiders.SpiderFactory.pull_spider(url, **kwargs)
+    assert spider.get_item()['title'] == '/big/10000'
+    content = spider.cache_store.read(spider.urlhash)
+    assert content.count(b'<p>paragraph</p>') == 10000
+
+    # the cached content is parsed
+    spider = local_spiders.SpiderFactory.pull_spider(url, **kwargs)
+    assert spider.get_item()['title'] == '/big/10000'
+    assert len(http_server.requests) == 1
+
+    with pytest.raises(local_spiders.SpiderRequestHTTPError):
+        local_spiders.SpiderFactory.pull_spider(
+            http_server.url + '/status/404', **kwargs)
+
+
+def test_compiled_xpaths(spiders):
+    from lxml import etree
+
+    ArxivSpider = spiders.ArxivSpider
+    compiled = ArxivSpider.compiled_xpaths()
+    assert set(compiled) == set(ArxivSpider.xpaths)
+    # compiled once per spider class
+    assert ArxivSpider.compiled_xpaths() is compiled
+    assert spiders.SpringerSpider.compiled_xpaths() is not compiled
+    assert spiders.BaseSpider.compiled_xpaths() == {}
+
+    content = (
+        '<html><body><div id="abs"><div class="subheader"><h1>cs &gt; AI</h1></div>'
+        '<h1 class="title">Title</h1><div class="authors"><a>A</a><a>B</a></div>'
+        '<blockquote class="abstract">abstract</blockquote>'
+        '<div class="extra-services"><a href="/pdf/1">pdf</a></div>'
+        '<div class="submission-history"><b>v1</b> Mon, 1 Jan 2018 (1 KB)</div>'
+        '</div></body></html>')
+    tree = etree.fromstring(content, etree.HTMLParser()).getroottree()
+    spider = ArxivSpider('https://arxiv.org/abs/1', cache_enabled=False)
+    spider.parse(tree)
+    item = spider.get_item()
+    assert item['title'] == 'Title'
+    assert item['authors'] == ['A', 'B']
+    assert item['categories'] == ['cs', 'AI']
+    assert item['download_link'] == 'https://arxiv.org/pdf/1'
+
+
+def test_parser_pool(spiders):
+    from io import BytesIO
+
+    pool = spiders.ParserPool()
+    with pool.parser('html', recover=True) as parser:
+        with pool.parser('html', recover=True) as nested:
+            assert nested is not parser
+    with pool.parser('html', recover=True) as reused:
+        assert reused in (parser, nested)
+    with pool.parser('html', recover=False) as other:
+        assert other not in (parser, nested)
+    with pytest.raises(ValueError):
+        with pool.parser('html', recover=True) as broken:
+            raise ValueError
+    # the broken parser is discarded
+    assert broken not in pool.get_idle(('html', (('recover', True),)))
+
+    parsers = []
+    def take():
+        with pool.parser('html', recover=True) as parser:
+            parsers.append(parser)
+    thread = threading.Thread(target=take)
+    thread.start()
+    thread.join()
+    assert parsers[0] not in (parser, nested)
+
+    # each parse keeps its own error log
+    broken_spider = spiders.ArxivSpider('https://arxiv.org/abs/1')
+    spider = spiders.ArxivSpider('https://arxiv.org/abs/2')
+    assert list(spider.get_parser_errors()) == []
+    broken_spider.html_parse(BytesIO(b'<html><body><p>broken</b></body></html>'))
+    spider.html_parse(BytesIO(b'<html><body><p>fine</p></body></html>'))
+    assert len(broken_spider.get_parser_errors()) > 0
+    assert len(spider.get_parser_errors()) == 0
+    assert list(spider.get_parser_errors('xml')) == []
+
+
+def test_spider_registry(spiders):
+    SpiderFactory = spiders.SpiderFactory
+    assert SpiderFactory.registry.match('ieee.org') is spiders.IEEESpider
+    assert SpiderFactory.registry.match('IEEEXplore.ieee.org.') is spiders.IEEESpider
+    assert SpiderFactory.registry.match('notieee.org') is None
+    assert SpiderFactory.registry.match('org') is None
+    assert isinstance(SpiderFactory.create_spider('https://arxiv.org:443/abs/1'),
+        spiders.ArxivSpider)
+    assert SpiderFactory.create_spider('https://arxiv.org.evil.test/abs/1') is None
+    assert not spiders.ArxivSpider.host_matched('https://notarxiv.org/abs/1')
+
+    registry = spiders.SpiderRegistry()
+
+    @registry.register
+    class ExampleSpider(spiders.BaseSpider):
+        name = 'example'
+        host = 'example.com'
+
+    class PapersSpider(ExampleSpider):
+        name = 'papers'
+        host = 'papers.example.com'
+
+    registry.register(PapersSpider, 'papers.example.org')
+    # the longest suffix wins
+    assert registry.match('www.example.com') is ExampleSpider
+    assert registry.match('cdn.papers.example.com') is PapersSpider
+    assert registry.match('papers.example.org') is PapersSpider
+    assert registry.match('example.org') is None
+    assert registry.spiders == [ExampleSpider, PapersSpider]
+    assert registry.match_url('http://[::1]:80/') is None
+
+
+def test_single_flight(local_spiders, http_server, tmpdir):
+    url = http_server.url + '/sleep/0.3'
+    lock_dir = str(tmpdir.join('locks'))
+    spiders = []
+    def pull():
+        spiders.append(local_spiders.SpiderFactory.pull_spider(url, lock_dir=lock_dir))
+    threads = [threading.Thread(target=pull) for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # the pulls of other threads share the item of the first one
+    assert len(http_server.requests) == 1
+    assert len(spiders) == 6
+    assert all(spider.item is spiders[0].item for spider in spiders)
+    assert spiders[0].get_item()['title'] == '/sleep/0.3'
+    assert os.listdir(lock_dir) == []
+    assert not local_spiders.SpiderFactory.single_flight.in_flight(spiders[0].urlhash)
+
+    # the error is raised for all of waiters
+    errors = []
+    def pull_error():
+        try:
+            local_spiders.SpiderFactory.pull_spider(http_server.url + '/status/404')
+        except local_spiders.SpiderError as e:
+            errors.append(e)
+    threads = [threading.Thread(target=pull_error) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 3
+
+
+def test_file_lock(tmpdir):
+    import multiprocessing
+    from ResearchHelper.paper import locks
+
+    if locks.fcntl is None:
+        pytest.skip('lock file is not supported')
+
+    filename = str(tmpdir.join('locks', 'url.lock'))
+    marker = str(tmpdir.join('locked'))
+
+    def hold():
+        with locks.file_lock(filename):
+            open(marker, 'w').close()
+            time.sleep(0.5)
+
+    process = multiprocessing.get_context('fork').Process(target=hold)
+    process.start()
+    while not os.path.exists(marker):
+        time.sleep(0.01)
+    start = time.time()
+    with locks.file_lock(filename):
+        assert time.time() - start > 0.2
+        assert os.path.exists(filename)
+    process.join()
+    assert not os.path.exists(filename)
+
+
+def test_token_bucket():
+    from ResearchHelper.paper.schedulers import TokenBucket, parse_retry_after
+
+    now = [0.0]
+    bucket = TokenBucket(rate=1, burst=2, clock=lambda: now[0])
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 1.0
+    assert bucket.reserve() == 2.0
+    now[0] = 3.0
+    assert bucket.delay() == 0
+    bucket.pause(10)
+    assert bucket.delay() == 10.0
+    now[0] = 13.0
+    assert bucket.delay() == 0
+
+    assert parse_retry_after('5') == 5.0
+    assert parse_retry_after('Thu, 01 Jan 1970 00:01:40 GMT', now=40) == 60.0
+    assert parse_retry_after('soon') is None
+    assert parse_retry_after(None) is None
+
+
+def test_fair_queue():
+    from ResearchHelper.paper.schedulers import HostScheduler, FairQueue
+
+    now = [0.0]
+    scheduler = HostScheduler(rate=1, burst=1, clock=lambda: now[0])
+    queue = FairQueue(scheduler)
+    for i in range(2):
+        queue.put('a', 'a{}'.format(i))
+        queue.put('b', 'b{}'.format(i))
+    assert len(queue) == 4
+    assert queue.next() == ('a', 0.0)
+    assert queue.get('a') == 'a0'
+    scheduler.reserve('a')
+    # the limited host is skipped
+    assert queue.next() == ('b', 0.0)
+    assert queue.get('b') == 'b0'
+    scheduler.reserve('b')
+    assert queue.next() == ('a', 1.0)
+    assert queue.next(skip=['a']) == ('b', 1.0)
+    assert queue.next(skip=['a', 'b']) is None
+
+
+def test_shared_host_scheduler(tmpdir):
+    import multiprocessing
+    from ResearchHelper.paper.schedulers import SharedHostScheduler
+
+    now = [100.0]
+    db_path = str(tmpdir.join('limits.sqlite3'))
+    # the schedulers of two processes
+    first = SharedHostScheduler(db_path, rate=1, burst=2, clock=lambda: now[0])
+    second = SharedHostScheduler(db_path, rate=1, burst=2, clock=lambda: now[0])
+    assert first.reserve('a') == 0.0
+    assert second.reserve('a') == 0.0
+    # the burst is used up by both
+    assert first.reserve('a') == 1.0
+    assert second.delay('b') == 0.0
+    now[0] += 2
+    assert second.delay('a') == 0.0
+    second.throttle('a', retry_after=5)
+    assert first.delay('a') == 5.0
+    assert second.stats()['throttled'] == 1
+    assert first.stats()['delay'] == {'a': 5.0, 'b': 0.0}
+
+    # the burst is shared by the processes
+    def take(db_path, queue):
+        scheduler = SharedHostScheduler(db_path, rate=0.01, burst=5)
+        queue.put([scheduler.reserve('c') for i in range(5)])
+
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    processes = [context.Process(target=take, args=(db_path, queue))
+        for i in range(2)]
+    for process in processes:
+        process.start()
+    waits = queue.get(timeout=30) + queue.get(timeout=30)
+    for process in processes:
+        process.join()
+    assert sum(1 for wait in waits if wait == 0) == 5
+
+
+def test_pull_many_scheduler(spiders, monkeypatch):
+    from ResearchHelper.paper.schedulers import HostScheduler
+
+    class ScheduledSpider(spiders.BaseSpider):
+        def pull(self, data=None, timeout=20):
+            self.scheduler.acquire(self.host)
+            self.update_item('title', self.url)
+
+    class SlowSpider(ScheduledSpider):
+        name = 'slow'
+        host = 'slow.test'
+
+    class FastSpider(ScheduledSpider):
+        name = 'fast'
+        host = 'fast.test'
+
+    monkeypatch.setattr(spiders.SpiderFactory, 'registry',
+        spiders.SpiderRegistry([SlowSpider, FastSpider]))
+    scheduler = HostScheduler(rate=100, burst=4, limits={'slow.test': (5, 1)})
+    urls = ['http://slow.test/{}'.format(i) for i in range(4)]
+    urls += ['http://fast.test/{}'.format(i) for i in range(4)]
+    start = time.time()
+    results = [url for url, item, error in spiders.SpiderFactory.pull_many(
+        urls, max_workers=2, scheduler=scheduler)]
+    # 4 requests of slow.test take 3 intervals of 0.2s
+    assert 0.55 < time.time() - start < 1.5
+    assert sorted(results) == sorted(urls)
+    # fast.test isn't blocked by slow.test
+    assert results[-1].startswith('http://slow.test/')
+    assert max(results.index(url) for url in urls[4:]) < 6
+
+
+def test_throttled_pull(local_spiders, http_server):
+    from ResearchHelper.paper.schedulers import HostScheduler
+
+    scheduler = HostScheduler(rate=100, burst=10)
+    spider = local_spiders.SpiderFactory.pull_spider(
+        http_server.url + '/throttle/2', scheduler=scheduler)
+    assert spider.get_item()['title'] == '/throttle/2'
+    assert http_server.responses == [429, 429, 200]
+    assert scheduler.stats()['throttled'] == 2
+
+    with pytest.raises(local_spiders.SpiderRequestHTTPError):
+        local_spiders.SpiderFactory.pull_spider(
+            http_server.url + '/throttle/5', scheduler=scheduler)
+    assert http_server.responses[3:] == [429, 429, 429]
+
+
+def test_retry_policy():
+    from ResearchHelper.paper.breakers import RetryPolicy
+
+    waits = []
+    policy = RetryPolicy(retries=3, backoff=0.5, max_backoff=1,
+        sleep=waits.append, random=lambda: 1.0)
+    assert all(policy.wait(attempt) for attempt in range(3))
+    assert not policy.wait(3)
+    assert waits == [0.5, 1.0, 1.0]
+    policy.random = lambda: 0.5
+    assert policy.get_backoff(0) == 0.25
+
+
+def test_circuit_breaker():
+    from ResearchHelper.paper.breakers import CircuitBreaker
+
+    now = [0.0]
+    breaker = CircuitBreaker(window=10, min_requests=4, threshold=0.5,
+        reset_timeout=30, clock=lambda: now[0])
+    for failed in (False, True, False):
+        assert breaker.allow()
+        breaker.record(failed)
+    assert breaker.state == 'closed'
+    breaker.record(True)
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+
+    # a probe is sent after the reset timeout
+    now[0] = 30.0
+    assert breaker.allow()
+    assert breaker.state == 'half-open'
+    assert not breaker.allow()
+    breaker.record(True)
+    assert breaker.state == 'open'
+    now[0] = 60.0
+    assert breaker.allow()
+    breaker.record(False)
+    assert breaker.state == 'closed'
+    stats = breaker.stats()
+    assert stats['trips'] == 2
+    assert stats['rejected'] == 2
+    assert stats['requests'] == 0
+
+
+def test_pull_retry(local_spiders, http_server):
+    from ResearchHelper.paper.breakers import RetryPolicy, CircuitBreakers
+
+    waits = []
+    policy = RetryPolicy(retries=2, sleep=waits.append)
+    breakers = CircuitBreakers(min_requests=3, threshold=0.5)
+    spider = local_spiders.SpiderFactory.pull_spider(
+        http_server.url + '/flaky/2', retry_policy=policy, breakers=breakers)
+    assert spider.get_item()['title'] == '/flaky/2'
+    assert http_server.responses == [503, 503, 200]
+    assert len(waits) == 2
+    assert breakers.stats()['127.0.0.1']['state'] == 'closed'
+
+    # the errors of the url are not retried
+    with pytest.raises(local_spiders.SpiderRequestHTTPError):
+        local_spiders.SpiderFactory.pull_spider(http_server.url + '/status/404',
+            retry_policy=policy, breakers=breakers)
+    assert http_server.responses[3:] == [404]
+
+    # the host keeps failing, so the circuit is open, even the retries of
+    # the request fail fast
+    with pytest.raises(local_spiders.SpiderRequestError):
+        local_spiders.SpiderFactory.pull_spider(http_server.url + '/status/500',
+            retry_policy=policy, breakers=breakers)
+    assert breakers.state('127.0.0.1') == 'open'
+    count = len(http_server.requests)
+    with pytest.raises(local_spiders.SpiderRequestUnavailableError):
+        local_spiders.SpiderFactory.pull_spider(http_server.url + '/1',
+            retry_policy=policy, breakers=breakers)
+    assert len(http_server.requests) == count
+
+    # a POST request isn't retried
+    with pytest.raises(local_spiders.SpiderRequestHTTPError):
+        local_spiders.SpiderFactory.pull_spider(http_server.url + '/flaky/3',
+            data={'q': 'x'}, retry_policy=policy)
+    assert http_server.responses[-1:] == [503]
+    assert http_server.requests.count('/flaky/3') == 1
+
+
+def test_is_transient(local_spiders):
+    import socket
+    from urllib.error import URLError, HTTPError
+
+    spider = local_spiders.SpiderFactory.create_spider('http://127.0.0.1/1')
+    assert spider.is_transient(HTTPError(spider.url, 503, 'error', {}, None))
+    assert not spider.is_transient(HTTPError(spider.url, 404, 'error', {}, None))
+    assert spider.is_transient(URLError(socket.timeout('timed out')))
+    assert spider.is_transient(URLError(ConnectionRefusedError()))
+    assert spider.is_transient(socket.timeout('timed out'))
+    assert not spider.is_transient(URLError('unknown url type: x'))
+    assert not spider.is_transient(URLError(socket.gaierror('unknown host')))
+
+
+def test_negative_cache(local_spiders, http_server, tmpdir):
+    from ResearchHelper.paper.caches import NegativeCache
+    from ResearchHelper.paper.metrics import MetricsRegistry
+
+    negative_cache = NegativeCache(str(tmpdir.join('failures.sqlite3')),
+        {'http_4xx': 3600, 'parse': 0.2})
+    metrics = MetricsRegistry()
+    url = http_server.url + '/status/404'
+    for i in range(3):
+        with pytest.raises(local_spiders.SpiderRequestHTTPError) as info:
+            local_spiders.SpiderFactory.pull_spider(url,
+                negative_cache=negative_cache, metrics=metrics)
+        assert str(info.value) == 'HTTP error, 404: Not Found'
+        assert info.value.code == 404
+    # the failure is kept
+    assert http_server.responses == [404]
+    assert negative_cache.stats() == {'http_4xx': 1}
+    assert metrics.stats()['counters']['negative_cache_hit'] == {'127.0.0.1': 2}
+    spider = local_spiders.SpiderFactory.create_spider(url)
+    assert negative_cache.get(spider.urlhash)['kind'] == 'http_4xx'
+    assert negative_cache.get(spider.urlhash)['code'] == 404
+
+    # the failures without TTL are not kept
+    with pytest.raises(local_spiders.SpiderRequestHTTPError):
+        local_spiders.SpiderFactory.pull_spider(http_server.url + '/status/500',
+            negative_cache=negative_cache)
+    assert negative_cache.stats() == {'http_4xx': 1}
+
+    # the failure expires
+    assert negative_cache.put('key', 'parse', 'SpiderParseError', 'broken')
+    assert negative_cache.get('key')['error'] == 'SpiderParseError'
+    time.sleep(0.3)
+    assert negative_cache.get('key') is None
+    negative_cache.delete(spider.urlhash)
+    with pytest.raises(local_spiders.SpiderRequestHTTPError):
+        local_spiders.SpiderFactory.pull_spider(url, negative_cache=negative_cache)
+    assert http_server.responses[-1] == 404
+    assert len(http_server.responses) == 3
+
+
+def test_negative_cache_legacy_schema(tmpdir):
+    import sqlite3
+    from ResearchHelper.paper.caches import NegativeCache
+
+    db_path = str(tmpdir.join('failures.sqlite3'))
+    conn = sqlite3.connect(db_path)
+    conn.execute('CREATE TABLE failure (key TEXT PRIMARY KEY, kind TEXT NOT NULL, '
+        'error TEXT NOT NULL, message TEXT NOT NULL, time REAL NOT NULL, '
+        'expires REAL NOT NULL)')
+    conn.execute("INSERT INTO failure VALUES ('old', 'http_4xx', "
+        "'SpiderRequestHTTPError', 'HTTP error, 404: Not Found', 0, 1e12)")
+    conn.commit()
+    conn.close()
+    # the kept failures have no code
+    negative_cache = NegativeCache(db_path, {'http_4xx': 3600})
+    assert negative_cache.get('old')['code'] is None
+    negative_cache.put('new', 'http_4xx', 'SpiderRequestHTTPError', 'gone', 410)
+    assert negative_cache.get('new')['code'] == 410
+
+
+@pytest.mark.parametrize('archive', ['archive.warc', 'archive.warc.gz', 'archive.har'])
+def test_archive_append_processes(tmpdir, archive):
+    import multiprocessing
+    from ResearchHelper.paper.archives import open_archive, ArchiveRecord
+
+    path = str(tmpdir.join(archive))
+
+    def append(name):
+        archive = open_archive(path)
+        for i in range(20):
+            url = 'http://a.test/{}/{}'.format(name, i)
+            archive.append(ArchiveRecord(url, 200, 'OK',
+                [('Content-Type', 'text/html')], os.urandom(2048), None))
+
+    # the records of the processes are all kept, and never mixed up
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=append, args=(i,)) for i in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+    records = list(open_archive(path))
+    assert len(records) == 80
+    assert len(set(record.url for record in records)) == 80
+    assert all(len(record.body) == 2048 for record in records)
+
+
+@pytest.mark.parametrize('archive', ['archive.warc', 'archive.warc.gz', 'archive.har'])
+def test_record_replay(local_spiders, http_server, tmpdir, archive):
+    from ResearchHelper.paper.transports import (HTTPConnectionPool,
+        RecordTransport, ReplayTransport)
+
+    path = str(tmpdir.join(archive))
+    urls = ['{}/{}'.format(http_server.url, i) for i in range(3)]
+    urls.append(http_server.url + '/status/404')
+    recorder = RecordTransport(path, HTTPConnectionPool())
+    for url in urls[:3]:
+        spider = local_spiders.SpiderFactory.pull_spider(url, transport=recorder)
+        assert spider.get_item()['title'] == url[len(http_server.url):]
+    with pytest.raises(local_spiders.SpiderRequestHTTPError):
+        local_spiders.SpiderFactory.pull_spider(urls[3], transport=recorder)
+    assert recorder.stats()['recorded'] == 4
+    assert len(http_server.requests) == 4
+
+    # the same results without the network
+    replayer = ReplayTransport(path)
+    for url in urls[:3]:
+        for stream_enabled in (True, False):
+            spider = local_spiders.SpiderFactory.pull_spider(url,
+                transport=replayer, stream_enabled=stream_enabled)
+            assert spider.get_item()['title'] == url[len(http_server.url):]
+    with pytest.raises(local_spiders.SpiderRequestHTTPError) as info:
+        local_spiders.SpiderFactory.pull_spider(urls[3], transport=replayer)
+    assert info.value.code == 404
+    with pytest.raises(local_spiders.SpiderRequestUnknowError):
+        local_spiders.SpiderFactory.pull_spider(http_server.url + '/missing',
+            transport=replayer)
+    assert len(http_server.requests) == 4
+    assert replayer.stats()['records'] == 4
+
+
+def test_date_normalizer(spiders):
+    import datetime
+    from ResearchHelper.paper.dates import DateNormalizer
+
+    normalizer = DateNormalizer()
+    cases = [
+        ('2018-01-02', datetime.datetime(2018, 1, 2), 'iso'),
+        ('2017-11-30T10:20:30Z', datetime.datetime(2017, 11, 30, 10, 20, 30), 'iso'),
+        (' 1 January 2018 ', datetime.datetime(2018, 1, 1), 'day month year'),
+        ('Mon, 1 Jan 2018 08:00:00 UTC', datetime.datetime(2018, 1, 1, 8), 'day month year'),
+        ('Jan. 12, 2018', datetime.datetime(2018, 1, 12), 'month day year'),
+        ('September 2016', datetime.datetime(2016, 9, 1), 'month year'),
+        ('2016', datetime.datetime(2016, 1, 1), 'year'),
+        ('12/25/2017', datetime.datetime(2017, 12, 25), 'dateutil'),
+    ]
+    for text, value, name in cases:
+        result = normalizer.parse(text)
+        assert (result.value, result.format) == (value, name)
+
+    # the format of the key is tried first
+    normalizer.parse('5 March 2018', 'site')
+    assert normalizer.learned['site'] == 1
+    assert normalizer.parse('6 March 2018', 'site').value == datetime.datetime(2018, 3, 6)
+    assert normalizer.parse('2018-03-07', 'site').format == 'iso'
+    assert normalizer.learned['site'] == 0
+
+    for text in ('', 'not a date', '30 February 2018x'):
+        result = normalizer.parse(text)
+        assert result.value is None
+        assert result.error
+
+    # the unparseable date is kept by the item
+    item = spiders.PaperItem('http://example.com/', 'example')
+    item.published = '2 May 2018'
+    assert item.published == datetime.datetime(2018, 5, 2)
+    item.published = 'unknown'
+    assert item.published == datetime.datetime(2018, 5, 2)
+    assert item.published_result.value is None
+    assert item.published_result.text == 'unknown'
+
+
+def test_parse_cache(local_spiders, http_server, tmpdir):
+    from ResearchHelper.paper.caches import ParseCache
+
+    parse_cache = ParseCache(str(tmpdir.join('items.sqlite3')))
+    parsed = []
+
+    class CountSpider(local_spiders.SpringerSpider):
+        host = '127.0.0.1'
+
+        def parse(self, tree):
+            parsed.append(self.url)
+            super().parse(tree)
+            self.update_item('published', '2 May 2018')
+
+    kwargs = {'cache_enabled': True, 'cache_dir': str(tmpdir.join('cache')),
+        'cache_expire': 3600, 'parse_cache': parse_cache}
+    url = http_server.url + '/1'
+    for stream_enabled in (False, True):
+        spider = CountSpider(url, stream_enabled=stream_enabled, **kwargs)
+        spider.pull()
+        assert spider.get_item()['title'] == '/1'
+    # the cached content is parsed once, and the item is kept
+    assert parsed == [url]
+    item = spider.get_item()
+    assert item['published'].year == 2018
+    assert parse_cache.stats()['hits'] == 1
+
+    # a new version of the spider parses it again
+    class NewSpider(CountSpider):
+        version = 2
+
+    NewSpider(url, **kwargs).pull()
+    NewSpider(url, **kwargs).pull()
+    CountSpider.version = 2
+    CountSpider(url, **kwargs).pull()
+    assert parsed == [url, url, url]
+    # the items of the old version are kept until they're purged, since
+    # the processes of both versions may run during a deploy
+    items = parse_cache.stats()['items']
+    assert items == {NewSpider.get_spider_key(): 1, CountSpider.get_spider_key(): 2}
+    assert parse_cache.purge_versions({CountSpider.get_spider_key(): 2}) == 1
+    items = parse_cache.stats()['items']
+    assert items == {NewSpider.get_spider_key(): 1, CountSpider.get_spider_key(): 1}
+    assert parse_cache.purge(NewSpider.get_spider_key()) == 1
+
+    # the same content of another url isn't taken, its links differ
+    key = CountSpider.get_spider_key()
+    parse_cache.put('a' * 32, 'digest', key, 2, {'download_link': 'http://a/x.pdf'})
+    assert parse_cache.get('b' * 32, 'digest', key, 2) is None
+    assert parse_cache.get('a' * 32, 'digest', key, 2) == {
+        'download_link': 'http://a/x.pdf'}
+
+    # the item of the former content of the url is replaced
+    parse_cache.put('a' * 32, 'changed', key, 2, {'title': 'changed'})
+    assert parse_cache.get('a' * 32, 'digest', key, 2) is None
+    assert parse_cache.get('a' * 32, 'changed', key, 2) == {'title': 'changed'}
+    assert parse_cache.stats()['items'] == {key: 2}
+
+
+def test_parse_cache_legacy_schema(spiders, tmpdir):
+    import sqlite3
+    from ResearchHelper.paper.caches import ParseCache
+
+    db_path = str(tmpdir.join('items.sqlite3'))
+    conn = sqlite3.connect(db_path)
+    conn.execute('CREATE TABLE item (digest TEXT NOT NULL, spider TEXT NOT NULL, '
+        'version TEXT NOT NULL, item TEXT NOT NULL, time REAL NOT NULL, '
+        'PRIMARY KEY (digest, spider, version))')
+    conn.execute("INSERT INTO item VALUES ('d', 's', '1', '{}', 0)")
+    conn.commit()
+    conn.close()
+    # the items kept without their urls are dropped
+    parse_cache = ParseCache(db_path)
+    assert parse_cache.stats()['items'] == {}
+    parse_cache.put('a' * 32, 'd', 's', 1, {'title': 't'})
+    assert parse_cache.get('a' * 32, 'd', 's', 1) == {'title': 't'}
+
+
+def test_stop_condition(spiders):
+    content = b'<html><head><title>t</title></head><body>' + b'x' * 100
+    for size in (1, 3, 7, 1000):
+        chunks = [content[i:i + size] for i in range(0, len(content), size)]
+        stop = spiders.StopCondition([b'<title>', b'</head>'])
+        read = b''
+        for chunk in chunks:
+            read += stop.feed(chunk)
+            if stop.stopped:
+                break
+        assert read == b'<html><head><title>t</title></head>'
+        assert stop.feed(b'more') == b''
+
+    stop = spiders.StopCondition(max_bytes=10)
+    assert stop.feed(b'12345') == b'12345'
+    assert stop.feed(b'67890abc') == b'67890'
+    assert stop.stopped
+    stop = spiders.StopCondition([b'</missing>'])
+    assert stop.feed(content) == content
+    assert not stop.stopped
+
+
+@pytest.mark.parametrize('stream_enabled', [True, False])
+def test_pull_stop_markers(local_spiders, http_server, tmpdir, stream_enabled):
+    from ResearchHelper.paper.transports import HTTPConnectionPool
+    from ResearchHelper.paper.caches import create_cache_store
+
+    class HeadSpider(local_spiders.SpringerSpider):
+        host = '127.0.0.1'
+        stop_markers = (b'</h1>',)
+        stream_chunk_size = 1024
+
+    store = create_cache_store('file', str(tmpdir))
+    pool = HTTPConnectionPool()
+    kwargs = {'cache_enabled': True, 'cache_store': store, 'transport': pool,
+        'stream_enabled': stream_enabled}
+    url = http_server.url + '/big/100000'
+    spider = HeadSpider(url, **kwargs)
+    spider.pull()
+    assert spider.get_item()['title'] == '/big/100000'
+    assert spider.truncated
+    content = store.read(spider.urlhash)
+    assert content.endswith(b'</h1>')
+    assert store.meta(spider.urlhash)['truncated']
+
+    # the connection with the unread content isn't reused
+    spider = HeadSpider(http_server.url + '/1', **kwargs)
+    spider.pull()
+    assert spider.get_item()['title'] == '/1'
+    assert pool.stats()['hits'] == 0
+
+
+@pytest.mark.parametrize('stream_enabled', [True, False])
+def test_stop_markers_recorded_pages(spiders, tmpdir, stream_enabled):
+    """The pages of arXiv and IEEE recorded in `archives/pages.warc`, they
+    are cut after the metadata, but never before it."""
+    import datetime
+    from ResearchHelper.paper.transports import ReplayTransport
+    from ResearchHelper.paper.caches import create_cache_store
+
+    archive = os.path.join(os.path.dirname(__file__), 'archives', 'pages.warc')
+    store = create_cache_store('file', str(tmpdir))
+    kwargs = {'cache_enabled': True, 'cache_store': store,
+        'transport': ReplayTransport(archive), 'stream_enabled': stream_enabled}
+
+    spider = spiders.ArxivSpider('https://arxiv.org/abs/1706.03762', **kwargs)
+    spider.pull()
+    item = spider.get_item()
+    assert item['title'] == 'Attention Is All You Need'
+    assert item['authors'][0] == 'Ashish Vaswani'
+    assert len(item['authors']) == 8
+    assert item['abstract'].startswith('The dominant sequence transduction models')
+    assert item['published'].date() == datetime.date(2017, 12, 6)
+    assert item['download_link'] == 'https://arxiv.org/pdf/1706.03762'
+    # the style and script of the submission history are not the marker
+    assert spider.truncated
+    content = store.read(spider.urlhash)
+    assert content.rstrip().endswith(b'(1,102 KB)<br/>\n    </div>')
+    assert b'endorsers' not in content
+
+    spider = spiders.IEEESpider('https://ieeexplore.ieee.org/document/7780459', **kwargs)
+    spider.pull()
+    item = spider.get_item()
+    assert item['title'] == 'Deep Residual Learning for Image Recognition'
+    assert item['authors'] == ['Kaiming He', 'Xiangyu Zhang', 'Shaoqing Ren', 'Jian Sun']
+    assert item['doi_link'] == 'https://doi.org/10.1109/CVPR.2016.90'
+    assert item['download_link'] == \
+        'https://ieeexplore.ieee.org/stamp/stamp.jsp?tp=&arnumber=7780459'
+    assert 'Image recognition' in item['keywords']
+    assert spider.truncated
+    content = store.read(spider.urlhash)
+    assert content.endswith(b'</script>')
+    assert b'References' not in content
+
+
+def test_metrics_registry():
+    from ResearchHelper.paper.metrics import MetricsRegistry, Histogram, \
+        cache_hit_ratios
+
+    histogram = Histogram((0.1, 1, 10))
+    for value in (0.05, 0.5, 0.5, 5, 50):
+        histogram.observe(value)
+    stats = histogram.stats()
+    assert stats['count'] == 5
+    assert stats['buckets'] == {'0.1': 1, '1': 3, '10': 4, '+Inf': 5}
+    assert stats['p50'] == 1
+    assert stats['p99'] == 50
+    assert stats['max'] == 50
+
+    registry = MetricsRegistry({'fetch_seconds': (0.1, 1)})
+    registry.inc('bytes', 'a.test', 10)
+    registry.inc('bytes', 'a.test', 5)
+    with pytest.raises(ValueError):
+        with registry.timer('fetch_seconds', 'a.test'):
+            raise ValueError()
+    stats = registry.stats()
+    assert stats['counters'] == {'bytes': {'a.test': 15}}
+    fetch = stats['histograms']['fetch_seconds']['a.test']
+    assert fetch['count'] == 1
+    assert list(fetch['buckets']) == ['0.1', '1', '+Inf']
+
+    # the snapshots of other processes are merged, even of other bounds
+    merged = MetricsRegistry({'fetch_seconds': (1, 10)})
+    merged.merge(registry.snapshot())
+    merged.merge({'counters': {'bytes': {'b.test': 1}}, 'histograms': {}})
+    stats = merged.stats()
+    assert stats['counters'] == {'bytes': {'a.test': 15, 'b.test': 1}}
+    fetch = stats['histograms']['fetch_seconds']['a.test']
+    assert fetch['count'] == 1
+    assert list(fetch['buckets']) == ['1', '10', '+Inf']
+
+    # a miss, then a stale cache revalidated
+    counters = {'cache_miss': {'a.test': 1}, 'cache_stale': {'a.test': 1},
+        'cache_revalidated': {'a.test': 1}}
+    assert cache_hit_ratios(counters) == {'a.test': 0.5}
+    counters = {'cache_hit': {'a.test': 2}, 'cache_revalidated': {'a.test': 1},
+        'cache_stale': {'a.test': 1}, 'cache_miss': {'a.test': 1, 'b.test': 1}}
+    assert cache_hit_ratios(counters) == {'a.test': 0.75, 'b.test': 0.0}
+
+
+@pytest.mark.parametrize('stream_enabled', [False, True])
+def test_pull_metrics(local_spiders, http_server, tmpdir, stream_enabled):
+    from ResearchHelper.paper.metrics import MetricsRegistry
+
+    metrics = MetricsRegistry()
+    kwargs = {'cache_enabled': True, 'cache_dir': str(tmpdir),
+        'cache_expire': 3600, 'stream_enabled': stream_enabled,
+        'metrics': metrics}
+    SpiderFactory = local_spiders.SpiderFactory
+    SpiderFactory.pull_spider(http_server.url + '/1', **kwargs)
+    SpiderFactory.pull_spider(http_server.url + '/1', **kwargs)
+    with pytest.raises(local_spiders.SpiderRequestHTTPError):
+        SpiderFactory.pull_spider(http_server.url + '/status/404', **kwargs)
+
+    stats = metrics.stats()
+    counters = stats['counters']
+    assert counters['cache_miss'] == {'127.0.0.1': 2}
+    assert counters['cache_hit'] == {'127.0.0.1': 1}
+    assert counters['cache_write'] == {'127.0.0.1': 1}
+    assert counters['bytes']['127.0.0.1'] > 0
+    assert counters['errors'] == {'SpiderRequestHTTPError': 1}
+    histograms = stats['histograms']
+    assert histograms['fetch_seconds']['127.0.0.1']['count'] == 2
+    # the cached content is parsed, the stream is parsed while reading
+    assert histograms['parse_seconds']['local']['count'] == 2
+    html_parse = histograms.get('html_parse_seconds', {}).get('local', {})
+    assert html_parse.get('count', 0) == (1 if stream_enabled else 2)
+
+
+def test_parse_sandbox(spiders, http_server):
+    from ResearchHelper.paper.sandbox import ParseSandbox, SandboxTimeoutError, \
+        SandboxMemoryError, get_rss
+
+    sandbox = ParseSandbox(processes=1, max_jobs=2, memory_limit=None, timeout=10)
+    kwargs = {'cache_enabled': False, 'stream_enabled': True,
+        'parse_sandbox': sandbox}
+    try:
+        for i in range(3):
+            spider = spiders.SpringerSpider(http_server.url + '/{}'.format(i), **kwargs)
+            spider.pull()
+            assert spider.get_item()['title'] == '/{}'.format(i)
+        # the worker is restarted after 2 pages
+        stats = sandbox.stats()
+        assert stats['jobs'] == 3
+        assert stats['started'] == 2
+
+        # a page takes too long, its worker is killed
+        sandbox.timeout = 0.01
+        spider = spiders.SpringerSpider(http_server.url + '/big/400000', **kwargs)
+        with pytest.raises(spiders.SpiderParseError, match='seconds'):
+            spider.pull()
+        content = b'<html><body>' + b'<p>paragraph</p>' * 400000 + b'</body></html>'
+        with pytest.raises(SandboxTimeoutError):
+            sandbox.parse(spider, content)
+        assert sandbox.stats()['timeouts'] == 2
+
+        # a page takes too much memory, its worker fails and quits
+        if get_rss(os.getpid()) is not None:
+            sandbox.close()
+            sandbox.timeout = 60
+            sandbox.memory_limit = 300 * 1024 * 1024
+            huge = b'<html><body>' + b'<p>paragraph</p>' * 2000000 + b'</body></html>'
+            with pytest.raises(SandboxMemoryError):
+                sandbox.parse(spider, huge)
+            assert sandbox.stats()['memory_kills'] == 1
+            # the limit is of the worker, not of this process
+            spider = spiders.SpringerSpider(http_server.url + '/small', **kwargs)
+            spider.pull()
+            assert spider.get_item()['title'] == '/small'
+
+        # the sandbox still works after the workers are killed
+        sandbox.timeout = 10
+        sandbox.memory_limit = None
+        spider = spiders.SpringerSpider(http_server.url + '/ok', **kwargs)
+        spider.pull()
+        assert spider.get_item()['title'] == '/ok'
+    finally:
+        sandbox.close()